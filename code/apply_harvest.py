@@ -0,0 +1,402 @@
+"""Incremental application of OAI harvests.
+
+@author Christoph Broschinski (https://github.com/cbroschinski)
+
+Instead of running the whole pipeline again for every new BASE dump, this
+script applies incremental OAI-PMH harvests (ListRecords files, compressed
+with bzip2, in DELTA_DIR) to the existing results. A harvest contains new
+and updated records as well as deleted ones (header status "deleted").
+
+1) The records of all new harvest files are reduced like in
+create_reduced_records.py and looked up in the identifier index (see
+record_index.py). Updated records with the same reduced content hash as
+the indexed version are skipped.
+
+2) Updated and deleted records are replaced in/removed from the
+reducedListRecords file they are stored in. The counters of their old
+versions are subtracted from the stats file, the counters of the new
+versions are added. Their corpus files and manifest entries are replaced.
+
+3) New records are written to a new reducedListRecords file and processed
+like in process_reduced_records.py.
+
+4) The prepared corpora (see prepare_corpora.py) are updated: Documents
+which no longer exist are removed from their corpus, new documents are
+added to the test (with the test corpus ratio of the split, or -t) or
+training corpus. The eval corpus keeps its documents, their classes are
+updated. In TSV corpora, only the chunks with removed or updated
+documents are compressed again, new documents are appended as new chunks.
+TSV corpora written before the chunk index was introduced have to be
+rebuilt once (-r).
+
+Only corpora with a plain random split are updated incrementally. New
+documents can not be assigned to the class strata (-s) or duplicate
+clusters (-u/-x, the clusters do not contain them yet) of a split without
+recomputing it, so a near-duplicate of a training document could end up
+in the test corpus and the per-class caps would be exceeded. Such corpora
+(and corpora without stored split settings) are left untouched,
+prepare_corpora.py (and deduplicate_corpus.py) must be run again.
+
+The processing settings are taken from the journal of
+process_reduced_records.py, so the results are the same as those of a
+complete new run. All reducedListRecords files must have been processed
+with these settings, if a run of this script is interrupted, running
+process_reduced_records.py (with the same settings) repairs the results
+of the affected files. Stats files generated from a sample and
+pre-filtered reduced records (which are not complete) are not supported.
+Applied harvest files are recorded in JOURNAL_DIR, summarize_stats.py
+(and deduplicate_corpus.py, if used) must be run again afterwards.
+"""
+
+import argparse
+import bz2
+import csv
+import json
+import os
+import re
+import sys
+
+from os.path import join
+from random import random
+
+from corpus_manifest import MANIFEST_PATH, PARTS_DIR as MANIFEST_PARTS_DIR, CorpusManifest, write_part
+from create_reduced_records import record_regex, reduce_record, target_regexes
+from file_utils import Journal, atomic_write, is_temp_file
+from prepare_corpora import TARGET_PATH as PREP_CORPORA_DIR, create_tsv_corpus, load_corpus_settings, load_tsv_index, update_tsv_corpus
+from process_reduced_records import (COMBINED_CODE_ORDER, CORPUS_DIR, DDC_VOCAB, JOURNAL_DIR as PROCESS_JOURNAL_DIR, PREFILTER_DIR, RLR_DIR, STATS_DIR,
+                                     Stats, corpus_file_name, load_ddc_vocab, output_paths, process_content, process_record,
+                                     remove_corpus_document, write_corpus_document)
+from record_index import RECORD_INDEX_PATH, RecordIndex, record_hash, record_identifier
+from record_store import ARROW_FORMAT, JSON_FORMAT, ARROW_SUFFIX, reduced_records_path, load_records, write_records
+
+DELTA_DIR = "../data/base_delta"
+JOURNAL_DIR = "../data/journal/harvest"
+
+LANGS = ["de", "en"]
+
+deleted_regex = re.compile(r"<header[^>]*status=\"deleted\"")
+
+def _processing_settings():
+    """The settings of the last process_reduced_records.py run, which
+    must be the same for all reducedListRecords files. Only the journal
+    markers are read here, the outputs of the files affected by a harvest
+    are checked by _check_processed()."""
+    settings = None
+    marker_names = [name for name in os.listdir(PROCESS_JOURNAL_DIR) if not is_temp_file(name)] if os.path.isdir(PROCESS_JOURNAL_DIR) else []
+    for name in marker_names:
+        with open(join(PROCESS_JOURNAL_DIR, name), encoding="utf-8") as f:
+            marker_settings = json.load(f)["settings"]
+        if settings is not None and marker_settings != settings:
+            print("Error: The reducedListRecords files were processed with different settings ({} and {}), re-run process_reduced_records.py first".format(settings, marker_settings))
+            sys.exit()
+        settings = marker_settings
+    if settings is None:
+        print("Error: No processed reducedListRecords found in the journal ({}), run process_reduced_records.py first".format(PROCESS_JOURNAL_DIR))
+        sys.exit()
+    if settings.get("combined_code_order") != COMBINED_CODE_ORDER:
+        print("Error: The reducedListRecords files were processed by an older version with unsorted combined DDC codes, re-run process_reduced_records.py first")
+        sys.exit()
+    if settings["sample_rate"] is not None:
+        print("Error: Stats generated from a sample (-x) can not be updated incrementally, re-run process_reduced_records.py without -x first")
+        sys.exit()
+    marker_names = set(marker_names)
+    for full_name in sorted(os.listdir(RLR_DIR)):
+        if not is_temp_file(full_name) and full_name + ".done" not in marker_names:
+            print("Error: {} has not been processed (an earlier run was interrupted), run process_reduced_records.py first".format(full_name))
+            sys.exit()
+    return settings
+
+def _check_processed(file_names, settings):
+    """Make sure the reducedListRecords files changed by a harvest and
+    their outputs are complete and match the current settings."""
+    journal = Journal(PROCESS_JOURNAL_DIR)
+    for full_name in file_names:
+        if not journal.is_done(full_name, join(RLR_DIR, full_name), settings, output_paths(full_name.split(".")[1], settings)):
+            print("Error: {} has not been processed with the current settings (an earlier run was interrupted or outputs are missing), run process_reduced_records.py first".format(full_name))
+            sys.exit()
+
+def _read_harvest(path, changes):
+    """Add the records of a harvest file to changes (identifier -> reduced
+    record or None for deleted records), later records replace earlier ones."""
+    with bz2.open(path, mode="rt", encoding="utf-8") as f:
+        content = f.read()
+    for record in record_regex.findall(content):
+        identifiers = target_regexes["identifier"].findall(record)
+        if not identifiers:
+            continue
+        if deleted_regex.search(record):
+            changes[identifiers[0]] = None
+        else:
+            changes[identifiers[0]] = reduce_record(record)
+
+def _add_corpus_changes(corpus_changes, entries, change_type):
+    for entry in entries:
+        corpus_changes[entry["lang"]][change_type].add(entry["basename"])
+
+def _update_stats_file(file_number, removed_stats, added_stats):
+    stats = Stats(file_number, STATS_DIR)
+    with open(join(STATS_DIR, "stats." + file_number), encoding="utf-8") as f:
+        stats.stats = json.load(f)
+    try:
+        stats.add_stats(removed_stats.stats, -1)
+    except (KeyError, ValueError):
+        print("Error: stats.{} does not match the reduced records, re-run process_reduced_records.py -o first".format(file_number))
+        sys.exit()
+    stats.add_stats(added_stats.stats, 1)
+    stats.write_stats_file()
+
+def _apply_file_changes(file_name, changed, index, corpus_changes, settings, processing_args):
+    """Replace/remove the changed records of a reducedListRecords file and
+    update its stats, corpus documents and manifest part."""
+    path = join(RLR_DIR, file_name)
+    file_number = file_name.split(".")[1]
+    process_journal = Journal(PROCESS_JOURNAL_DIR)
+    # Without a marker, process_reduced_records.py repairs the file's results if this is interrupted
+    process_journal.unmark(file_name)
+    records = []
+    removed_stats = Stats(file_number, STATS_DIR)
+    added_stats = Stats(file_number, STATS_DIR)
+    for record in load_records(path):
+        identifier = record_identifier(record)
+        if identifier not in changed:
+            records.append(record)
+            continue
+        process_record(record, removed_stats, processing_args, file_number)
+        if changed[identifier] is not None:
+            records.append(changed[identifier])
+    results = []
+    for identifier, record in changed.items():
+        if record is None:
+            continue
+        result = process_record(record, added_stats, processing_args, file_number)
+        if result is not None:
+            results.append(result)
+    if settings["stats"]:
+        _update_stats_file(file_number, removed_stats, added_stats)
+    if settings["corpus"]:
+        part_path = join(MANIFEST_PARTS_DIR, "manifest." + file_number)
+        entries = []
+        if os.path.isfile(part_path):
+            with open(part_path, encoding="utf-8") as f:
+                entries = json.load(f)
+        changed_basenames = set([corpus_file_name(file_number, identifier) for identifier in changed.keys()])
+        old_entries = [entry for entry in entries if entry["basename"] in changed_basenames]
+        for entry in old_entries:
+            remove_corpus_document(entry["lang"], entry["basename"])
+        new_entries = []
+        for lang, candidate in results:
+            os.makedirs(join(CORPUS_DIR, lang), exist_ok=True)
+            new_entries.append(write_corpus_document(lang, file_number, candidate))
+        _add_corpus_changes(corpus_changes, old_entries, "removed")
+        _add_corpus_changes(corpus_changes, new_entries, "added")
+        entries = [entry for entry in entries if entry["basename"] not in changed_basenames] + new_entries
+        write_part(MANIFEST_PARTS_DIR, file_number, entries)
+    write_records(path, records)
+    index.index_file(file_name, records, path)
+    process_journal.mark_done(file_name, path, settings)
+
+def _apply_new_records(records, index, corpus_changes, settings, processing_args):
+    file_numbers = [int(name.split(".")[1]) for name in index.file_names()]
+    file_number = "{:05d}".format(max(file_numbers) + 1 if file_numbers else 0)
+    output_format = JSON_FORMAT
+    if any([name.endswith(ARROW_SUFFIX) for name in index.file_names()]):
+        output_format = ARROW_FORMAT
+    path = reduced_records_path(RLR_DIR, "ListRecords." + file_number, output_format)
+    file_name = os.path.basename(path)
+    print("Writing {} new records to {}...".format(len(records), file_name))
+    write_records(path, records)
+    process_content(records, file_number, processing_args)
+    if settings["corpus"]:
+        with open(join(MANIFEST_PARTS_DIR, "manifest." + file_number), encoding="utf-8") as f:
+            _add_corpus_changes(corpus_changes, json.load(f), "added")
+    index.index_file(file_name, records, path)
+    Journal(PROCESS_JOURNAL_DIR).mark_done(file_name, path, settings)
+
+def _read_corpus_csv(csv_path):
+    with open(csv_path, encoding="utf-8") as csv_file:
+        reader = csv.reader(csv_file)
+        next(reader)
+        return [row[0] for row in reader]
+
+def _write_corpus_csv(csv_path, documents):
+    lines = ["document,annif_class_1,annif_class_2\n"] + [doc + ",,\n" for doc in documents]
+    atomic_write(csv_path, "".join(lines))
+
+def _link_document(lang, corpus_type, doc, remove=False):
+    target_dir = join(PREP_CORPORA_DIR, lang, corpus_type)
+    if not os.path.isdir(target_dir):
+        return
+    for file_ext in [".txt", ".key"]:
+        link_path = join(target_dir, doc + file_ext)
+        if os.path.islink(link_path):
+            os.remove(link_path)
+        if not remove:
+            os.symlink(join("../../../corpus/", lang, doc + file_ext), link_path)
+
+def _prepared_corpus_types(lang):
+    return [corpus_type for corpus_type in ["train", "test"] if os.path.isfile(join(PREP_CORPORA_DIR, lang, corpus_type + "_corpus.csv"))]
+
+def _updatable_languages(args):
+    """Return the languages whose prepared corpora can be updated
+    incrementally, print a note for the others."""
+    langs = []
+    for lang in LANGS:
+        if not _prepared_corpus_types(lang):
+            continue
+        corpus_settings = load_corpus_settings(lang)
+        if corpus_settings is None:
+            reason = "the split settings are unknown (prepared by an older version)"
+        elif corpus_settings["stratified"]:
+            reason = "they have a class-stratified split (-s)"
+        elif corpus_settings["group_duplicates"] or corpus_settings["drop_duplicates"]:
+            reason = "they use duplicate clusters (-u/-x)"
+        else:
+            langs.append(lang)
+            for corpus_type in _prepared_corpus_types(lang):
+                tsv_path = join(PREP_CORPORA_DIR, lang, corpus_type + ".tsv.gz")
+                if os.path.isfile(tsv_path) and load_tsv_index(corpus_type, lang) is None and not args.rebuild_tsv:
+                    print("Error: {} has no chunk index (written by an older version), use -r to rebuild it once".format(tsv_path))
+                    sys.exit()
+            continue
+        print("Note: The prepared '{}' corpora will not be updated, {}. Run prepare_corpora.py (and deduplicate_corpus.py, if used) again after applying the harvest".format(lang, reason))
+    return langs
+
+def _update_prepared_corpora(lang, changes, manifest, args):
+    lang_dir = join(PREP_CORPORA_DIR, lang)
+    test_corpus_ratio = args.test_corpus_ratio
+    if test_corpus_ratio is None:
+        test_corpus_ratio = load_corpus_settings(lang)["test_corpus_ratio"]
+    documents = {}
+    for corpus_type in ["train", "test"]:
+        csv_path = join(lang_dir, corpus_type + "_corpus.csv")
+        if os.path.isfile(csv_path):
+            documents[corpus_type] = _read_corpus_csv(csv_path)
+    if "train" not in documents:
+        return
+    # Documents with the same basename have been updated in place
+    dropped = changes["removed"] - changes["added"]
+    new = changes["added"] - changes["removed"]
+    updated = changes["removed"] & changes["added"]
+    changed_types = set()
+    for corpus_type, docs in documents.items():
+        remaining = []
+        for doc in docs:
+            if doc in dropped:
+                _link_document(lang, corpus_type, doc, remove=True)
+                changed_types.add(corpus_type)
+            else:
+                if doc in updated:
+                    changed_types.add(corpus_type)
+                remaining.append(doc)
+        documents[corpus_type] = remaining
+    json_path = join(lang_dir, "eval_corpus.json")
+    if os.path.isfile(json_path):
+        with open(json_path, encoding="utf-8") as json_file:
+            eval_docs = json.load(json_file)
+        remaining = []
+        for doc_data in eval_docs:
+            if doc_data["document"] in dropped:
+                _link_document(lang, "eval", doc_data["document"], remove=True)
+                continue
+            if doc_data["document"] in updated:
+                entry = manifest.get(lang, doc_data["document"])
+                doc_data["document_keys"] = [DDC_VOCAB[code] for code in entry["codes"]]
+                doc_data["auto_keys"] = [DDC_VOCAB[code] for code in entry["auto_codes"]]
+            remaining.append(doc_data)
+        atomic_write(json_path, json.dumps(remaining, indent=2, sort_keys=True, ensure_ascii=False))
+    for doc in sorted(new):
+        corpus_type = "train"
+        if "test" in documents and random() < test_corpus_ratio:
+            corpus_type = "test"
+        documents[corpus_type].append(doc)
+        _link_document(lang, corpus_type, doc)
+        changed_types.add(corpus_type)
+    for corpus_type in sorted(changed_types):
+        _write_corpus_csv(join(lang_dir, corpus_type + "_corpus.csv"), documents[corpus_type])
+        if not os.path.isfile(join(lang_dir, corpus_type + ".tsv.gz")):
+            continue
+        if not update_tsv_corpus(corpus_type, lang, documents[corpus_type], updated, manifest, args.processes):
+            print("The {} TSV corpus has no matching chunk index, it is written again".format(corpus_type))
+            create_tsv_corpus(corpus_type, lang, documents[corpus_type], manifest, args.processes)
+    msg = "Prepared corpora '{}': {} documents removed, {} added, {} updated"
+    print(msg.format(lang, len(dropped), len(new), len(updated)))
+
+def apply_harvest(harvest_files, args):
+    settings = _processing_settings()
+    langs = _updatable_languages(args) if settings["corpus"] else []
+    processing_args = argparse.Namespace(**settings)
+    load_ddc_vocab()
+    index = RecordIndex(args.index)
+    print("{} reduced records files (re-)indexed".format(index.update(RLR_DIR)))
+    changes = {}
+    for path in harvest_files:
+        _read_harvest(path, changes)
+    file_changes = {}
+    new_records = []
+    unchanged = 0
+    unknown_deletions = 0
+    for identifier, record in changes.items():
+        indexed = index.lookup(identifier)
+        if indexed is None:
+            if record is None:
+                unknown_deletions += 1
+            else:
+                new_records.append(record)
+            continue
+        if record is not None and record_hash(record) == indexed[1]:
+            unchanged += 1
+            continue
+        file_changes.setdefault(indexed[0], {})[identifier] = record
+    num_changed = sum([len([record for record in changed.values() if record is not None]) for changed in file_changes.values()])
+    num_deleted = sum([len([record for record in changed.values() if record is None]) for changed in file_changes.values()])
+    msg = "{} harvested records: {} new, {} updated, {} deleted, {} unchanged, {} deletions of unknown records"
+    print(msg.format(len(changes), len(new_records), num_changed, num_deleted, unchanged, unknown_deletions))
+    _check_processed(sorted(file_changes.keys()), settings)
+    corpus_changes = {lang: {"removed": set(), "added": set()} for lang in LANGS}
+    for file_name in sorted(file_changes.keys()):
+        _apply_file_changes(file_name, file_changes[file_name], index, corpus_changes, settings, processing_args)
+    if new_records:
+        _apply_new_records(new_records, index, corpus_changes, settings, processing_args)
+    index.close()
+    if settings["corpus"]:
+        manifest = CorpusManifest(MANIFEST_PATH)
+        manifest.merge(MANIFEST_PARTS_DIR)
+        for lang in langs:
+            _update_prepared_corpora(lang, corpus_changes[lang], manifest, args)
+        manifest.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--input_dir", default=DELTA_DIR, help="Directory containing the harvested ListRecords files (default: " + DELTA_DIR + ")")
+    parser.add_argument("-t", "--test_corpus_ratio", type=float, help="Ratio of the new documents which go into the test corpus, the remaining ones go into the training corpus. Default: The test corpus ratio of the split (see prepare_corpora.py -t)")
+    parser.add_argument("-p", "--processes", type=int, default=8, help="Number of processes used to write TSV corpus files. Default: 8")
+    parser.add_argument("-x", "--index", default=RECORD_INDEX_PATH, help="Path to the identifier index (default: " + RECORD_INDEX_PATH + ")")
+    parser.add_argument("-r", "--rebuild_tsv", action="store_true", help="Rebuild TSV corpora without chunk index (written by an older version of prepare_corpora.py) completely")
+    parser.add_argument("-o", "--overwrite", action="store_true", help="Apply all harvest files again, even if they have been applied before")
+    args = parser.parse_args()
+
+    if args.test_corpus_ratio is not None and (args.test_corpus_ratio < 0.0 or args.test_corpus_ratio > 1.0):
+        print("Error: test_corpus_ratio must be a float from 0.0 to 1.0")
+        sys.exit()
+    if not os.path.isdir(args.input_dir):
+        print("Error: Harvest directory {} not found".format(args.input_dir))
+        sys.exit()
+    if os.path.isdir(PREFILTER_DIR) and [name for name in os.listdir(PREFILTER_DIR) if not is_temp_file(name)]:
+        print("Error: The reduced records were pre-filtered (create_reduced_records.py -f) and do not contain all records, re-run create_reduced_records.py without -f first")
+        sys.exit()
+    journal = Journal(JOURNAL_DIR)
+    harvest_files = []
+    for full_name in sorted(os.listdir(args.input_dir)):
+        if full_name.split(".")[0] != "ListRecords":
+            continue
+        path = join(args.input_dir, full_name)
+        if args.overwrite or not journal.is_done(full_name, path):
+            harvest_files.append(path)
+    if not harvest_files:
+        print("No new harvest files found in " + args.input_dir)
+        sys.exit()
+    print("Applying {} harvest files...".format(len(harvest_files)))
+    apply_harvest(harvest_files, args)
+    for path in harvest_files:
+        journal.mark_done(os.path.basename(path), path)
+    print("Done!")
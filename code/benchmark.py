@@ -0,0 +1,364 @@
+"""Pipeline benchmark over synthetic BASE dumps.
+
+@author Christoph Broschinski (https://github.com/cbroschinski)
+
+This script generates synthetic ListRecords files (bzip2 compressed,
+structured like the files in data/base_dump) and times the pipeline
+stages on them end to end:
+
+reduce: create_reduced_records.py
+process: process_reduced_records.py -C -S -a -r
+prepare: prepare_corpora.py -D -E -c
+summarize: summarize_stats.py
+
+The generator is seeded and controlled via command line parameters
+(number of records, description length, language mix, DDC field density),
+so results are reproducible. Every combination of scale (-n) and worker
+count (-p) is run in a fresh workspace directory which mirrors the
+repository layout (code, data, analyze), the pipeline scripts are called
+as subprocesses from inside this workspace.
+
+Every stage is timed as a separate subprocess. Its peak memory usage is
+taken from the resource usage reported when the process is reaped
+(os.wait4), which covers the stage process and all worker processes it
+waited for, but no earlier stages. The pipeline scripts report most
+errors on stdout and still exit with status 0, so a stage only counts as
+successful if its exit code is 0, its output contains no error messages
+and the expected output files exist.
+
+Results are written as JSON to BENCHMARK_DIR (or the file given by -o),
+one entry per scale/worker combination, to allow comparisons between
+different versions of the code or different machines.
+"""
+
+import argparse
+import bz2
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from datetime import datetime
+from time import perf_counter
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+DDC_VOCAB_FILE = os.path.join(SCRIPT_DIR, "en_ddc.tsv")
+BENCHMARK_DIR = "../data/benchmark"
+
+STAGES = {
+    "reduce": ["create_reduced_records.py"],
+    "process": ["process_reduced_records.py", "-C", "-S", "-a", "-r"],
+    "prepare": ["prepare_corpora.py", "-D", "-E", "-c"],
+    "summarize": ["summarize_stats.py"]
+}
+
+# Stages which can make use of more than one process
+PARALLEL_STAGES = ["reduce", "process"]
+
+# Output lines of the pipeline scripts which indicate a failure
+ERROR_REGEX = re.compile(r"^(Error|.* could not be processed|processing of .* failed)")
+
+WORD_LISTS = {
+    "en": ["the", "of", "and", "in", "this", "study", "we", "analyze", "data", "results", "show", "that",
+           "model", "is", "for", "with", "are", "paper", "method", "based", "on", "new", "approach",
+           "research", "which", "between", "these", "findings", "suggest", "effects", "were", "used",
+           "analysis", "system", "development", "from", "our", "has", "been", "significant", "however"],
+    "de": ["der", "die", "und", "in", "den", "von", "zu", "das", "mit", "sich", "des", "auf", "für",
+           "ist", "im", "dem", "nicht", "ein", "eine", "als", "auch", "es", "an", "werden", "aus",
+           "wird", "untersuchung", "ergebnisse", "arbeit", "diese", "zeigen", "dass", "durch",
+           "beitrag", "entwicklung", "zwischen", "wurden", "analyse", "forschung", "jedoch"],
+    "other": ["le", "la", "les", "de", "des", "et", "en", "un", "une", "du", "est", "dans", "pour",
+              "que", "qui", "sur", "par", "avec", "cette", "nous", "résultats", "étude", "analyse",
+              "recherche", "entre", "ces", "sont", "ont", "été", "travail", "méthode", "modèle"]
+}
+
+RECORD_TEMPLATE = """<record>
+  <header xmlns="http://www.openarchives.org/OAI/2.0/">
+    <identifier>{identifier}</identifier>
+    <datestamp>2022-05-23T15:13:13Z</datestamp>
+  </header>
+  <metadata xmlns="http://www.openarchives.org/OAI/2.0/" xmlns:base_dc="http://oai.base-search.net/base_dc/" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xmlns:dc="http://purl.org/dc/elements/1.1/">
+    <base_dc:dc xsi:schemaLocation="http://oai.base-search.net/base_dc/ http://oai.base-search.net/base_dc/base_dc.xsd">
+      <base_dc:global_id>{identifier}</base_dc:global_id>
+      <base_dc:collection>ftsynthetic</base_dc:collection>
+{fields}
+    </base_dc:dc>
+  </metadata>
+</record>
+"""
+
+FILE_HEADER = """<?xml version="1.0"?>
+<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xmlns:base_dc="http://oai.base-search.net/base_dc/" xmlns:dc="http://purl.org/dc/elements/1.1/" xsi:schemaLocation="http://www.openarchives.org/OAI/2.0/ http://www.openarchives.org/OAI/2.0/OAI-PMH.xsd">
+  <responseDate>2022-12-24T17:04:13+00:00</responseDate>
+  <request verb="ListRecords">http://oai.base-search.net/oai</request>
+  <ListRecords>
+"""
+
+FILE_FOOTER = """  </ListRecords>
+</OAI-PMH>
+"""
+
+def _load_ddc_codes():
+    codes = []
+    with open(DDC_VOCAB_FILE, encoding="utf-8") as f:
+        for line in f:
+            code = line.split("\t")[0]
+            if len(code) == 3:
+                codes.append(code)
+    return codes
+
+def _parse_language_mix(mix_string):
+    mix = {}
+    for component in mix_string.split(","):
+        lang, weight = component.split(":")
+        if lang not in WORD_LISTS:
+            raise ValueError("Unknown language '{}' in language mix, choose from {}".format(lang, list(WORD_LISTS.keys())))
+        mix[lang] = float(weight)
+    return mix
+
+def _create_description(rng, lang, length):
+    words = []
+    current_length = 0
+    while current_length < length:
+        word = rng.choice(WORD_LISTS[lang])
+        words.append(word)
+        current_length += len(word) + 1
+    return (" ".join(words).capitalize() + ".")[:max(length, 1)]
+
+def create_record(rng, identifier, settings, ddc_codes):
+    fields = []
+    lang = rng.choices(list(settings["language_mix"].keys()), weights=list(settings["language_mix"].values()))[0]
+    title = _create_description(rng, lang, 60)
+    fields.append("<dc:title>{}</dc:title>".format(title))
+    for _ in range(rng.randint(0, 4)):
+        fields.append("<dc:subject>{}</dc:subject>".format(rng.choice(WORD_LISTS[lang])))
+    if rng.random() < settings["subject_ddc_density"]:
+        fields.append("<dc:subject>ddc:{}</dc:subject>".format(rng.choice(ddc_codes)))
+    for _ in range(rng.choices([0, 1, 2], weights=[0.2, 0.7, 0.1])[0]):
+        length = max(0, int(rng.gauss(settings["desc_length"], settings["desc_length"] / 2)))
+        fields.append("<dc:description>{}</dc:description>".format(_create_description(rng, lang, length)))
+    if rng.random() < settings["ddc_density"]:
+        for code in rng.sample(ddc_codes, rng.choices([1, 2], weights=[0.8, 0.2])[0]):
+            fields.append("<base_dc:classcode type=\"ddc\">{}</base_dc:classcode>".format(code))
+    if rng.random() < settings["autoclasscode_density"]:
+        fields.append("<base_dc:autoclasscode type=\"ddc\">{}</base_dc:autoclasscode>".format(rng.choice(ddc_codes)))
+    field_string = "\n".join(["      " + field for field in fields])
+    return RECORD_TEMPLATE.format(identifier=identifier, fields=field_string)
+
+def create_list_records_file(path, file_number, num_records, settings, ddc_codes):
+    rng = random.Random("{}-{}".format(settings["seed"], file_number))
+    with bz2.open(path, "wt", encoding="utf-8") as f:
+        f.write(FILE_HEADER)
+        for record_number in range(num_records):
+            identifier = "ftsynthetic:oai:synthetic.example.org:{}-{}".format(file_number, record_number)
+            f.write(create_record(rng, identifier, settings, ddc_codes))
+        f.write(FILE_FOOTER)
+
+def create_synthetic_dump(dump_dir, num_records, settings):
+    ddc_codes = _load_ddc_codes()
+    os.makedirs(dump_dir, exist_ok=True)
+    num_files = max(1, settings["files"])
+    records_per_file = num_records // num_files
+    for file_number in range(num_files):
+        count = records_per_file
+        if file_number < num_records % num_files:
+            count += 1
+        path = os.path.join(dump_dir, "ListRecords.{:05d}.bz2".format(file_number))
+        create_list_records_file(path, file_number, count, settings, ddc_codes)
+
+def _dir_size(path):
+    size = 0
+    for root, _, files in os.walk(path):
+        for file_name in files:
+            size += os.path.getsize(os.path.join(root, file_name))
+    return size
+
+def _reset_workspace(workspace):
+    for entry in os.listdir(os.path.join(workspace, "data")):
+        path = os.path.join(workspace, "data", entry)
+        if entry == "base_dump":
+            continue
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+    shutil.rmtree(os.path.join(workspace, "analyze"))
+    os.mkdir(os.path.join(workspace, "analyze"))
+
+def _create_workspace(base_dir):
+    workspace = tempfile.mkdtemp(prefix="base_benchmark_", dir=base_dir)
+    for sub_dir in ["code", "data", "analyze"]:
+        os.mkdir(os.path.join(workspace, sub_dir))
+    shutil.copy(DDC_VOCAB_FILE, os.path.join(workspace, "code"))
+    return workspace
+
+def _count_files(path):
+    if not os.path.isdir(path):
+        return 0
+    return len([name for name in os.listdir(path) if not name.startswith(".")])
+
+def _missing_outputs(stage, workspace):
+    """Return a description of the missing outputs of a stage or None."""
+    data_dir = os.path.join(workspace, "data")
+    expected = []
+    if stage == "reduce":
+        num_inputs = _count_files(os.path.join(data_dir, "base_dump"))
+        expected = [(os.path.join(data_dir, "reducedListRecords"), num_inputs)]
+    elif stage == "process":
+        num_inputs = _count_files(os.path.join(data_dir, "reducedListRecords"))
+        expected = [(os.path.join(data_dir, "stats"), num_inputs), (os.path.join(data_dir, "corpus_manifest"), num_inputs)]
+    elif stage == "prepare":
+        for lang in ["de", "en"]:
+            expected.append((os.path.join(data_dir, "prepared_corpora", lang, "train_corpus.csv"), None))
+    elif stage == "summarize":
+        expected = [(os.path.join(workspace, "analyze", "summarized_stats.json"), None)]
+    for path, num_files in expected:
+        if num_files is None:
+            if not os.path.isfile(path):
+                return "{} does not exist".format(path)
+        elif _count_files(path) < num_files:
+            return "{} contains {} of {} expected files".format(path, _count_files(path), num_files)
+    return None
+
+def _stage_error(stage, workspace, returncode, output, error_output):
+    if returncode != 0:
+        return "exit code {}: {}".format(returncode, error_output.strip().split("\n")[-1])
+    error_lines = [line for line in output.split("\n") if ERROR_REGEX.match(line)]
+    if error_lines:
+        return error_lines[0]
+    # Tracebacks of crashed worker processes
+    if "Traceback" in error_output:
+        return error_output.strip().split("\n")[-1]
+    return _missing_outputs(stage, workspace)
+
+def run_stage(stage, workspace, processes):
+    command = [sys.executable, os.path.join(SCRIPT_DIR, STAGES[stage][0])] + STAGES[stage][1:]
+    if stage in PARALLEL_STAGES:
+        command += ["-p", str(processes)]
+    cwd = os.path.join(workspace, "code")
+    with tempfile.TemporaryFile("w+", encoding="utf-8") as out_file, tempfile.TemporaryFile("w+", encoding="utf-8") as err_file:
+        start = perf_counter()
+        process = subprocess.Popen(command, cwd=cwd, stdout=out_file, stderr=err_file)
+        # The rusage of wait4 only covers this stage (the process and all
+        # children it waited for), unlike RUSAGE_CHILDREN of this process
+        _, status, usage = os.wait4(process.pid, 0)
+        duration = perf_counter() - start
+        process.returncode = os.waitstatus_to_exitcode(status)
+        out_file.seek(0)
+        err_file.seek(0)
+        output = out_file.read()
+        error_output = err_file.read()
+    stage_result = {
+        "seconds": round(duration, 4),
+        "returncode": process.returncode,
+        # peak RSS of the largest process of this stage (KiB on Linux)
+        "max_rss_kb": usage.ru_maxrss,
+        "success": True
+    }
+    error = _stage_error(stage, workspace, process.returncode, output, error_output)
+    if error is not None:
+        stage_result["success"] = False
+        stage_result["error"] = error
+    return stage_result
+
+def run_benchmark(args, settings):
+    results = []
+    workspace = _create_workspace(args.workdir)
+    try:
+        for num_records in args.records:
+            dump_dir = os.path.join(workspace, "data", "base_dump")
+            if os.path.isdir(dump_dir):
+                shutil.rmtree(dump_dir)
+            print("Generating synthetic dump with {} records...".format(num_records))
+            start = perf_counter()
+            create_synthetic_dump(dump_dir, num_records, settings)
+            generation_time = perf_counter() - start
+            dump_size = _dir_size(dump_dir)
+            for processes in args.processes:
+                for repetition in range(args.repeat):
+                    _reset_workspace(workspace)
+                    run = {
+                        "records": num_records,
+                        "processes": processes,
+                        "repetition": repetition,
+                        "dump_bytes": dump_size,
+                        "generation_seconds": round(generation_time, 4),
+                        "stages": {}
+                    }
+                    for stage in args.stages:
+                        msg = "Running stage '{}' ({} records, {} processes, repetition {})..."
+                        print(msg.format(stage, num_records, processes, repetition))
+                        stage_result = run_stage(stage, workspace, processes)
+                        run["stages"][stage] = stage_result
+                        if not stage_result["success"]:
+                            msg = "Stage '{}' failed ({}), skipping remaining stages of this run"
+                            print(msg.format(stage, stage_result["error"]))
+                            break
+                        print("took {} seconds".format(stage_result["seconds"]))
+                    run["total_seconds"] = round(sum([s["seconds"] for s in run["stages"].values()]), 4)
+                    results.append(run)
+    finally:
+        if not args.keep:
+            shutil.rmtree(workspace)
+        else:
+            print("Workspace kept at " + workspace)
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--records", type=int, nargs="+", default=[1000, 10000], help="Number of synthetic records, multiple values define the scales to benchmark (default: 1000 10000)")
+    parser.add_argument("-f", "--files", type=int, default=8, help="Number of ListRecords files the records are distributed over (default: 8)")
+    parser.add_argument("-p", "--processes", type=int, nargs="+", default=[1, 2, 4, 8], help="Worker counts to benchmark the parallel stages with (default: 1 2 4 8)")
+    parser.add_argument("-l", "--desc_length", type=int, default=400, help="Mean length of a synthetic description in characters (default: 400)")
+    parser.add_argument("-m", "--language_mix", default="en:0.6,de:0.25,other:0.15", help="Language distribution of the descriptions (default: en:0.6,de:0.25,other:0.15)")
+    parser.add_argument("-d", "--ddc_density", type=float, default=0.3, help="Ratio of records with a classcode field (default: 0.3)")
+    parser.add_argument("-j", "--subject_ddc_density", type=float, default=0.1, help="Ratio of records with DDC information in a subject field (default: 0.1)")
+    parser.add_argument("-u", "--autoclasscode_density", type=float, default=0.5, help="Ratio of records with an autoclasscode field (default: 0.5)")
+    parser.add_argument("-s", "--seed", type=int, default=42, help="Seed for the record generator (default: 42)")
+    parser.add_argument("-r", "--repeat", type=int, default=1, help="Number of repetitions of each run (default: 1)")
+    parser.add_argument("-t", "--stages", nargs="+", choices=list(STAGES.keys()), default=list(STAGES.keys()), help="Pipeline stages to run, in that order (default: all)")
+    parser.add_argument("-w", "--workdir", default=None, help="Directory for the temporary workspaces (default: system temp dir)")
+    parser.add_argument("-k", "--keep", action="store_true", help="Keep the workspace after the benchmark")
+    parser.add_argument("-o", "--output", help="Path of the JSON result file (default: a timestamped file in " + BENCHMARK_DIR + ")")
+    args = parser.parse_args()
+
+    try:
+        language_mix = _parse_language_mix(args.language_mix)
+    except ValueError as ve:
+        print("Error: " + str(ve))
+        sys.exit()
+    settings = {
+        "files": args.files,
+        "desc_length": args.desc_length,
+        "language_mix": language_mix,
+        "ddc_density": args.ddc_density,
+        "subject_ddc_density": args.subject_ddc_density,
+        "autoclasscode_density": args.autoclasscode_density,
+        "seed": args.seed
+    }
+    started = datetime.now().isoformat(timespec="seconds")
+    runs = run_benchmark(args, settings)
+    output = {
+        "started": started,
+        "settings": settings,
+        "stages": args.stages,
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count()
+        },
+        "runs": runs
+    }
+    out_path = args.output
+    if out_path is None:
+        if not os.path.isdir(BENCHMARK_DIR):
+            os.makedirs(BENCHMARK_DIR)
+        out_path = os.path.join(BENCHMARK_DIR, "benchmark_{}.json".format(datetime.now().strftime("%Y%m%d_%H%M%S")))
+    with open(out_path, "w", encoding="utf-8") as f:
+        f.write(json.dumps(output, indent=2, ensure_ascii=False))
+    print("Benchmark results were written to " + out_path)
@@ -0,0 +1,169 @@
+"""Block-parallel bzip2 decompression.
+
+@author Christoph Broschinski (https://github.com/cbroschinski)
+
+A bzip2 stream consists of independently compressed blocks (up to 900k of
+uncompressed data each). Blocks are not byte-aligned, but every block
+starts with a 48 bit magic number (BLOCK_MAGIC) and every stream ends with
+another one (EOS_MAGIC), followed by a combined CRC. This module scans a
+file for these magic numbers at bit level, cuts out every block and wraps
+it into a stream of its own (header + block + end of stream marker with
+the block CRC as combined CRC), so the blocks can be decompressed in
+parallel worker processes. Concatenating the results in order restores
+the original data, including records spanning block edges.
+
+The magic numbers may also occur by chance inside the compressed data.
+In this case the affected blocks cannot be decompressed and
+decompress_file() falls back to sequential decompression. The same
+happens if the file does not end with an end of stream marker: The data
+after the last marker would be lost, the sequential decompression raises
+an EOFError for truncated files.
+
+Called as a script, the parallel result is compared to bz2.open for the
+given files:
+
+python bz2_blocks.py ../data/base_dump/ListRecords.04910.bz2 -p 8
+"""
+
+import argparse
+import bz2
+import mmap
+import os
+import sys
+
+import multiprocessing as mp
+from time import time
+
+BLOCK_MAGIC = 0x314159265359
+EOS_MAGIC = 0x177245385090
+MAGIC_BITS = 48
+CRC_BITS = 32
+STREAM_HEADER = b"BZh9"
+
+def _magic_patterns(magic):
+    """For every bit offset of a magic number inside a byte, return the
+    fully determined bytes and the masks for the partial first/last byte."""
+    patterns = []
+    for shift in range(8):
+        num_bytes = (shift + MAGIC_BITS + 7) // 8
+        trailing = num_bytes * 8 - shift - MAGIC_BITS
+        value = (magic << trailing).to_bytes(num_bytes, "big")
+        first = 1 if shift > 0 else 0
+        last = num_bytes - 1 if trailing > 0 else num_bytes
+        patterns.append({
+            "shift": shift,
+            "value": value,
+            "inner": value[first:last],
+            "first": first,
+            "head_mask": (0xff >> shift) if shift > 0 else None,
+            "tail_mask": (0xff << trailing) & 0xff if trailing > 0 else None
+        })
+    return patterns
+
+def _find_magic(data, magic):
+    positions = []
+    for pattern in _magic_patterns(magic):
+        value = pattern["value"]
+        index = data.find(pattern["inner"])
+        while index != -1:
+            start = index - pattern["first"]
+            end = start + len(value)
+            if start >= 0 and end <= len(data):
+                match = True
+                if pattern["head_mask"] is not None:
+                    match = data[start] & pattern["head_mask"] == value[0] & pattern["head_mask"]
+                if match and pattern["tail_mask"] is not None:
+                    match = data[end - 1] & pattern["tail_mask"] == value[-1] & pattern["tail_mask"]
+                if match:
+                    positions.append(start * 8 + pattern["shift"])
+            index = data.find(pattern["inner"], index + 1)
+    return positions
+
+def find_blocks(path):
+    """Return the blocks of a bzip2 file as (start bit, end bit) tuples.
+    Raises a ValueError if the file does not end with a complete stream."""
+    if os.path.getsize(path) == 0:
+        return []
+    with open(path, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            block_starts = _find_magic(data, BLOCK_MAGIC)
+            stream_ends = _find_magic(data, EOS_MAGIC)
+    # The last stream must end the file (only followed by the combined CRC
+    # and padding), otherwise the blocks after the last marker are missing
+    trailing_bits = os.path.getsize(path) * 8 - max(stream_ends, default=0) - MAGIC_BITS - CRC_BITS
+    if not stream_ends or not 0 <= trailing_bits < 8:
+        raise ValueError("{} does not end with an end of stream marker".format(path))
+    boundaries = sorted(block_starts + stream_ends)
+    block_starts = set(block_starts)
+    blocks = []
+    for index, start in enumerate(boundaries[:-1]):
+        if start in block_starts:
+            blocks.append((start, boundaries[index + 1]))
+    return blocks
+
+def _decompress_block(task):
+    """Decompress one block, None if it cannot be decompressed (f.e. a
+    block cut at a magic number found by chance)."""
+    path, start, end = task
+    byte_start = start // 8
+    byte_end = (end + 7) // 8
+    with open(path, "rb") as f:
+        f.seek(byte_start)
+        chunk = f.read(byte_end - byte_start)
+    num_bits = end - start
+    value = int.from_bytes(chunk, "big") >> (len(chunk) * 8 - (end - byte_start * 8))
+    value &= (1 << num_bits) - 1
+    block_crc = (value >> (num_bits - MAGIC_BITS - CRC_BITS)) & 0xffffffff
+    value = (((value << MAGIC_BITS) | EOS_MAGIC) << CRC_BITS) | block_crc
+    num_bits += MAGIC_BITS + CRC_BITS
+    padding = (8 - num_bits % 8) % 8
+    stream = STREAM_HEADER + (value << padding).to_bytes((num_bits + padding) // 8, "big")
+    try:
+        return bz2.decompress(stream)
+    except (OSError, ValueError):
+        return None
+
+def _decompress_sequential(path, error):
+    print("Block-parallel decompression of {} failed ({}), falling back to sequential decompression".format(path, error))
+    with bz2.open(path, mode="rb") as f:
+        return f.read()
+
+def decompress_file(path, processes):
+    """Decompress a bzip2 file with several processes, the result is
+    identical to bz2.open(path).read()."""
+    try:
+        tasks = [(path, start, end) for start, end in find_blocks(path)]
+    except ValueError as error:
+        return _decompress_sequential(path, error)
+    # Failed blocks are returned as None instead of raising an exception in
+    # the workers: Terminating the pool while tasks are still being handed
+    # out may deadlock
+    with mp.Pool(processes) as pool:
+        blocks = list(pool.imap(_decompress_block, tasks))
+    if None in blocks:
+        return _decompress_sequential(path, "block {} of {} could not be decompressed".format(blocks.index(None) + 1, len(blocks)))
+    return b"".join(blocks)
+
+def verify(path, processes):
+    start = time()
+    with bz2.open(path, mode="rb") as f:
+        expected = f.read()
+    sequential_time = time() - start
+    start = time()
+    result = decompress_file(path, processes)
+    parallel_time = time() - start
+    identical = result == expected
+    msg = "{}: {} blocks, {} bytes, sequential {:.2f}s, parallel ({} processes) {:.2f}s, identical: {}"
+    print(msg.format(path, len(find_blocks(path)), len(expected), sequential_time, processes, parallel_time, identical))
+    return identical
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("files", nargs="+", help="bzip2 files to decompress and compare to bz2.open")
+    parser.add_argument("-p", "--processes", type=int, default=os.cpu_count(), help="Number of worker processes (default: all CPUs)")
+    args = parser.parse_args()
+
+    results = [verify(path, args.processes) for path in args.files]
+    if not all(results):
+        print("Error: Block-parallel decompression differs from bz2.open for at least one file")
+        sys.exit(1)
@@ -13,19 +13,31 @@ has been trained.
 
 Classification results will be written to a CSV file in the
 PREP_CORPORA_DIR (see command line message after finishing).
+
+Suggestions are cached in SUGGESTION_CACHE_PATH (see suggestion_cache.py),
+texts occurring several times in the eval corpus are only sent once.
+Repeated runs only send texts to Annif which have not been classified
+by the current model with the same limit and threshold before.
 """
 import argparse
 import csv
+import hashlib
 import json
+import sys
 from os.path import join
 
 import requests
 
+from suggestion_cache import SuggestionCache, text_hash
+from token_cache import cache_is_current, load_corpus
+
 PREP_CORPORA_DIR = "../data/prepared_corpora"
 DDC_VOCAB_PATH = "en_ddc.tsv"
 
 ANNIF_URL = "http://localhost:5000"
 
+SUGGESTION_CACHE_PATH = "../data/suggestion_cache.db"
+
 def _load_ddc_vocab():
     vocab = {}
     with open(DDC_VOCAB_PATH, encoding="utf-8") as f:
@@ -61,42 +73,87 @@ def _print_stats(results, args):
     msg = "Annif success rate: {}/{} ({}%)"
     print(msg.format(len(annif_correct), len(annif_docs), round(len(annif_correct)*100/len(annif_docs), 2)))
 
+def _model_fingerprint(args):
+    """Identify the current model of the backend by its project info
+    (includes the modification time of the trained model)."""
+    if args.fingerprint:
+        return args.fingerprint
+    res = requests.get(ANNIF_URL + "/v1/projects/" + args.backend)
+    project_info = json.loads(res.text)
+    return hashlib.sha1(json.dumps(project_info, sort_keys=True).encode("utf-8")).hexdigest()
+
+def _request_suggestions(suggest_url, text, args):
+    post_data = {
+        "limit": args.limit,
+        "threshold": args.threshold
+    }
+    post_data["text"] = text
+    res = requests.post(suggest_url, data=post_data)
+    content = json.loads(res.text)
+    return content["results"]
+
 def _eval_corpus(args):
     json_path = join(PREP_CORPORA_DIR, args.corpus_language, "eval_corpus.json")
     results = []
     suggest_url = ANNIF_URL + "/v1/projects/" + args.backend + "/suggest"
     with open(json_path, "r", encoding="utf-8") as json_file:
         json_content = json.load(json_file)
-        docs_to_process = int(len(json_content) * args.percentage)
-        msg = "Starting classification of eval corpus '{}'. Corpus consists of {} documents, {} ({}%) will be processed."
-        msg = msg.format(args.corpus_language, len(json_content), docs_to_process, args.percentage * 100)
-        print(msg)
-        for doc_data in json_content:
-            doc_name = doc_data["document"]
+    docs_to_process = int(len(json_content) * args.percentage)
+    msg = "Starting classification of eval corpus '{}'. Corpus consists of {} documents, {} ({}%) will be processed."
+    msg = msg.format(args.corpus_language, len(json_content), docs_to_process, args.percentage * 100)
+    print(msg)
+    analyzed_texts = None
+    if args.token_cache:
+        if not cache_is_current(args.corpus_language, "eval"):
+            print("Error: The token cache of the '{}' eval corpus is missing or outdated, run token_cache.py -x first".format(args.corpus_language))
+            sys.exit()
+        analyzed_texts = {name: " ".join(tokens) for name, tokens, subjects in load_corpus(args.corpus_language, "eval")}
+        uncached = [doc_data["document"] for doc_data in json_content[:docs_to_process] if doc_data["document"] not in analyzed_texts]
+        if uncached:
+            print("Error: {} documents of the eval corpus (f.e. {}) are not in the token cache, run token_cache.py -o -x first".format(len(uncached), uncached[0]))
+            sys.exit()
+    # Identical texts are only classified once
+    texts = {}
+    doc_hashes = []
+    for doc_data in json_content[:docs_to_process]:
+        doc_name = doc_data["document"]
+        if analyzed_texts is not None:
+            text = analyzed_texts[doc_name]
+        else:
             doc_path = join(PREP_CORPORA_DIR, args.corpus_language, "eval", doc_name + ".txt")
-            text = None
             with open(doc_path, "r", encoding="utf-8") as doc:
                 text = doc.read()
-            post_data = {
-                "limit": args.limit,
-                "threshold": args.threshold
-            }
-            post_data["text"] = text
-            #print(post_data)
-            res = requests.post(suggest_url, data=post_data)
-            content = json.loads(res.text)
-            #print(content)
-            doc_data["annif_keys"] = []
-            for result in content["results"]:
-                doc_data["annif_keys"].append(result["label"])
-            #print(res.text)
-            results.append(doc_data)
-            if len(results) % 100 == 0:
-                msg = "{} documents processed ({}%)"
-                msg = msg.format(len(results), round(len(results)*100/docs_to_process, 2))
-                print(msg)
-            if len(results) >= docs_to_process:
-                break
+        hash_value = text_hash(text)
+        texts[hash_value] = text
+        doc_hashes.append(hash_value)
+    suggestions = {}
+    cache = None
+    if not args.no_cache:
+        cache = SuggestionCache(args.cache)
+        fingerprint = _model_fingerprint(args)
+        suggestions = cache.get_many(args.backend, fingerprint, texts.keys(), args.limit, args.threshold)
+    missing = [hash_value for hash_value in texts.keys() if hash_value not in suggestions]
+    msg = "{} documents, {} unique texts, {} cached suggestions found, {} texts will be sent to Annif"
+    print(msg.format(len(doc_hashes), len(texts), len(suggestions), len(missing)))
+    for count, hash_value in enumerate(missing, 1):
+        suggestions[hash_value] = _request_suggestions(suggest_url, texts[hash_value], args)
+        if cache is not None:
+            cache.put(args.backend, fingerprint, hash_value, args.limit, args.threshold, suggestions[hash_value])
+        if count % 100 == 0:
+            if cache is not None:
+                cache.commit()
+            msg = "{} texts processed ({}%)"
+            msg = msg.format(count, round(count*100/len(missing), 2))
+            print(msg)
+    if cache is not None:
+        cache.close()
+    for doc_data, hash_value in zip(json_content, doc_hashes):
+        doc_data["annif_keys"] = []
+        for result in suggestions[hash_value]:
+            doc_data["annif_keys"].append(result["label"])
+        results.append(doc_data)
+    msg = "Suggestion cache: {} hits, {} misses. {} duplicate texts were deduplicated, {} requests were sent to Annif"
+    print(msg.format(len(texts) - len(missing), len(missing), len(doc_hashes) - len(texts), len(missing)))
     _print_stats(results, args)
     out_file_name = "eval_corpus_classified_{}_{}_{}.csv"
     out_file_name = out_file_name.format(args.backend, args.limit, args.threshold)
@@ -115,6 +172,7 @@ def _eval_corpus(args):
                 line.append(res)
             csv_writer.writerow(line)
     print("Full classification results of this run were written to " + out_csv_path)
+    print("Confidence intervals and significance tests for all runs: python eval_statistics.py -c " + args.corpus_language)
 
 def main():
     parser = argparse.ArgumentParser()
@@ -123,6 +181,10 @@ def main():
     parser.add_argument("-l", "--limit", type=int, default=2, help="The upper limit of suggested classes when querying annif, see the Annif Rest API for more details. Default: 2")
     parser.add_argument("-t", "--threshold", type=float, default=0.5, help="The lower limit of the confidence score required to suggest a class when querying annif, see the Annif Rest API for more details. Default: 0.5")
     parser.add_argument("-p", "--percentage", type=float, default=1.0, help="Percentage of the corpus to classify (default: full corpus (1.0))")
+    parser.add_argument("-s", "--cache", default=SUGGESTION_CACHE_PATH, help="Path to the suggestion cache (default: " + SUGGESTION_CACHE_PATH + ")")
+    parser.add_argument("-n", "--no_cache", action="store_true", help="Do not use the suggestion cache, send all (unique) texts to Annif")
+    parser.add_argument("-k", "--token_cache", action="store_true", help="Send the pre-analyzed texts from the token cache (see token_cache.py). Annif must be running with the projects file of the token cache")
+    parser.add_argument("-f", "--fingerprint", help="Model fingerprint to use for the cache instead of the one derived from the Annif project info")
     args = parser.parse_args()
     _eval_corpus(args)
 
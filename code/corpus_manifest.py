@@ -0,0 +1,204 @@
+"""Metadata manifest of the raw corpora.
+
+@author Christoph Broschinski (https://github.com/cbroschinski)
+
+When process_reduced_records.py creates the raw corpus files (-C), each
+worker also writes a manifest part for its reducedListRecords file to
+PARTS_DIR (manifest.<file number>, JSON). For every corpus document the
+part lists the basename, language, record identifier, description length,
+DDC codes (.key file) and baseclf codes (.autokey file).
+
+The parts are merged into a single SQLite database (MANIFEST_PATH),
+indexed by language and basename. Only parts which have been added or
+changed since the last merge are read again, documents of parts which no
+longer exist are removed. prepare_corpora.py uses the manifest for
+discovery, splitting and the metadata files, so it does not have to list
+the raw corpus directories or open any .key/.autokey files.
+
+Raw corpora created before the manifest was introduced have no parts.
+For them, build_parts() writes the missing parts once by scanning the raw
+corpus directories (prepare_corpora.py does this automatically if the
+manifest contains no documents). The classes are read from the .key and
+.autokey files and mapped back to DDC codes. Class names are not unique,
+like Annif, the last code for a given name is used, which leads to the
+same Annif corpora but may merge some classes in stratified mode. The
+record identifiers can not be restored from the file names and are left
+empty (they are not used by prepare_corpora.py).
+
+Called as a script, the manifest is brought up to date and the number of
+documents per language is printed (with -b, missing parts are built from
+the raw corpus directories first):
+
+python corpus_manifest.py
+"""
+
+import argparse
+import json
+import os
+import sqlite3
+
+from file_utils import atomic_write, is_temp_file
+
+PARTS_DIR = "../data/corpus_manifest"
+MANIFEST_PATH = "../data/corpus_manifest.db"
+RAW_CORPUS_PATH = "../data/corpus"
+DDC_VOCAB_PATH = "en_ddc.tsv"
+LANGS = ["de", "en"]
+
+def manifest_entry(basename, lang, identifier, desc_length, codes, auto_codes):
+    return {
+        "basename": basename,
+        "lang": lang,
+        "identifier": identifier,
+        "desc_length": desc_length,
+        "codes": codes,
+        "auto_codes": auto_codes
+    }
+
+def write_part(parts_dir, file_number, entries):
+    atomic_write(os.path.join(parts_dir, "manifest." + file_number), json.dumps(entries, ensure_ascii=False))
+
+def _load_label_codes(vocab_path):
+    # Maps class names to DDC codes, the last code for a given name is used
+    codes = {}
+    with open(vocab_path, encoding="utf-8") as f:
+        for line in f:
+            components = line.split("\t")
+            codes[components[1].replace("\n", "")] = components[0]
+    return codes
+
+def _read_codes(path, label_codes):
+    if not os.path.isfile(path):
+        return []
+    with open(path, encoding="utf-8") as f:
+        return sorted([label_codes[line.rstrip("\n")] for line in f if line.strip()])
+
+def build_parts(corpus_dir, parts_dir, vocab_path):
+    """Write the missing manifest parts for the documents found in the raw
+    corpus directories, returns the number of written parts."""
+    label_codes = _load_label_codes(vocab_path)
+    entries = {}
+    for lang in LANGS:
+        lang_dir = os.path.join(corpus_dir, lang)
+        if not os.path.isdir(lang_dir):
+            continue
+        for file_name in sorted(os.listdir(lang_dir)):
+            if is_temp_file(file_name) or not file_name.endswith(".txt"):
+                continue
+            basename = file_name[:-len(".txt")]
+            file_number = basename.split(".")[0]
+            with open(os.path.join(lang_dir, file_name), encoding="utf-8") as f:
+                desc_length = len(f.read())
+            codes = _read_codes(os.path.join(lang_dir, basename + ".key"), label_codes)
+            auto_codes = _read_codes(os.path.join(lang_dir, basename + ".autokey"), label_codes)
+            entries.setdefault(file_number, []).append(manifest_entry(basename, lang, None, desc_length, codes, auto_codes))
+    os.makedirs(parts_dir, exist_ok=True)
+    written = 0
+    for file_number in sorted(entries.keys()):
+        if os.path.isfile(os.path.join(parts_dir, "manifest." + file_number)):
+            continue
+        write_part(parts_dir, file_number, entries[file_number])
+        written += 1
+    return written
+
+def _split_codes(value):
+    if not value:
+        return []
+    return value.split(":")
+
+class CorpusManifest(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS documents ("
+            "lang TEXT NOT NULL, "
+            "basename TEXT NOT NULL, "
+            "part TEXT NOT NULL, "
+            "identifier TEXT, "
+            "desc_length INTEGER NOT NULL, "
+            "codes TEXT NOT NULL, "
+            "auto_codes TEXT NOT NULL, "
+            "PRIMARY KEY (lang, basename))"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS documents_part ON documents (part)")
+        # size/mtime of every merged part
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS parts ("
+            "name TEXT PRIMARY KEY, "
+            "size INTEGER NOT NULL, "
+            "mtime REAL NOT NULL)"
+        )
+        self.connection.commit()
+
+    def merge(self, parts_dir):
+        """Merge new or changed parts, returns the number of merged parts."""
+        part_names = []
+        if os.path.isdir(parts_dir):
+            part_names = sorted([name for name in os.listdir(parts_dir) if not is_temp_file(name)])
+        merged_states = {row[0]: (row[1], row[2]) for row in self.connection.execute("SELECT name, size, mtime FROM parts")}
+        merged = 0
+        for name in part_names:
+            path = os.path.join(parts_dir, name)
+            stat = os.stat(path)
+            if merged_states.get(name) == (stat.st_size, stat.st_mtime):
+                continue
+            with open(path, encoding="utf-8") as f:
+                entries = json.load(f)
+            self.connection.execute("DELETE FROM documents WHERE part = ?", (name,))
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO documents VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(entry["lang"], entry["basename"], name, entry["identifier"], entry["desc_length"],
+                  ":".join(entry["codes"]), ":".join(entry["auto_codes"])) for entry in entries]
+            )
+            self.connection.execute("INSERT OR REPLACE INTO parts VALUES (?, ?, ?)", (name, stat.st_size, stat.st_mtime))
+            self.connection.commit()
+            merged += 1
+        for name in set(merged_states.keys()) - set(part_names):
+            self.connection.execute("DELETE FROM documents WHERE part = ?", (name,))
+            self.connection.execute("DELETE FROM parts WHERE name = ?", (name,))
+        self.connection.commit()
+        return merged
+
+    def documents(self, lang):
+        """Yield (basename, codes, auto codes) for all documents of a language."""
+        cursor = self.connection.execute(
+            "SELECT basename, codes, auto_codes FROM documents WHERE lang = ? ORDER BY basename", (lang,)
+        )
+        for basename, codes, auto_codes in cursor:
+            yield basename, _split_codes(codes), _split_codes(auto_codes)
+
+    def get(self, lang, basename):
+        """Return the manifest entry of a document or None."""
+        row = self.connection.execute(
+            "SELECT identifier, desc_length, codes, auto_codes FROM documents WHERE lang = ? AND basename = ?",
+            (lang, basename)
+        ).fetchone()
+        if row is None:
+            return None
+        return manifest_entry(basename, lang, row[0], row[1], _split_codes(row[2]), _split_codes(row[3]))
+
+    def summary(self):
+        return self.connection.execute(
+            "SELECT lang, COUNT(*), SUM(auto_codes != '') FROM documents GROUP BY lang ORDER BY lang"
+        ).fetchall()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-m", "--manifest", default=MANIFEST_PATH, help="Path to the merged manifest (default: " + MANIFEST_PATH + ")")
+    parser.add_argument("-d", "--parts_dir", default=PARTS_DIR, help="Directory of the manifest parts (default: " + PARTS_DIR + ")")
+    parser.add_argument("-b", "--build", action="store_true", help="Build missing parts from the raw corpus directories in " + RAW_CORPUS_PATH + " (for corpora created before the manifest was introduced)")
+    args = parser.parse_args()
+
+    if args.build:
+        print("{} manifest parts built from the raw corpus directories".format(build_parts(RAW_CORPUS_PATH, args.parts_dir, DDC_VOCAB_PATH)))
+    manifest = CorpusManifest(args.manifest)
+    print("{} manifest parts merged".format(manifest.merge(args.parts_dir)))
+    for lang, count, autokey_count in manifest.summary():
+        print("{}: {} documents, {} classified by baseclf".format(lang, count, autokey_count))
+    manifest.close()
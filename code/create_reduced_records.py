@@ -7,10 +7,30 @@ BASE dump (a collection of ListRecord files, compressed with bzip2).
 Its purpose is to decompress the files on-the-fly, extract the DC fields
 which are relevant for the purpose of the master thesis project
 and write them to output files in JSON format ("reduced records").
+
+If only a corpus is needed, the pre-filter mode (-f) drops records right
+after extraction which process_reduced_records.py would reject anyway
+because of a too short description or missing DDC classes. It applies the
+same rules as process_reduced_records.py, so -d and -a must match the
+values used there. The filter settings and the number of dropped records
+per reason are written to PREFILTER_DIR. process_reduced_records.py adds
+these counts to its processing stats (-S), all other stats only cover the
+records which passed the pre-filter.
+
+The reduced records are written as JSON by default. With -F arrow, they
+are written in a memory-mappable columnar format instead (see
+record_store.py), which allows process_reduced_records.py to read only
+the fields a run needs.
+
+Decompression of a single file is sequential, so one oversized ListRecords
+file may determine the total runtime. With -b, files above the given size
+are decompressed block-parallel with all worker processes instead (see
+bz2_blocks.py).
 """
 
 import argparse
 import bz2
+import io
 import json
 import os
 import re
@@ -18,9 +38,18 @@ import re
 from copy import deepcopy
 from math import inf
 import multiprocessing as mp
-from time import sleep
+from time import sleep, time
 
-ddc_regex = re.compile(r">\s*(info:eu-repo/classification/ddc/|ddc:\s*)?\d\d\d\s*<")
+from bz2_blocks import decompress_file
+from ddc_codes import has_classcodes
+from file_utils import Journal, atomic_write
+from record_store import ARROW_FORMAT, JSON_FORMAT, reduced_records_path, write_records
+from work_queue import WorkQueue, default_node_id
+
+# Cheap check on the raw record XML used by the pre-filter: Matches every
+# record for which ddc_codes.has_classcodes could find a DDC code (and some
+# more, f.e. records with autoclasscodes only)
+ddc_regex = re.compile(r">\s*(info:eu-repo/classification/ddc/|ddc:)?\d\d\d", re.IGNORECASE)
 record_regex = re.compile(r"<record>.*?</record>", re.DOTALL)
 
 target_regexes = {
@@ -45,22 +74,75 @@ PROCESS_POOL = []
 CONTENT_WAITING_QUEUE = []
 MAX_PROCESSES = 8
 
+# Input files currently processed (keyed by process name) and
+# failed attempts per input file, failed files are retried up to
+# MAX_ATTEMPTS times
+PROCESS_ITEMS = {}
+FAILED_ATTEMPTS = {}
+RETRY_FILES = []
+MAX_ATTEMPTS = 3
+
+# Queue mode (-q) state: the shared work queue and this node's id
+WORK_QUEUE = None
+NODE_ID = None
+LEASE_RENEWAL_INTERVAL = 60
+
+JOURNAL = None
+FILTER_SETTINGS = None
+OUTPUT_FORMAT = JSON_FORMAT
+# Minimum size (bytes) of input files decompressed block-parallel (-b)
+BLOCK_PARALLEL_MIN_SIZE = None
+
 BASE_DUMP_DIR = "../data/base_dump"
 TARGET_DIR = "../data/reducedListRecords"
+JOURNAL_DIR = "../data/journal/reduce"
+PREFILTER_DIR = "../data/prefilter_stats"
+
+def _prefilter_reason(record, filter_settings):
+    descriptions = target_regexes["description"].findall(record)
+    if len(" ".join(descriptions)) < filter_settings["desc_min_length"]:
+        return "min_length"
+    if not ddc_regex.search(record):
+        return "no_classcodes"
+    classcodes = target_regexes["classcode"].findall(record)
+    subjects = target_regexes["subject"].findall(record)
+    if not has_classcodes(classcodes, subjects, filter_settings["additional_ddc_sources"]):
+        return "no_classcodes"
+    return None
+
+def reduce_record(record):
+    output = deepcopy(output_template)
+    for target, regex in target_regexes.items():
+        match = regex.findall(record)
+        output[target] = list(match)
+    return output
 
-def process_content(content, filename):
+def process_content(content, filename, filter_settings=None, output_format=JSON_FORMAT):
     records = record_regex.findall(content)
     out_content = []
+    filtered = {
+        "min_length": 0,
+        "no_classcodes": 0
+    }
     for record in records:
-        output = deepcopy(output_template)
-        for target, regex in target_regexes.items():
-            match = regex.findall(record)
-            output[target] = list(match)
-        out_content.append(output)
-    path = os.path.join(TARGET_DIR, "Reduced" + filename)
-    out_string = json.dumps(out_content, indent=2, ensure_ascii=False)
-    with open(path, "w", encoding="utf-8") as o:
-        o.write(out_string)
+        if filter_settings is not None:
+            reason = _prefilter_reason(record, filter_settings)
+            if reason is not None:
+                filtered[reason] += 1
+                continue
+        out_content.append(reduce_record(record))
+    prefilter_path = os.path.join(PREFILTER_DIR, "prefilter." + filename.split(".")[1])
+    if filter_settings is not None:
+        prefilter_stats = {"settings": filter_settings, "filtered": filtered}
+        atomic_write(prefilter_path, json.dumps(prefilter_stats, indent=2, sort_keys=True))
+    elif os.path.isfile(prefilter_path):
+        os.remove(prefilter_path)
+    write_records(reduced_records_path(TARGET_DIR, filename, output_format), out_content)
+    other_format = JSON_FORMAT if output_format == ARROW_FORMAT else ARROW_FORMAT
+    other_path = reduced_records_path(TARGET_DIR, filename, other_format)
+    # Remove results of earlier runs in the other format
+    if os.path.isfile(other_path):
+        os.remove(other_path)
 
 def _cleanup_process_pool():
     global PROCESS_POOL
@@ -68,57 +150,190 @@ def _cleanup_process_pool():
     for process in PROCESS_POOL:
         if process.is_alive():
             still_running.append(process)
+        else:
+            _finish_process(process)
     PROCESS_POOL = still_running
 
+def _finish_process(process):
+    full_name = PROCESS_ITEMS.pop(process.name)
+    if process.exitcode == 0:
+        JOURNAL.mark_done(full_name, os.path.join(BASE_DUMP_DIR, full_name), _journal_settings())
+        if WORK_QUEUE is not None:
+            WORK_QUEUE.complete(full_name, NODE_ID)
+        return
+    _record_failure(full_name, "exit code {}".format(process.exitcode))
+
+def _record_failure(full_name, error, permanent=False):
+    print("processing of {} failed: {}".format(full_name, error))
+    if WORK_QUEUE is not None:
+        WORK_QUEUE.fail(full_name, NODE_ID, error, permanent)
+        return
+    FAILED_ATTEMPTS[full_name] = FAILED_ATTEMPTS.get(full_name, 0) + 1
+    if permanent:
+        FAILED_ATTEMPTS[full_name] = MAX_ATTEMPTS
+    if FAILED_ATTEMPTS[full_name] < MAX_ATTEMPTS:
+        RETRY_FILES.append(full_name)
+
 def _start_new_process():
     global CONTENT_WAITING_QUEUE, PROCESS_POOL, MAX_PROCESSES
     if len(PROCESS_POOL) < MAX_PROCESSES:
         data = CONTENT_WAITING_QUEUE.pop()
-        p = mp.Process(target=process_content, args=(data[0], data[1],), name="Process_" + data[1])
+        p = mp.Process(target=process_content, args=(data[0], data[1], FILTER_SETTINGS, OUTPUT_FORMAT), name="Process_" + data[1])
         PROCESS_POOL.append(p)
+        PROCESS_ITEMS[p.name] = data[2]
         p.start()
         number = int(data[1].split(".")[1])
         if number % 10 == 0:
             print("started process " + str(p))
 
+def _journal_settings():
+    return {"prefilter": FILTER_SETTINGS, "format": OUTPUT_FORMAT}
+
+def _output_paths(full_name):
+    file_name = ".".join(full_name.split(".")[:2])
+    paths = [reduced_records_path(TARGET_DIR, file_name, OUTPUT_FORMAT)]
+    if FILTER_SETTINGS is not None:
+        paths.append(os.path.join(PREFILTER_DIR, "prefilter." + file_name.split(".")[1]))
+    return paths
+
+def _list_input_files(args):
+    input_files = []
+    for full_name in sorted(os.listdir(BASE_DUMP_DIR)):
+        components = full_name.split(".")
+        if components[0] != "ListRecords":
+            continue
+        file_number = int(components[1])
+        if args.start > file_number or args.end < file_number:
+            continue
+        if not args.overwrite and JOURNAL.is_done(full_name, os.path.join(BASE_DUMP_DIR, full_name), _journal_settings(), _output_paths(full_name)):
+            continue
+        input_files.append(full_name)
+    return input_files
+
+def _read_input_file(full_name):
+    """Return the decompressed content of a ListRecords file, None on errors."""
+    path = os.path.join(BASE_DUMP_DIR, full_name)
+    try:
+        if BLOCK_PARALLEL_MIN_SIZE is not None and os.path.getsize(path) >= BLOCK_PARALLEL_MIN_SIZE:
+            print("Decompressing {} block-parallel with {} processes...".format(full_name, MAX_PROCESSES))
+            data = decompress_file(path, MAX_PROCESSES)
+            # same newline handling as bz2.open in text mode
+            return io.TextIOWrapper(io.BytesIO(data), encoding="utf-8").read()
+        with bz2.open(path, mode="rt", encoding="utf-8") as f:
+            return f.read()
+    except (OSError, EOFError, ValueError) as e:
+        # A truncated or corrupt file (including invalid UTF-8) fails again
+        # on every attempt, so it is not retried
+        _record_failure(full_name, str(e) + " (Hint: Download the file again)", permanent=True)
+        return None
+
+def _renew_leases(names=()):
+    WORK_QUEUE.renew(list(PROCESS_ITEMS.values()) + list(names), NODE_ID)
+
+def _process_queue(args):
+    already_done = WORK_QUEUE.add_items(_list_input_files(args))
+    if already_done:
+        msg = ("Warning: {} files to process are already marked as done in the queue file {} and will not be processed again. " +
+               "Use a new queue file for every run")
+        print(msg.format(len(already_done), WORK_QUEUE.path))
+    last_renewal = time()
+    while True:
+        _cleanup_process_pool()
+        if len(PROCESS_POOL) < MAX_PROCESSES:
+            full_name = WORK_QUEUE.claim(NODE_ID)
+            if full_name is not None:
+                file_name = ".".join(full_name.split(".")[:2])
+                # The leases of running files must not expire during a
+                # long read (f.e. a large file decompressed with -b)
+                _renew_leases()
+                content = _read_input_file(full_name)
+                _renew_leases([full_name])
+                last_renewal = time()
+                if content is not None:
+                    CONTENT_WAITING_QUEUE.append((content, file_name, full_name))
+                    _start_new_process()
+                continue
+        if not PROCESS_POOL and WORK_QUEUE.unfinished() == 0:
+            break
+        if time() - last_renewal > LEASE_RENEWAL_INTERVAL:
+            _renew_leases()
+            last_renewal = time()
+        sleep(1)
+    summary = WORK_QUEUE.summary()
+    print("Work queue finished: {} files done, {} files failed".format(summary["done"], summary["failed"]))
+
+def _process_files(args):
+    global RETRY_FILES
+    input_files = _list_input_files(args)
+    while input_files:
+        for full_name in input_files:
+            file_name = ".".join(full_name.split(".")[:2])
+            content = _read_input_file(full_name)
+            if content is None:
+                continue
+            CONTENT_WAITING_QUEUE.append((content, file_name, full_name))
+            _cleanup_process_pool()
+            _start_new_process()
+        print("All Files read, processing remaining content...")
+        while len(CONTENT_WAITING_QUEUE) > 0:
+            _cleanup_process_pool()
+            _start_new_process()
+            sleep(0.1)
+        print("Waiting for all processes to finish...")
+        while len(PROCESS_POOL) > 0:
+            _cleanup_process_pool()
+            sleep(0.1)
+        input_files = RETRY_FILES
+        RETRY_FILES = []
+        if input_files:
+            print("Retrying {} failed files...".format(len(input_files)))
+    failed_files = [name for name, attempts in FAILED_ATTEMPTS.items() if attempts >= MAX_ATTEMPTS]
+    if failed_files:
+        print("The following files could not be processed: " + ", ".join(sorted(failed_files)))
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("-p", "--processes", type=int, help="Max number of concurrent processes (Default: " + str(MAX_PROCESSES) + ")")
     parser.add_argument("-s", "--start", type=int, default=0, help="ListRecords start number")
     parser.add_argument("-e", "--end", type=int, default=inf, help="ListRecords end number")
-    parser.add_argument("-o", "--overwrite", action="store_true", help="Overwrite existing result files")
+    parser.add_argument("-o", "--overwrite", action="store_true", help="Overwrite existing result files (per default, only files without a completion entry in the journal are processed)")
+    parser.add_argument("-f", "--prefilter", action="store_true", help="Drop records which are not eligible for the corpus because of a too short description or missing DDC classes (for corpus-only runs)")
+    parser.add_argument("-d", "--desc_min_length", type=int, default=100, help="Pre-filter: Minimum length of a record's description field, must match the value used in process_reduced_records.py (default: 100)")
+    parser.add_argument("-a", "--additional_ddc_sources", action="store_true", help="Pre-filter: Accept DDC classes found in the 'subject' field, must match the setting used in process_reduced_records.py")
+    parser.add_argument("-F", "--format", choices=[JSON_FORMAT, ARROW_FORMAT], default=JSON_FORMAT, help="Output format of the reduced records: JSON or memory-mappable Arrow files, which allow process_reduced_records.py to read only the needed fields (default: json)")
+    parser.add_argument("-b", "--block_parallel", type=float, help="Decompress input files larger than this size (in MB) block-parallel, using all worker processes (default: off)")
+    parser.add_argument("-q", "--queue", help="Path to a shared work queue file. All nodes started with the same queue file claim ListRecords files from it until all files have been processed")
+    parser.add_argument("-n", "--node_id", default=default_node_id(), help="Name of this node in queue mode (default: hostname:pid)")
     args = parser.parse_args()
     if not os.path.isdir(TARGET_DIR):
         os.mkdir(TARGET_DIR)
     if args.processes:
         MAX_PROCESSES = args.processes
+    JOURNAL = Journal(JOURNAL_DIR)
+    OUTPUT_FORMAT = args.format
+    if args.block_parallel is not None:
+        BLOCK_PARALLEL_MIN_SIZE = args.block_parallel * 1024 * 1024
+    if args.prefilter:
+        FILTER_SETTINGS = {
+            "desc_min_length": args.desc_min_length,
+            "additional_ddc_sources": args.additional_ddc_sources
+        }
+        if not os.path.isdir(PREFILTER_DIR):
+            os.mkdir(PREFILTER_DIR)
 
     mp.set_start_method('fork')
-    files = sorted(os.listdir(BASE_DUMP_DIR))
     start_msg = "Processing ListRecords with {} concurrent processes, start index {}, end index {}"
     print(start_msg.format(MAX_PROCESSES, args.start, args.end))
-    for full_name in files:
-        components = full_name.split(".")
-        if components[0] != "ListRecords":
-            continue
-        file_number = int(components[1])
-        file_name = components[0] + "." + components[1]
-        if args.start > file_number or args.end < file_number:
-            continue
-        if not args.overwrite and os.path.isfile(os.path.join(TARGET_DIR, "Reduced" + file_name)):
-            continue
-        with bz2.open(os.path.join(BASE_DUMP_DIR, full_name), mode="rt", encoding="utf-8") as f:
-            content = f.read()
-            CONTENT_WAITING_QUEUE.append((content, file_name))
-            _cleanup_process_pool()
-            _start_new_process()
-    print("All Files read, processing remaining content...")
-    while len(CONTENT_WAITING_QUEUE) > 0:
-        _cleanup_process_pool()
-        _start_new_process()
-        sleep(0.1)
-    print("Waiting for all processes to finish...")
-    while len(PROCESS_POOL) > 0:
-        _cleanup_process_pool()
-        sleep(0.1)
+    print("Output format: " + OUTPUT_FORMAT)
+    if FILTER_SETTINGS is not None:
+        msg = "Pre-filter active: minimum description length {}, DDC classes from subject field: {}"
+        print(msg.format(args.desc_min_length, args.additional_ddc_sources))
+    if args.queue:
+        WORK_QUEUE = WorkQueue(args.queue)
+        NODE_ID = args.node_id
+        print("Queue mode, claiming files from {} as node {}".format(args.queue, NODE_ID))
+        _process_queue(args)
+        WORK_QUEUE.close()
+    else:
+        _process_files(args)
     print("Done!")
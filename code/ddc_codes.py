@@ -0,0 +1,47 @@
+"""DDC code extraction from reduced record fields.
+
+@author Christoph Broschinski (https://github.com/cbroschinski)
+
+Shared by create_reduced_records.py (pre-filter mode) and
+process_reduced_records.py, so both stages apply exactly the same rules
+when deciding whether a record carries DDC information.
+"""
+
+import re
+
+SUBJECT_DDC_REGEX = re.compile(r"\s*(ddc:|info:eu-repo/classification/ddc/)(?P<ddc>\d\d\d)\s*", re.IGNORECASE)
+DDC_REGEX = re.compile(r"\s*(?P<ddc>\d\d\d)\s*")
+
+def extract_subject_classcodes(subjects):
+    ret = []
+    for subject in subjects:
+        match = SUBJECT_DDC_REGEX.match(subject)
+        if match:
+            ret.append(match.group("ddc"))
+    if len(ret) > 1:
+        ret.sort()
+    return ret
+
+def extract_classcodes(classcodes, file_number):
+    ret = []
+    for code in classcodes:
+        match = DDC_REGEX.match(code)
+        if match:
+            ret.append(match.group("ddc"))
+        else:
+            print("invalid classcode in {}: {}".format(file_number, code))
+    if len(ret) > 1:
+        ret.sort()
+    return ret
+
+def has_classcodes(classcodes, subjects, additional_ddc_sources):
+    """Quiet check if extract_classcodes (and extract_subject_classcodes if
+    additional_ddc_sources is set) would find at least one DDC code."""
+    for code in classcodes:
+        if DDC_REGEX.match(code):
+            return True
+    if additional_ddc_sources:
+        for subject in subjects:
+            if SUBJECT_DDC_REGEX.match(subject):
+                return True
+    return False
@@ -0,0 +1,191 @@
+"""Near-duplicate detection for the raw corpora.
+
+@author Christoph Broschinski (https://github.com/cbroschinski)
+
+BASE contains many records sharing the same or nearly the same description
+(mirrored repositories, different versions of a preprint etc.). This script
+works on the raw corpora generated by process_reduced_records.py (-C) and
+finds clusters of such documents:
+
+1) Worker processes normalize the text of each document and compute an
+exact hash as well as a MinHash signature over word shingles.
+
+2) The main process collects the results into a shared index: Documents
+with identical exact hashes are clustered directly, the first document of
+each exact cluster is then inserted into an LSH index (banded MinHash
+signatures). A new document is compared to every cluster in the LSH
+buckets it falls into, represented by the first member of the cluster
+in that bucket, and joined to the cluster if the estimated Jaccard
+similarity reaches the threshold (-t). Only documents which do not join
+a cluster of the bucket become new representatives, so buckets only grow
+with the number of distinct clusters in them and all of them are
+compared.
+
+The clusters (only those with more than one document) are written to
+DEDUP_DIR as JSON (<lang>_clusters.json, used by prepare_corpora.py -u/-x)
+and CSV (<lang>_clusters.csv, one line per document).
+"""
+
+import argparse
+import csv
+import hashlib
+import json
+import os
+import random
+import re
+import sys
+import zlib
+
+from array import array
+from os.path import join
+import multiprocessing as mp
+
+from file_utils import atomic_write, atomic_write_with, is_temp_file
+
+RAW_CORPUS_PATH = "../data/corpus"
+DEDUP_DIR = "../data/dedup"
+
+NUM_PERM = 64
+BANDS = 16
+ROWS = NUM_PERM // BANDS
+SHINGLE_SIZE = 3
+
+MERSENNE_PRIME = (1 << 61) - 1
+_perm_rng = random.Random(4711)
+PERMUTATIONS = [(_perm_rng.randrange(1, MERSENNE_PRIME), _perm_rng.randrange(0, MERSENNE_PRIME)) for _ in range(NUM_PERM)]
+
+TOKEN_REGEX = re.compile(r"\w+")
+
+def normalize_text(text):
+    return " ".join(TOKEN_REGEX.findall(text.lower()))
+
+def _shingle_hashes(tokens):
+    if len(tokens) < SHINGLE_SIZE:
+        shingles = [" ".join(tokens)]
+    else:
+        shingles = [" ".join(tokens[i:i + SHINGLE_SIZE]) for i in range(len(tokens) - SHINGLE_SIZE + 1)]
+    return set([zlib.crc32(shingle.encode("utf-8")) for shingle in shingles])
+
+def minhash_signature(normalized_text):
+    hashes = _shingle_hashes(normalized_text.split(" "))
+    signature = array("I")
+    for a, b in PERMUTATIONS:
+        signature.append(min([(a * h + b) % MERSENNE_PRIME for h in hashes]) & 0xffffffff)
+    return signature
+
+def _analyze_document(path):
+    basename = os.path.splitext(os.path.basename(path))[0]
+    with open(path, encoding="utf-8") as f:
+        normalized = normalize_text(f.read())
+    exact_hash = hashlib.sha1(normalized.encode("utf-8")).hexdigest()
+    return basename, exact_hash, minhash_signature(normalized)
+
+def _estimated_similarity(sig_a, sig_b):
+    matches = 0
+    for a, b in zip(sig_a, sig_b):
+        if a == b:
+            matches += 1
+    return matches / NUM_PERM
+
+class DuplicateIndex(object):
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.parents = {}
+        self.exact_hashes = {}
+        self.signatures = {}
+        self.buckets = {}
+        self.exact_duplicates = 0
+        self.near_duplicates = 0
+
+    def _find(self, basename):
+        root = basename
+        while self.parents[root] != root:
+            root = self.parents[root]
+        while self.parents[basename] != root:
+            self.parents[basename], basename = root, self.parents[basename]
+        return root
+
+    def _union(self, basename_a, basename_b):
+        root_a = self._find(basename_a)
+        root_b = self._find(basename_b)
+        if root_a != root_b:
+            self.parents[max(root_a, root_b)] = min(root_a, root_b)
+
+    def add(self, basename, exact_hash, signature):
+        self.parents[basename] = basename
+        if exact_hash in self.exact_hashes:
+            self._union(basename, self.exact_hashes[exact_hash])
+            self.exact_duplicates += 1
+            return
+        self.exact_hashes[exact_hash] = basename
+        self.signatures[basename] = signature
+        near_duplicate = False
+        for band in range(BANDS):
+            key = (band, tuple(signature[band * ROWS:(band + 1) * ROWS]))
+            # One representative per cluster in this bucket
+            representatives = self.buckets.setdefault(key, [])
+            joined = False
+            for representative in representatives:
+                if self._find(representative) == self._find(basename):
+                    joined = True
+                    continue
+                if _estimated_similarity(signature, self.signatures[representative]) >= self.threshold:
+                    self._union(basename, representative)
+                    near_duplicate = True
+                    joined = True
+            if not joined:
+                representatives.append(basename)
+        if near_duplicate:
+            self.near_duplicates += 1
+
+    def clusters(self):
+        clusters = {}
+        for basename in self.parents:
+            clusters.setdefault(self._find(basename), []).append(basename)
+        return sorted([sorted(members) for members in clusters.values() if len(members) > 1])
+
+def deduplicate(lang, args):
+    raw_corpus_path = join(RAW_CORPUS_PATH, lang)
+    paths = [join(raw_corpus_path, name) for name in sorted(os.listdir(raw_corpus_path)) if name.endswith(".txt") and not is_temp_file(name)]
+    print("Analyzing {} documents in raw corpus '{}' with {} processes...".format(len(paths), lang, args.processes))
+    index = DuplicateIndex(args.threshold)
+    with mp.Pool(args.processes) as pool:
+        for count, result in enumerate(pool.imap(_analyze_document, paths, chunksize=100)):
+            index.add(*result)
+            if count % 10000 == 0:
+                print("{} documents".format(count))
+    clusters = index.clusters()
+    duplicate_docs = sum([len(cluster) - 1 for cluster in clusters])
+    msg = "{} duplicate clusters found in raw corpus '{}', {} documents are duplicates ({} exact, {} near duplicates)"
+    print(msg.format(len(clusters), lang, duplicate_docs, index.exact_duplicates, index.near_duplicates))
+    atomic_write(join(DEDUP_DIR, lang + "_clusters.json"), json.dumps(clusters, indent=2, ensure_ascii=False))
+    def _write_csv(temp_path):
+        with open(temp_path, "w", encoding="utf-8") as csv_file:
+            writer = csv.writer(csv_file)
+            writer.writerow(["cluster", "cluster_size", "document"])
+            for cluster_id, cluster in enumerate(clusters):
+                for basename in cluster:
+                    writer.writerow([cluster_id, len(cluster), basename])
+    atomic_write_with(join(DEDUP_DIR, lang + "_clusters.csv"), _write_csv)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-p", "--processes", type=int, default=8, help="Number of worker processes (default: 8)")
+    parser.add_argument("-t", "--threshold", type=float, default=0.8, help="Minimum estimated Jaccard similarity of two documents to be considered near duplicates (default: 0.8)")
+    parser.add_argument("-D", "--german", action="store_true", help="Deduplicate the german raw corpus")
+    parser.add_argument("-E", "--english", action="store_true", help="Deduplicate the english raw corpus")
+    args = parser.parse_args()
+
+    langs = []
+    if args.german:
+        langs.append("de")
+    if args.english:
+        langs.append("en")
+    if not langs:
+        print("Error: Either the German (-D) or English (-E) raw corpus must be deduplicated (or both)")
+        sys.exit()
+    if not os.path.isdir(DEDUP_DIR):
+        os.makedirs(DEDUP_DIR)
+    for lang in langs:
+        deduplicate(lang, args)
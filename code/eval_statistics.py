@@ -0,0 +1,262 @@
+"""Bootstrap confidence intervals and significance tests for eval results.
+
+@author Christoph Broschinski (https://github.com/cbroschinski)
+
+classify_eval_corpus.py only reports point estimates of how often Annif
+and baseclf match the classes of a document exactly. This script reads
+one or more of its result files (eval_corpus_classified_*.csv) and
+computes for every system (each Annif run and baseclf):
+
+- exact_match: share of all documents classified exactly right
+- success_rate: share of the classified documents classified exactly right
+
+with bootstrap confidence intervals, and for every pair of systems the
+difference of both metrics with a paired bootstrap confidence interval and
+p-value (plus McNemar's test for exact_match).
+
+Per document, the state of a system is encoded as a small integer
+(classified: bit 0, correct: bit 1). Both metrics only depend on the
+number of documents in each state, so resampling the documents of a pair
+of systems is the same as drawing the counts of the 16 joint states from a
+multinomial distribution. All resamples are drawn at once as a NumPy
+array, the runtime depends on the number of resamples, not on the
+corpus size. Resamples can be distributed over several processes (-p).
+
+Only documents contained in all given result files are used. The results
+are printed and written to ANALYZE_DIR (eval_statistics.csv and
+eval_comparisons.csv).
+"""
+
+import argparse
+import csv
+import os
+import sys
+
+from itertools import combinations
+from math import erfc, sqrt
+from os.path import join
+import multiprocessing as mp
+
+import numpy as np
+
+PREP_CORPORA_DIR = "../data/prepared_corpora"
+ANALYZE_DIR = "../analyze"
+
+RESULT_FILE_PREFIX = "eval_corpus_classified_"
+BASECLF = "baseclf"
+METRICS = ["exact_match", "success_rate"]
+
+CLASSIFIED = 1
+CORRECT = 2
+NUM_STATES = 4
+
+def _classes(value):
+    if value == "NA":
+        return []
+    return sorted(value.split(":"))
+
+def _document_state(classes, document_classes):
+    state = 0
+    if classes:
+        state |= CLASSIFIED
+    if classes == document_classes:
+        state |= CORRECT
+    return state
+
+def _system_name(path):
+    name = os.path.basename(path)
+    if name.startswith(RESULT_FILE_PREFIX):
+        name = name[len(RESULT_FILE_PREFIX):]
+    return os.path.splitext(name)[0]
+
+def _read_result_file(path, state_cache):
+    documents = []
+    states = []
+    baseclf_states = []
+    with open(path, encoding="utf-8") as csv_file:
+        reader = csv.reader(csv_file)
+        next(reader)
+        for document, document_classes, baseclf_classes, annif_classes in reader:
+            for classes in [annif_classes, baseclf_classes]:
+                if (classes, document_classes) not in state_cache:
+                    state_cache[(classes, document_classes)] = _document_state(_classes(classes), _classes(document_classes))
+            documents.append(document)
+            states.append(state_cache[(annif_classes, document_classes)])
+            baseclf_states.append(state_cache[(baseclf_classes, document_classes)])
+    return documents, states, baseclf_states
+
+def load_states(paths):
+    """Return the system names and an array (documents x systems) with the
+    state of every system for all documents contained in all files."""
+    # The number of distinct class combinations is small, so the state of
+    # each combination of (suggested classes, document classes) is only
+    # computed once
+    state_cache = {}
+    results = [_read_result_file(path, state_cache) for path in paths]
+    names = [_system_name(path) for path in paths] + [BASECLF]
+    documents = results[0][0]
+    if all([result[0] == documents for result in results[1:]]):
+        # Usual case: All runs classified the same eval corpus
+        columns = [result[1] for result in results] + [results[0][2]]
+        return names, np.array(columns, dtype=np.int8).T
+    common_documents = set(documents)
+    for result in results[1:]:
+        common_documents &= set(result[0])
+    msg = "Warning: The result files contain different documents, only the {} documents contained in all files are used"
+    print(msg.format(len(common_documents)))
+    common_documents = sorted(common_documents)
+    columns = []
+    for result in results:
+        states = dict(zip(result[0], result[1]))
+        columns.append([states[document] for document in common_documents])
+    baseclf = dict(zip(results[0][0], results[0][2]))
+    columns.append([baseclf[document] for document in common_documents])
+    return names, np.array(columns, dtype=np.int8).T
+
+def _metrics(counts, system):
+    """Both metrics of a system (0 or 1 in a pair) from joint state counts
+    (last axis, NUM_STATES ** 2 entries)."""
+    joint_states = np.arange(NUM_STATES ** 2)
+    states = joint_states % NUM_STATES if system == 0 else joint_states // NUM_STATES
+    correct = counts @ ((states & CORRECT) > 0)
+    classified = counts @ ((states & CLASSIFIED) > 0)
+    correct_classified = counts @ ((states & (CORRECT | CLASSIFIED)) == (CORRECT | CLASSIFIED))
+    total = counts.sum(axis=-1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return {
+            "exact_match": correct / total,
+            "success_rate": correct_classified / classified
+        }
+
+def _joint_counts(states_a, states_b):
+    return np.bincount(states_a + NUM_STATES * states_b.astype(np.int64), minlength=NUM_STATES ** 2)
+
+def _resample_counts(counts, resamples, seed):
+    rng = np.random.default_rng(seed)
+    total = counts.sum()
+    return rng.multinomial(total, counts / total, size=resamples)
+
+def bootstrap_counts(counts, resamples, seed, processes=1):
+    """Draw bootstrap resamples of the joint state counts, optionally in
+    several processes (each with an independent random stream)."""
+    if processes <= 1:
+        return _resample_counts(counts, resamples, seed)
+    chunk_sizes = [resamples // processes + (1 if i < resamples % processes else 0) for i in range(processes)]
+    seeds = np.random.SeedSequence(seed).spawn(processes)
+    with mp.Pool(processes) as pool:
+        chunks = pool.starmap(_resample_counts, [(counts, size, chunk_seed) for size, chunk_seed in zip(chunk_sizes, seeds) if size > 0])
+    return np.concatenate(chunks)
+
+def _interval(values, confidence_level):
+    alpha = (1 - confidence_level) / 2
+    lower, upper = np.nanpercentile(values, [alpha * 100, (1 - alpha) * 100])
+    return float(lower), float(upper)
+
+def _bootstrap_p_value(differences):
+    """Two-sided p-value of a zero difference (percentile bootstrap), at
+    least 2 / (resamples + 1)."""
+    differences = differences[~np.isnan(differences)]
+    if len(differences) == 0:
+        return float("nan")
+    tail = min(np.sum(differences <= 0), np.sum(differences >= 0))
+    return float(min(1.0, 2 * (tail + 1) / (len(differences) + 1)))
+
+def _mcnemar_p_value(counts):
+    """McNemar's test (with continuity correction) for exact_match."""
+    joint_states = np.arange(NUM_STATES ** 2)
+    correct_a = (joint_states % NUM_STATES & CORRECT) > 0
+    correct_b = (joint_states // NUM_STATES & CORRECT) > 0
+    only_a = counts[correct_a & ~correct_b].sum()
+    only_b = counts[correct_b & ~correct_a].sum()
+    if only_a + only_b == 0:
+        return 1.0
+    # The continuity correction may not turn a zero difference into a positive one
+    statistic = max(abs(only_a - only_b) - 1, 0) ** 2 / (only_a + only_b)
+    return erfc(sqrt(statistic / 2))
+
+def system_statistics(names, states, args):
+    rows = []
+    for index, name in enumerate(names):
+        counts = _joint_counts(states[:, index], np.zeros(len(states), dtype=np.int8))
+        estimates = _metrics(counts, 0)
+        resampled = _metrics(bootstrap_counts(counts, args.resamples, [args.seed, index], args.processes), 0)
+        for metric in METRICS:
+            lower, upper = _interval(resampled[metric], args.confidence_level)
+            rows.append([name, metric, float(estimates[metric]), lower, upper, len(states)])
+    return rows
+
+def pairwise_comparisons(names, states, args):
+    rows = []
+    for index_a, index_b in combinations(range(len(names)), 2):
+        counts = _joint_counts(states[:, index_a], states[:, index_b])
+        estimates_a = _metrics(counts, 0)
+        estimates_b = _metrics(counts, 1)
+        resampled = bootstrap_counts(counts, args.resamples, [args.seed, len(names), index_a, index_b], args.processes)
+        resampled_a = _metrics(resampled, 0)
+        resampled_b = _metrics(resampled, 1)
+        for metric in METRICS:
+            differences = resampled_a[metric] - resampled_b[metric]
+            lower, upper = _interval(differences, args.confidence_level)
+            p_mcnemar = _mcnemar_p_value(counts) if metric == "exact_match" else "NA"
+            difference = float(estimates_a[metric] - estimates_b[metric])
+            rows.append([names[index_a], names[index_b], metric, difference, lower, upper, _bootstrap_p_value(differences), p_mcnemar])
+    return rows
+
+def _result_files(args):
+    if args.files:
+        return args.files
+    lang_dir = join(PREP_CORPORA_DIR, args.corpus_language)
+    return [join(lang_dir, name) for name in sorted(os.listdir(lang_dir)) if name.startswith(RESULT_FILE_PREFIX) and name.endswith(".csv")]
+
+def _write_csv(path, header, rows):
+    with open(path, "w", encoding="utf-8") as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(header)
+        writer.writerows(rows)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("files", nargs="*", help="Result files of classify_eval_corpus.py (default: all result files of the language selected with -c)")
+    parser.add_argument("-c", "--corpus_language", choices=["de", "en"], help="Use all eval_corpus_classified_*.csv files of this language")
+    parser.add_argument("-b", "--resamples", type=int, default=10000, help="Number of bootstrap resamples (default: 10000)")
+    parser.add_argument("-l", "--confidence_level", type=float, default=0.95, help="Confidence level of the intervals (default: 0.95)")
+    parser.add_argument("-s", "--seed", type=int, default=0, help="Random seed (default: 0)")
+    parser.add_argument("-p", "--processes", type=int, default=1, help="Number of processes drawing the resamples (default: 1)")
+    parser.add_argument("-o", "--output_dir", default=ANALYZE_DIR, help="Directory for the CSV files (default: " + ANALYZE_DIR + ")")
+    args = parser.parse_args()
+
+    if not args.files and not args.corpus_language:
+        print("Error: Either result files or a corpus language (-c) must be given")
+        sys.exit()
+    if not 0.0 < args.confidence_level < 1.0:
+        print("Error: The confidence level must be in the range (0, 1)")
+        sys.exit()
+    if args.resamples < 1:
+        print("Error: The number of resamples must be a positive integer")
+        sys.exit()
+    paths = _result_files(args)
+    if not paths:
+        print("Error: No result files found, run classify_eval_corpus.py first")
+        sys.exit()
+    names, states = load_states(paths)
+    print("{} systems, {} documents, {} resamples\n".format(len(names), len(states), args.resamples))
+    system_rows = system_statistics(names, states, args)
+    interval_name = "{:g}% CI".format(args.confidence_level * 100)
+    for name, metric, estimate, lower, upper, _ in system_rows:
+        print("{} {}: {:.4f} ({} {:.4f} - {:.4f})".format(name, metric, estimate, interval_name, lower, upper))
+    comparison_rows = pairwise_comparisons(names, states, args)
+    if comparison_rows:
+        print("")
+    for name_a, name_b, metric, difference, lower, upper, p_bootstrap, p_mcnemar in comparison_rows:
+        msg = "{} - {} {}: {:+.4f} ({} {:+.4f} - {:+.4f}), p = {:.4g} (bootstrap)"
+        msg = msg.format(name_a, name_b, metric, difference, interval_name, lower, upper, p_bootstrap)
+        if p_mcnemar != "NA":
+            msg += ", {:.4g} (McNemar)".format(p_mcnemar)
+        print(msg)
+    os.makedirs(args.output_dir, exist_ok=True)
+    _write_csv(join(args.output_dir, "eval_statistics.csv"), ["system", "metric", "estimate", "ci_lower", "ci_upper", "documents"], system_rows)
+    _write_csv(join(args.output_dir, "eval_comparisons.csv"), ["system_a", "system_b", "metric", "difference", "ci_lower", "ci_upper", "p_bootstrap", "p_mcnemar"], comparison_rows)
+    print("\nResults written to {} (eval_statistics.csv, eval_comparisons.csv)".format(args.output_dir))
+
+if __name__ == '__main__':
+    main()
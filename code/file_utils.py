@@ -0,0 +1,111 @@
+"""Crash-safe output helpers.
+
+@author Christoph Broschinski (https://github.com/cbroschinski)
+
+Helpers used by the processing scripts to make their outputs survive
+killed processes and to resume interrupted runs:
+
+atomic_write() writes a file to a temporary name in the target directory
+and renames it afterwards, so a file either exists completely or not at
+all. Temporary files start with a dot, listings of the data directories
+ignore them (see is_temp_file()).
+
+Journal keeps one completion marker per input file. A marker is only
+written once all outputs of an input file have been written, it stores
+the processing settings and the size/mtime of the input file, so an
+input file is considered done only if it was processed with the same
+settings, has not changed since and all of its expected outputs (given by
+the caller) still exist.
+
+Inputs may also be directories, like the prepared corpora made of
+symlinks: Their state (see input_state()) is a digest over the names,
+sizes and mtimes of the files in the directory, following symlinks. The
+mtime of the directory itself does not change if a linked file is edited
+in place.
+"""
+
+import hashlib
+import json
+import os
+
+from datetime import datetime
+
+TEMP_SUFFIX = ".tmp"
+
+def is_temp_file(file_name):
+    return file_name.startswith(".")
+
+def atomic_write(path, content, encoding="utf-8"):
+    def _write(temp_path):
+        with open(temp_path, "w", encoding=encoding) as f:
+            f.write(content)
+    atomic_write_with(path, _write)
+
+def atomic_write_with(path, write_function):
+    """Like atomic_write(), for files written by other libraries:
+    write_function is called with the temporary path to write to."""
+    directory, file_name = os.path.split(path)
+    temp_path = os.path.join(directory, "." + file_name + TEMP_SUFFIX + str(os.getpid()))
+    try:
+        write_function(temp_path)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.isfile(temp_path):
+            os.remove(temp_path)
+        raise
+
+def input_state(path):
+    """Size and mtime of a file, for a directory the number of files and a
+    digest over their names, sizes and mtimes (of the symlink targets)."""
+    if not os.path.isdir(path):
+        stat = os.stat(path)
+        return {"size": stat.st_size, "mtime": stat.st_mtime}
+    digest = hashlib.sha1()
+    entries = sorted(os.scandir(path), key=lambda entry: entry.name)
+    for entry in entries:
+        try:
+            stat = entry.stat()
+            state = "{}\t{}\t{}\n".format(entry.name, stat.st_size, stat.st_mtime_ns)
+        except FileNotFoundError:
+            # dangling symlink
+            state = "{}\tmissing\n".format(entry.name)
+        digest.update(state.encode("utf-8"))
+    return {"files": len(entries), "digest": digest.hexdigest()}
+
+class Journal(object):
+
+    def __init__(self, journal_dir):
+        self.journal_dir = journal_dir
+        os.makedirs(journal_dir, exist_ok=True)
+
+    def _marker_path(self, item):
+        return os.path.join(self.journal_dir, item + ".done")
+
+    def is_done(self, item, input_path, settings=None, outputs=()):
+        for output_path in outputs:
+            if not os.path.exists(output_path):
+                return False
+        marker_path = self._marker_path(item)
+        if not os.path.isfile(marker_path):
+            return False
+        try:
+            with open(marker_path, encoding="utf-8") as f:
+                marker = json.load(f)
+        except json.decoder.JSONDecodeError:
+            return False
+        if marker.get("settings") != settings:
+            return False
+        return marker.get("input") == input_state(input_path)
+
+    def mark_done(self, item, input_path, settings=None):
+        marker = {
+            "settings": settings,
+            "input": input_state(input_path),
+            "finished": datetime.now().isoformat(timespec="seconds")
+        }
+        atomic_write(self._marker_path(item), json.dumps(marker, indent=2, sort_keys=True))
+
+    def unmark(self, item):
+        marker_path = self._marker_path(item)
+        if os.path.isfile(marker_path):
+            os.remove(marker_path)
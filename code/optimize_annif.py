@@ -0,0 +1,435 @@
+"""Parallel hyperparameter optimization for the Annif projects.
+
+@author Christoph Broschinski (https://github.com/cbroschinski)
+
+This script reads the project definitions from ANNIF_PROJECTS_FILE,
+expands a grid of backend parameters (-g, f. e. -g min_df=1,2,5) for the
+selected projects and trains/evaluates every resulting configuration with
+the annif command line tool. Each configuration becomes its own Annif
+project (the base project id plus a hash of the configuration), all
+projects share one Annif data directory inside CACHE_DIR.
+
+- Configurations are processed by parallel worker processes. The number
+  of workers follows from the CPU and memory budget (-c/-j, -m/-M).
+- Trained models and evaluation results are cached by configuration hash
+  (which includes the training corpus), so repeated runs skip finished
+  work.
+- Every configuration is first trained and evaluated on a random
+  subsample of the test corpus (-s, drawn with the seed -e). Only after
+  all configurations have been evaluated on the subsample, the full
+  evaluation is run for the configurations whose best subsample F1 score
+  reaches a fraction (-x) of the best subsample F1 of the same base
+  project. This way, the stopped configurations only depend on the grid,
+  not on the order in which the workers finish. The subsample is recreated
+  when the test corpus changes (see JOURNAL_DIR).
+
+The evaluation uses 'annif optimize', which sweeps limits and thresholds.
+Results for the selected limits (-l) are written in the schema of
+analyze/annif_optimize/optimization_results.csv (project, limit,
+threshold, precision, recall, f1), the parameters belonging to each
+generated project id are written to a second CSV file (*_configs.csv).
+
+With -k, the pre-analyzed corpora of the token cache (see token_cache.py
+-x) are used for training and evaluation, the analyzer of all projects
+using the cached analyzer is replaced by CACHED_ANALYZER.
+
+Make sure the annif executable (see -a) comes from the Annif
+environment (annif/annif-venv).
+"""
+
+import argparse
+import configparser
+import csv
+import gzip
+import hashlib
+import itertools
+import json
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+
+import multiprocessing as mp
+
+from functools import lru_cache
+from file_utils import Journal, atomic_write, input_state
+from token_cache import CACHED_ANALYZER, TOKEN_CACHE_DIR, project_analyzers
+
+ANNIF_PROJECTS_FILE = "../annif/projects.cfg"
+ANNIF_EXECUTABLE = "../annif/annif-venv/bin/annif"
+CACHE_DIR = "../data/annif_optimize"
+JOURNAL_DIR = "../data/annif_optimize/journal"
+OUTPUT_FILE = "../analyze/annif_optimize/optimization_results_grid.csv"
+
+# Vocabularies as loaded in the README (vocab id: (vocab file, language))
+VOCABS = {
+    "en_ddc": ("en_ddc.tsv", "en"),
+    "en_ddc_for_de": ("en_ddc.tsv", "de")
+}
+
+RESULT_FIELDNAMES = ["project", "limit", "threshold", "precision", "recall", "f1"]
+OPTIMIZE_LINE_REGEX = re.compile(r"^(\d+)\t([\d.]+)\t([\d.]+)\t([\d.]+)\t([\d.]+)$")
+
+def _parse_grid(grid_args):
+    grid = {}
+    for grid_arg in grid_args:
+        if "=" not in grid_arg:
+            raise ValueError("Invalid grid parameter '{}', expected name=value1,value2,...".format(grid_arg))
+        name, values = grid_arg.split("=", 1)
+        grid[name.strip()] = [value.strip() for value in values.split(",")]
+    return grid
+
+def _expand_grid(grid):
+    names = sorted(grid.keys())
+    return [dict(zip(names, values)) for values in itertools.product(*[grid[name] for name in names])]
+
+@lru_cache(maxsize=None)
+def _corpus_state(path):
+    # Identifies a corpus by path and content state (for directories: of
+    # all linked documents, see file_utils.input_state), computed once per
+    # process as it is needed for every configuration
+    return [os.path.abspath(path), input_state(path)]
+
+def _config_hash(section, train_corpus):
+    content = json.dumps({"section": section, "train_corpus": _corpus_state(train_corpus)}, sort_keys=True)
+    return hashlib.sha1(content.encode("utf-8")).hexdigest()[:10]
+
+def create_configurations(projects, args, grid):
+    configurations = []
+    for base_project in args.projects:
+        if base_project not in projects:
+            raise ValueError("Unknown project '{}' (not defined in {})".format(base_project, args.projects_file))
+        lang = projects[base_project]["language"]
+        train_corpus = args.train_corpus.format(lang=lang)
+        for corpus in [train_corpus, args.test_corpus.format(lang=lang)]:
+            if not os.path.exists(corpus):
+                raise ValueError("Corpus {} not found (with -k, run token_cache.py -x first)".format(corpus))
+        for overrides in _expand_grid(grid):
+            section = dict(projects[base_project])
+            section.update(overrides)
+            hash_content = dict(section)
+            if section["backend"] == "nn_ensemble":
+                # ensembles depend on the configuration of their sources
+                for source in section["sources"].split(","):
+                    source_id = source.split(":")[0].strip()
+                    hash_content["source:" + source_id] = json.dumps(projects[source_id], sort_keys=True)
+            project_id = base_project + "-" + _config_hash(hash_content, train_corpus)
+            section["name"] = project_id
+            configurations.append({
+                "project_id": project_id,
+                "base_project": base_project,
+                "overrides": overrides,
+                "section": section,
+                "train_corpus": train_corpus,
+                "test_corpus": args.test_corpus.format(lang=lang),
+                "subsample_corpus": _cache_path(lang + "_test_subsample_{}".format(args.subsample))
+            })
+    return configurations
+
+def _cache_path(*components):
+    return os.path.join(CACHE_DIR, *components)
+
+def _write_projects_file(projects, configurations):
+    config = configparser.ConfigParser(interpolation=None)
+    # original projects are kept, nn_ensemble configurations refer to them as sources
+    for project_id, section in projects.items():
+        config[project_id] = section
+    for configuration in configurations:
+        config[configuration["project_id"]] = configuration["section"]
+    path = _cache_path("projects.cfg")
+    with open(path, "w", encoding="utf-8") as f:
+        config.write(f)
+    return path
+
+def _annif_env():
+    env = dict(os.environ)
+    env["ANNIF_PROJECTS"] = os.path.abspath(_cache_path("projects.cfg"))
+    env["ANNIF_DATADIR"] = os.path.abspath(_cache_path("annif_data"))
+    return env
+
+def _run_annif(args, command):
+    result = subprocess.run([args.annif] + command, env=_annif_env(), stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    if result.returncode != 0:
+        raise RuntimeError("'annif {}' failed: {}".format(" ".join(command), result.stderr.strip().split("\n")[-1]))
+    return result.stdout
+
+def _load_vocabs(args, projects, configurations):
+    vocab_ids = set([projects[c["base_project"]]["vocab"] for c in configurations])
+    for vocab_id in sorted(vocab_ids):
+        if os.path.isdir(_cache_path("annif_data", "vocabs", vocab_id)):
+            continue
+        vocab_file, lang = VOCABS[vocab_id]
+        print("Loading vocabulary {}...".format(vocab_id))
+        _run_annif(args, ["load-vocab", vocab_id, vocab_file, "-L", lang])
+
+def _train_sources(args, projects, configurations):
+    """Train the source projects of nn_ensemble configurations (once, in
+    their original configuration) before the ensembles themselves."""
+    source_ids = set()
+    for configuration in configurations:
+        if configuration["section"]["backend"] == "nn_ensemble":
+            for source in configuration["section"]["sources"].split(","):
+                source_ids.add(source.split(":")[0].strip())
+    for source_id in sorted(source_ids):
+        train_corpus = args.train_corpus.format(lang=projects[source_id]["language"])
+        # the marker identifies the source configuration the model was trained with
+        source_hash = _config_hash(projects[source_id], train_corpus)
+        trained_marker = _cache_path("trained", source_id)
+        if os.path.isfile(trained_marker):
+            with open(trained_marker, encoding="utf-8") as f:
+                if f.read() == source_hash:
+                    continue
+        print("Training ensemble source project {}...".format(source_id))
+        _run_annif(args, ["train", source_id, train_corpus])
+        atomic_write(trained_marker, source_hash)
+
+def _create_subsample(test_corpus, subsample_corpus, size, seed, journal):
+    """Create a test corpus containing a random sample of size documents of
+    a directory or TSV corpus. An existing subsample is only reused if the
+    test corpus, the size and the seed are unchanged."""
+    item = os.path.basename(subsample_corpus)
+    settings = {"test_corpus": os.path.abspath(test_corpus), "size": size, "seed": seed}
+    if journal.is_done(item, test_corpus, settings, outputs=[subsample_corpus]):
+        return
+    journal.unmark(item)
+    if os.path.isdir(subsample_corpus):
+        shutil.rmtree(subsample_corpus)
+    elif os.path.exists(subsample_corpus):
+        os.remove(subsample_corpus)
+    rng = random.Random(seed)
+    if os.path.isdir(test_corpus):
+        os.makedirs(subsample_corpus)
+        txt_files = sorted([name for name in os.listdir(test_corpus) if name.endswith(".txt")])
+        txt_files = sorted(rng.sample(txt_files, min(size, len(txt_files))))
+        for txt_file in txt_files:
+            basename = os.path.splitext(txt_file)[0]
+            for file_ext in [".txt", ".key"]:
+                source = os.path.abspath(os.path.join(test_corpus, basename + file_ext))
+                os.symlink(source, os.path.join(subsample_corpus, basename + file_ext))
+    else:
+        # reservoir sampling, the TSV corpus is only read once
+        sample = []
+        opener = gzip.open if test_corpus.endswith(".gz") else open
+        with opener(test_corpus, "rt", encoding="utf-8") as source:
+            for index, line in enumerate(source):
+                if index < size:
+                    sample.append((index, line))
+                else:
+                    position = rng.randint(0, index)
+                    if position < size:
+                        sample[position] = (index, line)
+        atomic_write(subsample_corpus, "".join([line for _, line in sorted(sample)]))
+    journal.mark_done(item, test_corpus, settings)
+
+def _parse_optimize_output(output, project_id, limits):
+    rows = []
+    for line in output.split("\n"):
+        match = OPTIMIZE_LINE_REGEX.match(line.strip())
+        if match and int(match.group(1)) in limits:
+            rows.append({
+                "project": project_id,
+                "limit": int(match.group(1)),
+                "threshold": float(match.group(2)),
+                "precision": match.group(3),
+                "recall": match.group(4),
+                "f1": match.group(5)
+            })
+    return rows
+
+def _subsample_settings(args):
+    return {"size": args.subsample, "seed": args.seed}
+
+def _cached_result(configuration, args):
+    """Return the cached results of a configuration which are still valid
+    (an empty dict if there are none). The rows of the full evaluation
+    depend on the test corpus and the limits, the subsample F1 score also
+    on the subsample settings."""
+    result_path = _cache_path("results", configuration["project_id"] + ".json")
+    if not os.path.isfile(result_path):
+        return {}
+    with open(result_path, encoding="utf-8") as f:
+        cached = json.load(f)
+    if cached["test_corpus"] != _corpus_state(configuration["test_corpus"]) or cached["limits"] != args.limits:
+        return {}
+    if cached.get("subsample") != _subsample_settings(args):
+        cached["subsample_f1"] = None
+    return cached
+
+def _update_cached_result(configuration, args, **values):
+    cached = _cached_result(configuration, args)
+    if not cached:
+        cached = {"test_corpus": _corpus_state(configuration["test_corpus"]), "limits": args.limits, "subsample_f1": None, "rows": None}
+    cached["subsample"] = _subsample_settings(args)
+    cached.update(values)
+    atomic_write(_cache_path("results", configuration["project_id"] + ".json"), json.dumps(cached, indent=2))
+
+def _train(configuration, args):
+    project_id = configuration["project_id"]
+    trained_marker = _cache_path("trained", project_id)
+    if os.path.isfile(trained_marker):
+        return
+    train_command = ["train", project_id, configuration["train_corpus"]]
+    if args.jobs_per_config > 1:
+        train_command += ["--jobs", str(args.jobs_per_config)]
+    _run_annif(args, train_command)
+    atomic_write(trained_marker, json.dumps(configuration["overrides"]))
+
+def evaluate_subsample(configuration, args):
+    """First phase: Train a configuration and evaluate it on the test
+    subsample. Returns the project id, a status and the best subsample F1
+    score."""
+    project_id = configuration["project_id"]
+    cached = _cached_result(configuration, args)
+    if cached.get("subsample_f1") is not None:
+        return project_id, "cached (subsample F1 {:.4f})".format(cached["subsample_f1"]), cached["subsample_f1"]
+    _train(configuration, args)
+    output = _run_annif(args, ["optimize", project_id, configuration["subsample_corpus"]])
+    rows = _parse_optimize_output(output, project_id, args.limits)
+    subsample_f1 = max([float(row["f1"]) for row in rows] + [0.0])
+    _update_cached_result(configuration, args, subsample_f1=subsample_f1)
+    return project_id, "subsample F1 {:.4f}".format(subsample_f1), subsample_f1
+
+def evaluate_full(configuration, args):
+    """Second phase: Evaluate a configuration on the full test corpus
+    (training it first if the subsample phase was skipped)."""
+    project_id = configuration["project_id"]
+    cached = _cached_result(configuration, args)
+    if cached.get("rows") is not None:
+        return project_id, "cached", cached["rows"]
+    _train(configuration, args)
+    output = _run_annif(args, ["optimize", project_id, configuration["test_corpus"]])
+    rows = _parse_optimize_output(output, project_id, args.limits)
+    _update_cached_result(configuration, args, rows=rows)
+    return project_id, "evaluated", rows
+
+def _run_safe(task):
+    function, configuration, args = task
+    try:
+        return function(configuration, args)
+    except RuntimeError as re_error:
+        return configuration["project_id"], "failed: " + str(re_error), None
+
+def select_configurations(configurations, subsample_f1, args):
+    """Return the configurations to evaluate on the full test corpus: all of
+    them without subsample, otherwise those whose subsample F1 score reaches
+    early_stop_ratio of the best one of their base project. The decision
+    only depends on the scores of the whole grid, not on the order in which
+    they were computed."""
+    if args.subsample == 0:
+        return configurations
+    best_f1 = {}
+    for configuration in configurations:
+        f1 = subsample_f1.get(configuration["project_id"])
+        if f1 is not None:
+            best_f1[configuration["base_project"]] = max(f1, best_f1.get(configuration["base_project"], 0.0))
+    selected = []
+    for configuration in configurations:
+        f1 = subsample_f1.get(configuration["project_id"])
+        if f1 is None:
+            # failed in the first phase
+            continue
+        best = best_f1[configuration["base_project"]]
+        if f1 < best * args.early_stop_ratio:
+            print("{}: stopped early (subsample F1 {:.4f}, best {:.4f})".format(configuration["project_id"], f1, best))
+            continue
+        selected.append(configuration)
+    return selected
+
+def _run_tasks(function, configurations, args, workers):
+    tasks = [(function, configuration, args) for configuration in configurations]
+    with mp.Pool(workers) as pool:
+        for project_id, status, result in pool.imap_unordered(_run_safe, tasks):
+            print("{}: {}".format(project_id, status))
+            if result is not None:
+                yield project_id, result
+
+def _number_of_workers(args):
+    workers = max(1, args.cpus // args.jobs_per_config)
+    if args.memory is not None:
+        workers = min(workers, max(1, int(args.memory // args.memory_per_config)))
+    return workers
+
+def write_results(configurations, results, output_file):
+    with open(output_file, "w", encoding="utf-8") as out:
+        writer = csv.DictWriter(out, fieldnames=RESULT_FIELDNAMES)
+        writer.writeheader()
+        for project_id in sorted(results.keys()):
+            for row in sorted(results[project_id], key=lambda r: (r["limit"], r["threshold"])):
+                writer.writerow(row)
+    configs_file = os.path.splitext(output_file)[0] + "_configs.csv"
+    with open(configs_file, "w", encoding="utf-8") as out:
+        writer = csv.writer(out)
+        writer.writerow(["project", "base_project", "parameters"])
+        for configuration in configurations:
+            writer.writerow([configuration["project_id"], configuration["base_project"], json.dumps(configuration["overrides"], sort_keys=True)])
+    print("Results were written to {} (parameters: {})".format(output_file, configs_file))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("projects", nargs="+", help="Ids of the base projects to optimize (as defined in the projects file)")
+    parser.add_argument("-g", "--grid", action="append", default=[], help="Parameter values to try, f. e. 'min_df=1,2,5'. Can be given multiple times, all combinations are evaluated")
+    parser.add_argument("-r", "--train_corpus", help="Training corpus, {lang} is replaced by the project language (default: ../data/prepared_corpora/{lang}/train, with -k: the pre-analyzed training corpus)")
+    parser.add_argument("-t", "--test_corpus", help="Test corpus, {lang} is replaced by the project language (default: ../data/prepared_corpora/{lang}/test, with -k: the pre-analyzed test corpus)")
+    parser.add_argument("-k", "--token_cache", action="store_true", help="Train and evaluate on the pre-analyzed corpora of the token cache (see token_cache.py -x)")
+    parser.add_argument("-l", "--limits", type=int, nargs="+", default=[2], help="Limits to report results for (default: 2)")
+    parser.add_argument("-s", "--subsample", type=int, default=1000, help="Size of the test corpus subsample used for early stopping, 0 disables early stopping (default: 1000)")
+    parser.add_argument("-x", "--early_stop_ratio", type=float, default=0.9, help="Stop a configuration if its subsample F1 score is below this fraction of the best one of the same base project (default: 0.9)")
+    parser.add_argument("-e", "--seed", type=int, default=0, help="Random seed of the test corpus subsample (default: 0)")
+    parser.add_argument("-c", "--cpus", type=int, default=os.cpu_count(), help="CPU budget (default: all CPUs)")
+    parser.add_argument("-j", "--jobs_per_config", type=int, default=1, help="Parallel jobs used by annif for a single training (default: 1)")
+    parser.add_argument("-M", "--memory", type=float, help="Memory budget in GB (default: no limit)")
+    parser.add_argument("-m", "--memory_per_config", type=float, default=4.0, help="Expected memory usage of a single training in GB (default: 4)")
+    parser.add_argument("-p", "--projects_file", default=ANNIF_PROJECTS_FILE, help="Annif projects file (default: " + ANNIF_PROJECTS_FILE + ")")
+    parser.add_argument("-a", "--annif", default=ANNIF_EXECUTABLE, help="Path to the annif executable (default: " + ANNIF_EXECUTABLE + ")")
+    parser.add_argument("-o", "--output", default=OUTPUT_FILE, help="Result CSV file (default: " + OUTPUT_FILE + ")")
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.annif) and shutil.which(args.annif) is None:
+        print("Error: annif executable not found at {}, use -a to set the correct path".format(args.annif))
+        sys.exit()
+    projects_config = configparser.ConfigParser(interpolation=None)
+    projects_config.read(args.projects_file, encoding="utf-8")
+    projects = {section: dict(projects_config[section]) for section in projects_config.sections()}
+    if args.token_cache:
+        corpus_dir = os.path.join(TOKEN_CACHE_DIR, "{lang}")
+        args.train_corpus = args.train_corpus or os.path.join(corpus_dir, "train.tsv.gz")
+        args.test_corpus = args.test_corpus or os.path.join(corpus_dir, "test.tsv.gz")
+        cached_analyzers = {lang: analyzers.pop() for lang, analyzers in project_analyzers(args.projects_file).items() if len(analyzers) == 1}
+        for section in projects.values():
+            if section.get("analyzer") is not None and section.get("analyzer") == cached_analyzers.get(section["language"]):
+                section["analyzer"] = CACHED_ANALYZER
+    else:
+        args.train_corpus = args.train_corpus or "../data/prepared_corpora/{lang}/train"
+        args.test_corpus = args.test_corpus or "../data/prepared_corpora/{lang}/test"
+    try:
+        configurations = create_configurations(projects, args, _parse_grid(args.grid))
+    except ValueError as ve:
+        print("Error: " + str(ve))
+        sys.exit()
+    for sub_dir in ["results", "trained", "annif_data"]:
+        os.makedirs(_cache_path(sub_dir), exist_ok=True)
+    _write_projects_file(projects, configurations)
+    try:
+        _load_vocabs(args, projects, configurations)
+        _train_sources(args, projects, configurations)
+    except RuntimeError as re_error:
+        print("Error: " + str(re_error))
+        sys.exit()
+    if args.subsample > 0:
+        journal = Journal(JOURNAL_DIR)
+        for configuration in configurations:
+            _create_subsample(configuration["test_corpus"], configuration["subsample_corpus"], args.subsample, args.seed, journal)
+
+    workers = _number_of_workers(args)
+    subsample_f1 = {}
+    if args.subsample > 0:
+        msg = "Evaluating {} configurations on the test subsample with {} parallel workers..."
+        print(msg.format(len(configurations), workers))
+        subsample_f1 = dict(_run_tasks(evaluate_subsample, configurations, args, workers))
+    selected = select_configurations(configurations, subsample_f1, args)
+    msg = "Evaluating {} configurations on the full test corpus with {} parallel workers..."
+    print(msg.format(len(selected), workers))
+    results = {project_id: rows for project_id, rows in _run_tasks(evaluate_full, selected, args, workers) if rows}
+    write_results(configurations, results, args.output)
@@ -24,6 +24,29 @@ backends.
 
 4) Create CSV/JSON files to store document metadata for all 3 corpora.
 
+The documents and their metadata (DDC and baseclf classes) are taken from
+the corpus manifest written by process_reduced_records.py (see
+corpus_manifest.py), which is merged at the start of every run. The raw
+corpus directories are neither listed nor are any .key/.autokey files read.
+Only if the manifest contains no documents of a language (raw corpora
+created before the manifest was introduced), the missing manifest parts
+are built once from the raw corpus directories.
+
+Instead of uniform sampling, a class-stratified split can be created
+(-s): Every document is assigned to the rarest of its DDC classes (by the
+number of documents in the corpus having that class), so documents with
+several classes keep the small classes populated. Each class is then
+split into eval/test/train according to the given ratios.
+With a per-class cap (-m), only a random sample (reservoir sampling in a
+single pass over the manifest) of at most that many of the documents
+assigned to a class is used, which keeps heavily populated classes from
+dominating the training corpus.
+
+If duplicate clusters have been computed by deduplicate_corpus.py, they
+can be used to keep all members of a cluster in the same corpus (-u) or
+to keep only one document per cluster (-x), so duplicates can not leak
+from the training corpus into the test or evaluation corpus.
+
 Per default, the final corpora will be created in language-specific
 directories inside RAW_CORPUS_PATH, so f. e. the English training
 corpus can be found in:
@@ -32,19 +55,48 @@ data/prepared_corpora/en/train
 
 To minimize disk usage, soft links to the raw corpus directory will
 be used instead of copying files.
+
+Alternatively (-f tsv/both), the train and test corpora can be written as
+single gzip compressed Annif TSV corpus files (train.tsv.gz and
+test.tsv.gz in the language directory), which Annif can read sequentially
+instead of opening two files per document.
+
+The split settings of every language are stored in CORPUS_SETTINGS_FILE,
+apply_harvest.py only updates corpora with a plain random split (without
+-s, -u and -x) incrementally. Every chunk of TSV_CHUNK_SIZE
+documents is a separate gzip member, their offsets and documents are
+stored in a chunk index next to the corpus file (*.tsv.index.json), so
+apply_harvest.py can update a TSV corpus by only compressing the chunks
+with changed and new documents again (see update_tsv_corpus()).
 """
 
 import argparse
 import csv
+import gzip
 import json
 import sys
 import os
 
+from collections import deque
 from os.path import join
-from random import sample
+from math import floor
+import multiprocessing as mp
+from random import random, randrange, sample, shuffle
+
+from corpus_manifest import MANIFEST_PATH, PARTS_DIR as MANIFEST_PARTS_DIR, CorpusManifest, build_parts
+from file_utils import TEMP_SUFFIX, atomic_write
 
 RAW_CORPUS_PATH = "../data/corpus"
 TARGET_PATH = "../data/prepared_corpora"
+DEDUP_DIR = "../data/dedup"
+DDC_VOCAB_PATH = "en_ddc.tsv"
+
+DDC_CODES = {}
+DDC_LABELS = {}
+CORPUS_SETTINGS_FILE = "corpus_settings.json"
+TSV_CHUNK_SIZE = 1000
+# Chunks submitted to the pool but not yet written, per process
+TSV_CHUNKS_IN_FLIGHT = 2
 
 HELP_STRINGS = {
     "test_corpus_ratio": "Ratio of the documents which go into the test corpus. Default: 0.1",
@@ -52,19 +104,18 @@ HELP_STRINGS = {
     "clear": "Delete an existing corpus before preparation",
     "german": "Prepare the german corpora",
     "english": "Prepare the english corpora",
-    "non-random": "Do not create an random evaluation corpus, use only documents classfied by baseclf instead"
+    "non-random": "Do not create an random evaluation corpus, use only documents classfied by baseclf instead",
+    "group_duplicates": "Put all documents of a duplicate cluster (see deduplicate_corpus.py) into the same corpus",
+    "drop_duplicates": "Use only the first document of each duplicate cluster (see deduplicate_corpus.py)",
+    "stratified": "Split each DDC class separately according to the corpus ratios. Documents with several classes are assigned to their rarest class",
+    "format": "Output format of the train and test corpora: Directories of soft links to the raw corpus files ('links'), a single gzip compressed Annif TSV corpus file per corpus ('tsv') or both. The eval corpus is always created as links. Default: links",
+    "processes": "Number of processes used to build TSV corpus files. Default: 8",
+    "max_per_class": "Stratified mode: Use at most this many randomly sampled documents per DDC class (for all three corpora together, documents count for their rarest class). Default: no limit"
 }
 
 # We take up to 5 DDC classes contained in the Document for comparison.
 EVAL_CSV_FIELDNAMES = ["document", "doc_class_1", "doc_class_2", "doc_class_3", "doc_class_4", "doc_class_5","annif_class_1", "annif_class_2", "baseclf_class_1", "baseclf_class_2"]
 
-def _extrakt_keys(key_file_path):
-    res = []
-    with open(key_file_path, "r", encoding="utf-8") as key_file:
-        for line in key_file:
-            res.append(line.replace("\n", ""))
-    return res
-
 def _clear_directory(dir_path):
     current_dir = os.getcwd()
     os.chdir(dir_path)
@@ -72,7 +123,7 @@ def _clear_directory(dir_path):
         os.remove(file_name)
     os.chdir(current_dir)
 
-def _create_eval_corpus(lang, documents, clear=False):
+def _create_eval_corpus(lang, documents, manifest, clear=False):
     eval_docs = []
     target_dir = join(TARGET_PATH, lang, "eval")
     if os.path.isdir(target_dir):
@@ -86,14 +137,9 @@ def _create_eval_corpus(lang, documents, clear=False):
     relative_target_path = join("../../../corpus/", lang)
     for doc in documents:
         doc_data = {"document": doc}
-        autokey_path = join(relative_target_path, doc + ".autokey")
-        autokeys = []
-        if os.path.isfile(autokey_path):
-            autokeys = _extrakt_keys(autokey_path)
-        doc_data["auto_keys"] = autokeys
-        doc_key_path = join(relative_target_path, doc + ".key")
-        doc_keys = _extrakt_keys(doc_key_path)
-        doc_data["document_keys"] = doc_keys
+        entry = manifest.get(lang, doc)
+        doc_data["auto_keys"] = [DDC_LABELS[code] for code in entry["auto_codes"]]
+        doc_data["document_keys"] = [DDC_LABELS[code] for code in entry["codes"]]
         for file_ext in [".txt", ".key"]:
             file_name = doc + file_ext
             try:
@@ -107,26 +153,44 @@ def _create_eval_corpus(lang, documents, clear=False):
     with open(json_path, "w", encoding="utf-8") as json_file:
         json_file.write(json.dumps(eval_docs, indent=2, sort_keys=True, ensure_ascii=False))
 
-def _create_annif_corpus(corpus_type, lang, documents, clear=False):
+def _create_annif_corpus(corpus_type, lang, documents, manifest, args):
     if corpus_type not in ["train", "test"]:
         print('Error: Corpus type must be either "train" or "test"')
         sys.exit()
+    csv_path = join(TARGET_PATH, lang, corpus_type + "_corpus.csv")
+    os.makedirs(join(TARGET_PATH, lang), exist_ok=True)
+    with open(csv_path, "w", encoding="utf-8") as csv_file:
+        csv_writer = csv.writer(csv_file)
+        csv_writer.writerow(["document", "annif_class_1", "annif_class_2"])
+        for doc in documents:
+            csv_writer.writerow([doc, "", ""])
     target_dir = join(TARGET_PATH, lang, corpus_type)
+    tsv_path = join(TARGET_PATH, lang, corpus_type + ".tsv.gz")
+    # Remove outputs of earlier runs in the other format, they would not
+    # match the current split
+    if args.format == "tsv" and os.path.isdir(target_dir):
+        print("Deleting old " + corpus_type + " corpus links...")
+        _clear_directory(target_dir)
+        os.rmdir(target_dir)
+    if args.format == "links" and os.path.isfile(tsv_path):
+        print("Deleting old " + corpus_type + " TSV corpus...")
+        os.remove(tsv_path)
+        if os.path.isfile(_tsv_index_path(corpus_type, lang)):
+            os.remove(_tsv_index_path(corpus_type, lang))
+    if args.format in ["tsv", "both"]:
+        create_tsv_corpus(corpus_type, lang, documents, manifest, args.processes)
+    if args.format == "tsv":
+        return
     if os.path.isdir(target_dir):
-        if clear:
+        if args.clear:
             print("Deleting old " + corpus_type + " corpus...")
             _clear_directory(target_dir)
     else:
         os.makedirs(target_dir)
-    csv_path = join(TARGET_PATH, lang, corpus_type + "_corpus.csv")
-    csv_file = open(csv_path, "w", encoding="utf-8")
-    csv_writer = csv.writer(csv_file)
-    csv_writer.writerow(["document", "annif_class_1", "annif_class_2"])
     current_dir = os.getcwd()
     os.chdir(target_dir)
     relative_target_path = join("../../../corpus/", lang)
     for doc in documents:
-        csv_writer.writerow([doc, "", ""])
         for file_ext in [".txt", ".key"]:
             file_name = doc + file_ext
             try:
@@ -135,25 +199,307 @@ def _create_annif_corpus(corpus_type, lang, documents, clear=False):
                 print("Error: " + str(fee) + "\nHint:use -c option to clear old corpora beforehand.")
                 sys.exit()
     os.chdir(current_dir)
-    csv_file.close()
 
-def _create_corpora(lang, args):
-    print("Analyzing raw corpus '{}'...".format(lang))
+def _load_ddc_codes():
+    # Maps class names to DDC codes. Class names are not unique (f.e.
+    # "[Unassigned]"), like Annif we use the last code for a given name.
+    codes = {}
+    with open(DDC_VOCAB_PATH, encoding="utf-8") as f:
+        for line in f:
+            components = line.split("\t")
+            codes[components[1].replace("\n", "")] = components[0]
+    return codes
+
+def _load_ddc_labels():
+    labels = {}
+    with open(DDC_VOCAB_PATH, encoding="utf-8") as f:
+        for line in f:
+            components = line.split("\t")
+            labels[components[0]] = components[1].replace("\n", "")
+    return labels
+
+def _create_tsv_chunk(chunk):
+    # Runs in the pool workers: Only uses the chunk and module constants,
+    # so it works with every start method (the subjects are mapped to
+    # URIs in the parent, see _tsv_chunk())
+    lang, documents = chunk
     raw_corpus_path = join(RAW_CORPUS_PATH, lang)
-    files = os.listdir(raw_corpus_path)
+    lines = []
+    for doc, uris in documents:
+        with open(join(raw_corpus_path, doc + ".txt"), encoding="utf-8") as f:
+            text = f.read().replace("\t", " ").replace("\r", " ").replace("\n", " ")
+        lines.append(text + "\t" + " ".join(uris) + "\n")
+    return gzip.compress("".join(lines).encode("utf-8"))
+
+def _tsv_chunk(lang, documents, manifest):
+    chunk_docs = []
+    for doc in documents:
+        # The subjects are given as labels in the .key files, so they
+        # are mapped back like Annif does (non-unique labels)
+        uris = ["<" + DDC_CODES[DDC_LABELS[code]] + ">" for code in manifest.get(lang, doc)["codes"]]
+        chunk_docs.append((doc, uris))
+    return lang, chunk_docs
+
+def _tsv_chunks(lang, documents, manifest):
+    # A generator, so only the chunks in flight are held in memory
+    for i in range(0, len(documents), TSV_CHUNK_SIZE):
+        chunk_documents = documents[i:i + TSV_CHUNK_SIZE]
+        yield chunk_documents, _tsv_chunk(lang, chunk_documents, manifest)
+
+def _tsv_index_path(corpus_type, lang):
+    return join(TARGET_PATH, lang, corpus_type + ".tsv.index.json")
+
+def load_tsv_index(corpus_type, lang):
+    """Return the chunk index of a TSV corpus, None if there is no index
+    or it does not belong to the current corpus file."""
+    tsv_path = join(TARGET_PATH, lang, corpus_type + ".tsv.gz")
+    index_path = _tsv_index_path(corpus_type, lang)
+    if not os.path.isfile(tsv_path) or not os.path.isfile(index_path):
+        return None
+    with open(index_path, encoding="utf-8") as f:
+        index = json.load(f)
+    if index["size"] != os.path.getsize(tsv_path):
+        return None
+    return index
+
+def _load_ddc_mappings():
+    global DDC_CODES, DDC_LABELS
+    if not DDC_CODES:
+        DDC_CODES = _load_ddc_codes()
+    if not DDC_LABELS:
+        DDC_LABELS = _load_ddc_labels()
+
+def _write_tsv_members(corpus_type, lang, members, processes):
+    """Write the gzip members of a TSV corpus and its chunk index. members
+    yields (documents, source) tuples, source is either the chunk to
+    compress or the (offset, size) of an unchanged member of the existing
+    corpus file, which is copied. Members are produced lazily and at most
+    TSV_CHUNKS_IN_FLIGHT per process are submitted but not yet written,
+    so the memory usage does not depend on the corpus size, even if
+    writing is slower than compressing."""
+    tsv_path = join(TARGET_PATH, lang, corpus_type + ".tsv.gz")
+    temp_path = join(TARGET_PATH, lang, "." + corpus_type + ".tsv.gz" + TEMP_SUFFIX)
+    index_path = _tsv_index_path(corpus_type, lang)
+    max_in_flight = processes * TSV_CHUNKS_IN_FLIGHT
+    pending = deque()
+    chunks = []
+    def _write_next(tsv_file):
+        documents, result = pending.popleft()
+        data = result if isinstance(result, bytes) else result.get()
+        chunks.append({"documents": documents, "offset": tsv_file.tell(), "size": len(data)})
+        tsv_file.write(data)
+    source_file = open(tsv_path, "rb") if os.path.isfile(tsv_path) else None
+    try:
+        with open(temp_path, "wb") as tsv_file, mp.Pool(processes) as pool:
+            for documents, source in members:
+                if isinstance(source[0], int):
+                    source_file.seek(source[0])
+                    pending.append((documents, source_file.read(source[1])))
+                else:
+                    pending.append((documents, pool.apply_async(_create_tsv_chunk, (source,))))
+                if len(pending) >= max_in_flight:
+                    _write_next(tsv_file)
+            while pending:
+                _write_next(tsv_file)
+            size = tsv_file.tell()
+    finally:
+        if source_file is not None:
+            source_file.close()
+    # Without an index, an interrupted run can not leave a mismatching one
+    if os.path.isfile(index_path):
+        os.remove(index_path)
+    os.replace(temp_path, tsv_path)
+    atomic_write(index_path, json.dumps({"size": size, "chunks": chunks}))
+
+def create_tsv_corpus(corpus_type, lang, documents, manifest, processes):
+    """Write documents as a single gzip compressed Annif TSV corpus.
+    Chunks are compressed in parallel as separate gzip members, their
+    concatenation (in document order) is a valid gzip file."""
+    _load_ddc_mappings()
+    print("Writing {} corpus to {}...".format(corpus_type, join(TARGET_PATH, lang, corpus_type + ".tsv.gz")))
+    _write_tsv_members(corpus_type, lang, _tsv_chunks(lang, documents, manifest), processes)
+
+def update_tsv_corpus(corpus_type, lang, documents, updated, manifest, processes):
+    """Update a TSV corpus to documents, which must be the documents of the
+    existing corpus without the removed ones (in the same order), followed
+    by the new ones. Only the chunks containing removed or updated
+    documents are compressed again, unchanged chunks are copied and new
+    documents are appended as new chunks. Returns False if the corpus has
+    no matching chunk index and must be created again."""
+    index = load_tsv_index(corpus_type, lang)
+    if index is None:
+        return False
+    document_set = set(documents)
+    kept = [doc for chunk in index["chunks"] for doc in chunk["documents"] if doc in document_set]
+    if kept != documents[:len(kept)]:
+        return False
+    _load_ddc_mappings()
+    print("Updating {} corpus {}...".format(corpus_type, join(TARGET_PATH, lang, corpus_type + ".tsv.gz")))
+    def _members():
+        for chunk in index["chunks"]:
+            chunk_documents = [doc for doc in chunk["documents"] if doc in document_set]
+            if chunk_documents == chunk["documents"] and not updated.intersection(chunk_documents):
+                yield chunk_documents, (chunk["offset"], chunk["size"])
+            elif chunk_documents:
+                yield chunk_documents, _tsv_chunk(lang, chunk_documents, manifest)
+        yield from _tsv_chunks(lang, documents[len(kept):], manifest)
+    _write_tsv_members(corpus_type, lang, _members(), processes)
+    return True
+
+def _write_corpus_settings(lang, args):
+    settings = ["test_corpus_ratio", "eval_corpus_ratio", "non_random", "group_duplicates",
+                "drop_duplicates", "stratified", "max_per_class", "format"]
+    content = {setting: getattr(args, setting) for setting in settings}
+    atomic_write(join(TARGET_PATH, lang, CORPUS_SETTINGS_FILE), json.dumps(content, indent=2, sort_keys=True))
+
+def load_corpus_settings(lang):
+    """Return the split settings of the prepared corpora of a language
+    (None for corpora prepared before the settings were stored)."""
+    path = join(TARGET_PATH, lang, CORPUS_SETTINGS_FILE)
+    if not os.path.isfile(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+def _load_duplicate_clusters(lang):
+    clusters_path = join(DEDUP_DIR, lang + "_clusters.json")
+    if not os.path.isfile(clusters_path):
+        print("Error: No duplicate clusters found at {}, run deduplicate_corpus.py first".format(clusters_path))
+        sys.exit()
+    with open(clusters_path, encoding="utf-8") as f:
+        clusters = json.load(f)
+    cluster_ids = {}
+    for cluster in clusters:
+        for basename in cluster:
+            cluster_ids[basename] = cluster[0]
+    return cluster_ids
+
+def _sample_documents(candidates, size, cluster_ids, all_basenames):
+    """Sample up to size documents from candidates. If duplicate clusters
+    are given, only whole clusters are sampled: Clusters with members
+    which are not in candidates (f.e. documents without baseclf classes
+    for a non-random eval corpus) and clusters which do not fit into the
+    remaining size are skipped."""
+    if not cluster_ids:
+        return sample(candidates, size)
+    candidate_set = set(candidates)
+    cluster_members = {}
+    for basename in all_basenames:
+        cluster_members.setdefault(cluster_ids.get(basename, basename), []).append(basename)
+    units = list(dict.fromkeys([cluster_ids.get(basename, basename) for basename in candidates]))
+    shuffle(units)
+    docs = []
+    for unit in units:
+        if len(docs) >= size:
+            break
+        members = cluster_members[unit]
+        if len(docs) + len(members) > size:
+            continue
+        if any([member not in candidate_set for member in members]):
+            continue
+        docs += members
+    return docs
+
+class ClassReservoir(object):
+    """Uniform random sample of a stream of documents (Algorithm R)"""
+
+    def __init__(self, capacity=None):
+        self.capacity = capacity
+        self.seen = 0
+        self.items = []
+
+    def add(self, item):
+        self.seen += 1
+        if self.capacity is None or len(self.items) < self.capacity:
+            self.items.append(item)
+            return
+        index = randrange(self.seen)
+        if index < self.capacity:
+            self.items[index] = item
+
+def _stratum_share(stratum_size, ratio):
+    # Randomized rounding: Plain rounding would leave small classes
+    # without any test/eval documents, this keeps the expected overall
+    # corpus sizes at the given ratios.
+    exact = stratum_size * ratio
+    share = floor(exact)
+    if random() < exact - share:
+        share += 1
+    return share
+
+def _create_stratified_corpora(lang, manifest, args):
+    print("Analyzing raw corpus '{}' (stratified)...".format(lang))
+    cluster_ids = {}
+    if args.drop_duplicates:
+        cluster_ids = _load_duplicate_clusters(lang)
+    class_sizes = {}
+    for basename, codes, _ in manifest.documents(lang):
+        if cluster_ids.get(basename, basename) != basename:
+            continue
+        for code in codes:
+            class_sizes[code] = class_sizes.get(code, 0) + 1
+    reservoirs = {}
+    corpus_size = 0
+    for basename, codes, auto_codes in manifest.documents(lang):
+        if cluster_ids.get(basename, basename) != basename:
+            continue
+        stratum = min(codes, key=lambda code: (class_sizes[code], code))
+        has_autokey = len(auto_codes) > 0
+        if stratum not in reservoirs:
+            reservoirs[stratum] = ClassReservoir(args.max_per_class)
+        reservoirs[stratum].add((basename, has_autokey))
+        corpus_size += 1
+    sample_size = sum([len(reservoir.items) for reservoir in reservoirs.values()])
+    msg = "Raw corpus '{}' consists of {} documents in {} classes, {} documents sampled"
+    print(msg.format(lang, corpus_size, len(reservoirs), sample_size))
+    eval_docs = []
+    test_docs = []
+    train_docs = []
+    for stratum in sorted(reservoirs.keys()):
+        items = reservoirs[stratum].items
+        shuffle(items)
+        eval_size = _stratum_share(len(items), args.eval_corpus_ratio)
+        test_size = _stratum_share(len(items), args.test_corpus_ratio)
+        if args.non_random:
+            eval_items = [item for item in items if item[1]][:eval_size]
+        else:
+            eval_items = items[:eval_size]
+        eval_basenames = set([item[0] for item in eval_items])
+        remaining = [item[0] for item in items if item[0] not in eval_basenames]
+        eval_docs += [item[0] for item in eval_items]
+        test_docs += remaining[:test_size]
+        train_docs += remaining[test_size:]
+    if eval_docs:
+        msg = "Creating evaluation corpus with {} documents"
+        print(msg.format(len(eval_docs)))
+        _create_eval_corpus(lang, eval_docs, manifest, args.clear)
+    if test_docs:
+        msg = "Creating test corpus with {} documents"
+        print(msg.format(len(test_docs)))
+        _create_annif_corpus("test", lang, test_docs, manifest, args)
+    msg = "Creating training corpus with {} documents"
+    print(msg.format(len(train_docs)))
+    _create_annif_corpus("train", lang, train_docs, manifest, args)
+
+def _create_corpora(lang, manifest, args):
+    print("Analyzing raw corpus '{}'...".format(lang))
     basenames_no_autokey = []
     basenames_autokey = []
-    for count, filename in enumerate(files):
-        if count % 10000 == 0:
-            print("{} files".format(count))
-        basename = os.path.splitext(filename)[0]
-        autokey_file_path = join(raw_corpus_path, (basename + ".autokey"))
-        if os.path.isfile(autokey_file_path):
-            if basename not in basenames_autokey:
-                basenames_autokey.append(basename)
+    for basename, codes, auto_codes in manifest.documents(lang):
+        if auto_codes:
+            basenames_autokey.append(basename)
         else:
-            if basename not in basenames_no_autokey:
-                basenames_no_autokey.append(basename)
+            basenames_no_autokey.append(basename)
+    cluster_ids = {}
+    if args.group_duplicates or args.drop_duplicates:
+        cluster_ids = _load_duplicate_clusters(lang)
+    if args.drop_duplicates:
+        size_before = len(basenames_no_autokey) + len(basenames_autokey)
+        basenames_autokey = [basename for basename in basenames_autokey if cluster_ids.get(basename, basename) == basename]
+        basenames_no_autokey = [basename for basename in basenames_no_autokey if cluster_ids.get(basename, basename) == basename]
+        cluster_ids = {}
+        msg = "Dropped {} duplicate documents from raw corpus '{}'"
+        print(msg.format(size_before - len(basenames_no_autokey) - len(basenames_autokey), lang))
     corpus_size = len(basenames_no_autokey) + len(basenames_autokey)
     msg = "Raw corpus '{}' consists of {} documents, {} have been classified by baseclf"
     print(msg.format(lang, corpus_size, len(basenames_autokey)))
@@ -162,14 +508,15 @@ def _create_corpora(lang, args):
         len_autokey_before = len(basenames_autokey)
         msg = "Creating evaluation corpus, target size is {} documents ({} %)"
         print(msg.format(eval_corpus_size, round(eval_corpus_size / corpus_size * 100, 2)))
+        full_sample = basenames_no_autokey + basenames_autokey
         if args.non_random:
-            eval_docs = sample(basenames_autokey, eval_corpus_size)
+            eval_docs = _sample_documents(basenames_autokey, eval_corpus_size, cluster_ids, full_sample)
         else:
-            full_sample = basenames_no_autokey + basenames_autokey
-            eval_docs = sample(full_sample, eval_corpus_size)
-        _create_eval_corpus(lang, eval_docs, args.clear)
-        basenames_autokey = [filename for filename in basenames_autokey if filename not in eval_docs]
-        basenames_no_autokey = [filename for filename in basenames_no_autokey if filename not in eval_docs]
+            eval_docs = _sample_documents(full_sample, eval_corpus_size, cluster_ids, full_sample)
+        _create_eval_corpus(lang, eval_docs, manifest, args.clear)
+        eval_docs_set = set(eval_docs)
+        basenames_autokey = [filename for filename in basenames_autokey if filename not in eval_docs_set]
+        basenames_no_autokey = [filename for filename in basenames_no_autokey if filename not in eval_docs_set]
         msg = "{} out of {} documents in the evaluation corpus have been classified by baseclf"
         print(msg.format(len_autokey_before - len(basenames_autokey), len(eval_docs)))
     remaining_basenames = basenames_no_autokey + basenames_autokey
@@ -177,12 +524,13 @@ def _create_corpora(lang, args):
     if test_corpus_size > 0:
         msg = "Creating test corpus, target size is {} documents ({} %)"
         print(msg.format(test_corpus_size, round(test_corpus_size / corpus_size * 100, 2)))
-        test_docs = sample(remaining_basenames, test_corpus_size)
-        _create_annif_corpus("test", lang, test_docs, args.clear)
-        remaining_basenames = [filename for filename in remaining_basenames if filename not in test_docs]
+        test_docs = _sample_documents(remaining_basenames, test_corpus_size, cluster_ids, remaining_basenames)
+        _create_annif_corpus("test", lang, test_docs, manifest, args)
+        test_docs_set = set(test_docs)
+        remaining_basenames = [filename for filename in remaining_basenames if filename not in test_docs_set]
     msg = "Creating training corpus, target size is {} documents"
     print(msg.format(len(remaining_basenames)))
-    _create_annif_corpus("train", lang, remaining_basenames, args.clear)
+    _create_annif_corpus("train", lang, remaining_basenames, manifest, args)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -192,6 +540,12 @@ if __name__ == '__main__':
     parser.add_argument("-n", "--non-random", action="store_true", help=HELP_STRINGS["non-random"])
     parser.add_argument("-D", "--german", action="store_true", help=HELP_STRINGS["german"])
     parser.add_argument("-E", "--english", action="store_true", help=HELP_STRINGS["english"])
+    parser.add_argument("-u", "--group_duplicates", action="store_true", help=HELP_STRINGS["group_duplicates"])
+    parser.add_argument("-x", "--drop_duplicates", action="store_true", help=HELP_STRINGS["drop_duplicates"])
+    parser.add_argument("-f", "--format", choices=["links", "tsv", "both"], default="links", help=HELP_STRINGS["format"])
+    parser.add_argument("-p", "--processes", type=int, default=8, help=HELP_STRINGS["processes"])
+    parser.add_argument("-s", "--stratified", action="store_true", help=HELP_STRINGS["stratified"])
+    parser.add_argument("-m", "--max_per_class", type=int, help=HELP_STRINGS["max_per_class"])
     args = parser.parse_args()
 
     if args.test_corpus_ratio < 0.0 or args.test_corpus_ratio > 1.0:
@@ -203,6 +557,15 @@ if __name__ == '__main__':
     if args.eval_corpus_ratio + args.test_corpus_ratio > 1.0:
         print("Error: The sum of eval_corpus_ratio and test_corpus_ratio may not exceed 1.0")
         sys.exit()
+    if args.max_per_class is not None and not args.stratified:
+        print("Error: A per-class cap (-m) can only be used in stratified mode (-s)")
+        sys.exit()
+    if args.max_per_class is not None and args.max_per_class < 1:
+        print("Error: max_per_class must be a positive integer")
+        sys.exit()
+    if args.stratified and args.group_duplicates:
+        print("Error: Duplicate clusters can not be kept together in stratified mode, use -x to drop duplicates instead")
+        sys.exit()
     langs = []
     if args.german:
         langs.append("de")
@@ -212,5 +575,25 @@ if __name__ == '__main__':
         print("Error: Either a German (-D) or English (-E) corpus must be created (or both)")
         sys.exit()
 
+    DDC_LABELS = _load_ddc_labels()
+    manifest = CorpusManifest(MANIFEST_PATH)
+    merged_parts = manifest.merge(MANIFEST_PARTS_DIR)
+    if merged_parts > 0:
+        print("{} new or changed corpus manifest parts merged".format(merged_parts))
+    manifest_counts = {row[0]: row[1] for row in manifest.summary()}
+    if any([manifest_counts.get(lang, 0) == 0 for lang in langs]):
+        built_parts = build_parts(RAW_CORPUS_PATH, MANIFEST_PARTS_DIR, DDC_VOCAB_PATH)
+        if built_parts > 0:
+            print("{} corpus manifest parts built from the raw corpus directories".format(built_parts))
+            manifest.merge(MANIFEST_PARTS_DIR)
+            manifest_counts = {row[0]: row[1] for row in manifest.summary()}
     for lang in langs:
-        _create_corpora(lang, args)
+        if manifest_counts.get(lang, 0) == 0:
+            print("Error: The corpus manifest contains no '{}' documents. Hint: Create the raw corpus with process_reduced_records.py -C first".format(lang))
+            sys.exit()
+        if args.stratified:
+            _create_stratified_corpora(lang, manifest, args)
+        else:
+            _create_corpora(lang, manifest, args)
+        _write_corpus_settings(lang, args)
+    manifest.close()
@@ -22,35 +22,93 @@ to hold the language-specific raw corpus files, so the default paths are:
 English raw corpus: data/corpus/en
 German raw corpus: data/corpus/de
 
+Every worker also writes a manifest part with the metadata of its corpus
+documents to MANIFEST_PARTS_DIR (see corpus_manifest.py), which is used by
+prepare_corpora.py.
+
+If the reduced records were created in pre-filter mode
+(create_reduced_records.py -f), the pre-filter settings stored in
+PREFILTER_DIR must match the current settings. The pre-filter applies the
+first two checks of process_record, so in -S mode the counts of dropped
+records are added to the "min_length" and "no_classcodes" processing
+stats. All other stat categories only cover the records which passed the
+pre-filter, the counts are also kept in a "prefilter" section.
+
+Reduced records in Arrow format (create_reduced_records.py -F arrow) are
+memory-mapped and only the fields needed by the current settings are
+read: 'identifier' is only needed for corpus generation (-C), 'subject'
+only with -a.
+
+For a quick profile of a dump, stats can be generated from a random sample
+of records (-x, stats mode only). In "uniform" mode every record is
+sampled independently with the given rate, in "file" mode exactly
+rate * (number of records) records are drawn from every file. All
+counters are scaled up to estimates for the whole file, the estimated
+variance of each counter is stored in the "sampling" section of the stats
+file (summarize_stats.py derives confidence intervals from it). The
+description length lists in the "corpus" section only contain the sampled
+records, the corresponding count estimates are stored in the sampling
+section. Records are sampled right after reading a file, so only the
+sampled records are passed to the worker processes. For Arrow files, only
+the memory-mapped pages of the sampled rows are read. JSON files can only
+be parsed as a whole, so for them sampling saves the processing (mostly
+language detection), but not the reading and parsing of the file.
 """
 
 import argparse
 import json
 import os
-import re
+import random
 import sys
 
 from copy import deepcopy
 from math import inf
 import multiprocessing as mp
-from time import sleep
+from time import sleep, time
 
 from polyglot.detect import Detector
 import pycld2
 
+from corpus_manifest import PARTS_DIR as MANIFEST_PARTS_DIR, manifest_entry, write_part
+from ddc_codes import extract_classcodes, extract_subject_classcodes
+from file_utils import Journal, atomic_write, is_temp_file
+from record_store import ARROW_SUFFIX, iter_records, num_records, read_arrow, take_records
+from work_queue import WorkQueue, default_node_id
+
 PROCESS_POOL = []
 CONTENT_WAITING_QUEUE = []
 MAX_PROCESSES = 8
 
+# Input files currently processed (keyed by process name) and
+# failed attempts per input file, failed files are retried up to
+# MAX_ATTEMPTS times
+PROCESS_ITEMS = {}
+FAILED_ATTEMPTS = {}
+RETRY_FILES = []
+MAX_ATTEMPTS = 3
+
+# Queue mode (-q) state: the shared work queue and this node's id
+WORK_QUEUE = None
+NODE_ID = None
+LEASE_RENEWAL_INTERVAL = 60
+
+JOURNAL = None
+
 DDC_VOCAB = {}
 
 DDC_VOCAB_FILE = "en_ddc.tsv"
 RLR_DIR = "../data/reducedListRecords"
 STATS_DIR = "../data/stats"
 CORPUS_DIR = "../data/corpus"
+JOURNAL_DIR = "../data/journal/process"
+PREFILTER_DIR = "../data/prefilter_stats"
+
+SAMPLE_MODES = ["uniform", "file"]
 
-SUBJECT_DDC_REGEX = re.compile(r"\s*(ddc:|info:eu-repo/classification/ddc/)(?P<ddc>\d\d\d)\s*", re.IGNORECASE)
-DDC_REGEX = re.compile(r"\s*(?P<ddc>\d\d\d)\s*")
+# Combined DDC codes used to be joined in set order, which varied between
+# runs. They are sorted now, the version is part of the journal settings,
+# so results of older runs are processed again.
+COMBINED_CODE_ORDER = "sorted"
 
 class Stats(object):
 
@@ -155,7 +213,7 @@ class Stats(object):
             "classcodes": classcodes,
             "subject_classcodes": subject_classcodes,
             "auto_classcodes": auto_classcodes,
-            "combined_classcodes": list(set(classcodes + subject_classcodes))
+            "combined_classcodes": sorted(set(classcodes + subject_classcodes))
         }
         if len(subject_classcodes) > 0 and len(classcodes) == 0:
             code_data["standalone_subject_classcodes"] = subject_classcodes
@@ -172,7 +230,7 @@ class Stats(object):
                 else:
                     self.stats["ddc_data"][code_type]["codes"][code_combo] += 1
         if len(auto_classcodes) > 0:
-            classcodes_combined = list(set(classcodes + subject_classcodes))
+            classcodes_combined = sorted(set(classcodes + subject_classcodes))
             if len(classcodes_combined) > 0:
                 combo_key =  ":".join(classcodes_combined) + "<->" + ":".join(auto_classcodes)
                 if combo_key not in self.stats["ddc_data"]["both_codes"]["codes"]:
@@ -209,128 +267,278 @@ class Stats(object):
             else:
                 self.stats["languages"][desc_type][category][lang] += 1
 
+    def _count_variance(self, count, sampling):
+        if sampling["mode"] == "uniform":
+            # Bernoulli sampling with inclusion probability rate
+            rate = sampling["rate"]
+            return count * (1 - rate) / rate ** 2
+        population = sampling["population"]
+        sample = sampling["sample"]
+        if sample < 2:
+            return 0.0
+        # Simple random sample without replacement
+        share = count / sample
+        return population ** 2 * (1 - sample / population) * share * (1 - share) / (sample - 1)
+
+    def _count_estimate(self, count, sampling):
+        if sampling["mode"] == "uniform":
+            return count / sampling["rate"]
+        return count * sampling["population"] / sampling["sample"] if sampling["sample"] > 0 else 0.0
+
+    def apply_sampling(self, sampling):
+        """Scale all counters of a sample up to estimates for the whole file
+        and store their estimated variances in the "sampling" section."""
+        variances = {}
+        corpus_estimates = {}
+        path_list = [[category] for category in self.stats.keys()]
+        while len(path_list) > 0:
+            path = path_list.pop()
+            parent = self.stats
+            variance_parent = variances
+            for path_element in path[:-1]:
+                parent = parent[path_element]
+                variance_parent = variance_parent.setdefault(path_element, {})
+            value = parent[path[-1]]
+            if type(value) == type({}):
+                for next_level in value.keys():
+                    path_list.append(path + [next_level])
+                continue
+            if type(value) == type([]):
+                # description lengths of sampled corpus documents
+                count = len(value)
+                lang = path[1]
+                corpus_estimates.setdefault(lang, {})[path[-1]] = self._count_estimate(count, sampling)
+            else:
+                count = value
+                parent[path[-1]] = self._count_estimate(count, sampling)
+            variance_parent[path[-1]] = self._count_variance(count, sampling)
+        self.stats["sampling"] = dict(sampling)
+        self.stats["sampling"]["variances"] = variances
+        self.stats["sampling"]["corpus_estimates"] = corpus_estimates
+
+    def add_prefilter_stats(self, filtered):
+        """Count the records dropped by the pre-filter of
+        create_reduced_records.py as rejected by the matching checks."""
+        self.stats["prefilter"] = dict(filtered)
+        for reason, count in filtered.items():
+            self.stats["processing_stats"][reason] += count
+
+    def add_stats(self, other, sign=1):
+        """Add (sign 1) or subtract (sign -1) the counters of another stats
+        dict. Entries which drop to zero are removed unless they are part
+        of the template, so the result equals a stats file created from
+        the combined records."""
+        # Normalize keys like a stats file read from disk (some counters use int keys)
+        self.stats = json.loads(json.dumps(self.stats))
+        other = json.loads(json.dumps(other))
+        path_list = [[category] for category in other.keys()]
+        while len(path_list) > 0:
+            path = path_list.pop()
+            value = other
+            for path_element in path:
+                value = value[path_element]
+            if type(value) == type({}):
+                for next_level in value.keys():
+                    path_list.append(path + [next_level])
+                continue
+            parent = self.stats
+            template = self.STATS_TEMPLATE
+            for path_element in path[:-1]:
+                parent = parent.setdefault(path_element, {})
+                template = template.get(path_element, {})
+            key = path[-1]
+            if type(value) == type([]):
+                current = parent.setdefault(key, [])
+                if sign > 0:
+                    current.extend(value)
+                else:
+                    for item in value:
+                        current.remove(item)
+                if not current:
+                    del parent[key]
+                continue
+            parent[key] = parent.get(key, 0) + sign * value
+            if parent[key] == 0 and key not in template:
+                del parent[key]
+
     def write_stats_file(self):
         file_name = "stats." + self.file_number
-        with open(os.path.join(self.stats_dir, file_name), "w") as f:
-            f.write(json.dumps(self.stats, indent=2, sort_keys=True, ensure_ascii=False))
-
-def extract_subject_classcodes(subjects):
-    ret = []
-    for subject in subjects:
-        match = SUBJECT_DDC_REGEX.match(subject)
-        if match:
-            ret.append(match.group("ddc"))
-    if len(ret) > 1:
-        ret.sort()
-    return ret
-
-def extract_classcodes(classcodes, file_number):
-    ret = []
-    for code in classcodes:
-        match = DDC_REGEX.match(code)
-        if match:
-            ret.append(match.group("ddc"))
-        else:
-            print("invalid classcode in {}: {}".format(file_number, code))
-    if len(ret) > 1:
-        ret.sort()
-    return ret
+        atomic_write(os.path.join(self.stats_dir, file_name), json.dumps(self.stats, indent=2, sort_keys=True, ensure_ascii=False))
+
+def process_record(record, stats, args, file_number):
+    """Add the stats of a single record. Returns the language and the
+    corpus candidate of an eligible record, None otherwise."""
+    record_eligible = True
+    # if no stats are requested, we can speed up the process by
+    # returning early
+    try:
+        description_combined = " ".join(record["description"])
+    except KeyError:
+        print(record)
+        sys.exit(1)
+    if len(description_combined) < args.desc_min_length:
+        if record_eligible:
+            stats.stats["processing_stats"]["min_length"] += 1
+            record_eligible = False
+        if not args.stats:
+            return None
+    stats.create_desc_stats(record["description"])
+    classcodes = extract_classcodes(record["classcode"], file_number)
+    subject_classcodes = []
+    if args.additional_ddc_sources:
+        subject_classcodes = extract_subject_classcodes(record["subject"])
+    if not classcodes and not subject_classcodes:
+        if record_eligible:
+            stats.stats["processing_stats"]["no_classcodes"] += 1
+            record_eligible = False
+        if not args.stats:
+            return None
+    auto_classcodes = record["autoclasscode"]
+    if len(auto_classcodes) > 1:
+        auto_classcodes.sort()
+    stats.create_classcode_stats(classcodes, subject_classcodes, auto_classcodes)
+    det = None
+    if len(description_combined) > 0:
+        try:
+            det = Detector(description_combined, quiet=True)
+        except pycld2.error:
+            # The underlying pycld2 lib may fail if the input contains
+            # malformed utf-8 bytes. We treat these cases as "detection failure"
+            pass
+    if det is None:
+        if record_eligible:
+            stats.stats["processing_stats"]["lang_detection_failure"] += 1
+            record_eligible = False
+        if not args.stats:
+            return None
+    if det and args.reliable_predictions_only and not det.reliable:
+        if record_eligible:
+            stats.stats["processing_stats"]["lang_detection_unreliable"] += 1
+            record_eligible = False
+        if not args.stats:
+            return None
+    if det and det.language.confidence < args.language_min_confidence:
+        if record_eligible:
+            stats.stats["processing_stats"]["lang_min_confidence"] += 1
+            record_eligible = False
+        if not args.stats:
+            return None
+    if det and det.language.code not in ["de", "en"]:
+        if record_eligible:
+            stats.stats["processing_stats"]["other_lang"] += 1
+            record_eligible = False
+        if not args.stats:
+            return None
+    stats.create_language_stats(det, args, description_combined)
+    if not record_eligible:
+        return None
+    stats.stats["processing_stats"]["eligible"] += 1
+    classcodes_combined = sorted(set(classcodes + subject_classcodes)) # join and remove duplicates, sorted so code combinations are reproducible
+    stats.create_corpus_stats(det.language.code, classcodes_combined, description_combined)
+    # The identifier is not read from Arrow files in stats-only runs
+    return det.language.code, (record.get("identifier"), description_combined, classcodes_combined, auto_classcodes)
+
+def corpus_file_name(file_number, identifier):
+    return file_number + "." + identifier.replace(":", "~").replace("/", "_")
 
-def process_content(content, file_number, args):
+def write_corpus_document(lang, file_number, candidate):
+    """Write the raw corpus files of a candidate, returns its manifest entry."""
+    target_dir = os.path.join(CORPUS_DIR, lang)
+    file_name = corpus_file_name(file_number, candidate[0][0])
+    atomic_write(os.path.join(target_dir, file_name + ".txt"), candidate[1])
+    keys = "".join([DDC_VOCAB[code] + "\n" for code in candidate[2]])
+    atomic_write(os.path.join(target_dir, file_name + ".key"), keys)
+    if len(candidate[3]) > 0:
+        autokeys = "".join([DDC_VOCAB[code] + "\n" for code in candidate[3]])
+        atomic_write(os.path.join(target_dir, file_name + ".autokey"), autokeys)
+    return manifest_entry(file_name, lang, candidate[0][0], len(candidate[1]), candidate[2], candidate[3])
+
+def remove_corpus_document(lang, basename):
+    for file_ext in [".txt", ".key", ".autokey"]:
+        path = os.path.join(CORPUS_DIR, lang, basename + file_ext)
+        if os.path.isfile(path):
+            os.remove(path)
+
+def process_content(content, file_number, args, sampling=None):
     corpus_candidates = {
         "de": [],
         "en": [],
     }
     stats = Stats(file_number, STATS_DIR)
-    for record in content:
-        record_eligible = True
-        # if no stats are requested, we can speed up the process by
-        # continuing early
-        try:
-            description_combined = " ".join(record["description"])
-        except KeyError:
-            print(record)
-            sys.exit()
-        if len(description_combined) < args.desc_min_length:
-            if record_eligible:
-                stats.stats["processing_stats"]["min_length"] += 1
-                record_eligible = False
-            if not args.stats:
-                continue
-        stats.create_desc_stats(record["description"])
-        classcodes = extract_classcodes(record["classcode"], file_number)
-        subject_classcodes = []
-        if args.additional_ddc_sources:
-            subject_classcodes = extract_subject_classcodes(record["subject"])
-        if not classcodes and not subject_classcodes:
-            if record_eligible:
-                stats.stats["processing_stats"]["no_classcodes"] += 1
-                record_eligible = False
-            if not args.stats:
-                continue
-        auto_classcodes = record["autoclasscode"]
-        if len(auto_classcodes) > 1:
-            auto_classcodes.sort()
-        stats.create_classcode_stats(classcodes, subject_classcodes, auto_classcodes)
-        det = None
-        if len(description_combined) > 0:
-            try:
-                det = Detector(description_combined, quiet=True)
-            except pycld2.error:
-                # The underlying pycld2 lib may fail if the input contains
-                # malformed utf-8 bytes. We treat these cases as "detection failure"
-                pass
-        if det is None:
-            if record_eligible:
-                stats.stats["processing_stats"]["lang_detection_failure"] += 1
-                record_eligible = False
-            if not args.stats:
-                continue
-        if det and args.reliable_predictions_only and not det.reliable:
-            if record_eligible:
-                stats.stats["processing_stats"]["lang_detection_unreliable"] += 1
-                record_eligible = False
-            if not args.stats:
-                continue
-        if det and det.language.confidence < args.language_min_confidence:
-            if record_eligible:
-                stats.stats["processing_stats"]["lang_min_confidence"] += 1
-                record_eligible = False
-            if not args.stats:
-                continue
-        if det and det.language.code not in ["de", "en"]:
-            if record_eligible:
-                stats.stats["processing_stats"]["other_lang"] += 1
-                record_eligible = False
-            if not args.stats:
-                continue
-        stats.create_language_stats(det, args, description_combined)
-        if record_eligible:
-            stats.stats["processing_stats"]["eligible"] += 1
-            classcodes_combined = list(set(classcodes + subject_classcodes)) # join and remove duplicates
-            corpus_candidates[det.language.code].append((record["identifier"], description_combined, classcodes_combined, auto_classcodes))
-            stats.create_corpus_stats(det.language.code, classcodes_combined, description_combined)
+    for record in iter_records(content):
+        result = process_record(record, stats, args, file_number)
+        if result is not None and args.corpus:
+            corpus_candidates[result[0]].append(result[1])
+    if sampling is not None:
+        stats.apply_sampling(sampling)
     if args.stats:
+        prefilter_stats = _load_prefilter_stats(file_number)
+        if prefilter_stats is not None:
+            # Exact counts over the whole file, added after sampling
+            stats.add_prefilter_stats(prefilter_stats["filtered"])
         stats.write_stats_file()
     if not args.corpus:
         return
+    manifest_entries = []
     for lang, candidates in corpus_candidates.items():
         target_dir = os.path.join(CORPUS_DIR, lang)
         if not os.path.isdir(target_dir):
             os.mkdir(target_dir)
         for candidate in candidates:
-            file_name = file_number + "." + candidate[0][0].replace(":", "~").replace("/", "_")
-            with open(os.path.join(target_dir, file_name + ".txt") , "w") as o:
-                o.write(candidate[1])
-            with open(os.path.join(target_dir, file_name + ".key") , "w") as o:
-                for code in candidate[2]:
-                    o.write(DDC_VOCAB[code] + "\n")
-            if len(candidate[3]) > 0:
-                with open(os.path.join(target_dir, file_name + ".autokey") , "w") as o:
-                    for code in candidate[3]:
-                        o.write(DDC_VOCAB[code] + "\n")
-
-def _load_ddc_vocab():
+            manifest_entries.append(write_corpus_document(lang, file_number, candidate))
+    # Written last, the manifest only lists documents whose files exist
+    write_part(MANIFEST_PARTS_DIR, file_number, manifest_entries)
+
+def _sample_content(content, file_number, args):
+    population = num_records(content)
+    # Seeded per file, so results do not depend on the processing order
+    rng = random.Random("{}:{}".format(args.sample_seed, file_number))
+    if args.sample_mode == "uniform":
+        indices = [index for index in range(population) if rng.random() < args.sample_rate]
+    else:
+        indices = sorted(rng.sample(range(population), round(population * args.sample_rate)))
+    sampling = {
+        "mode": args.sample_mode,
+        "rate": args.sample_rate,
+        "seed": args.sample_seed,
+        "population": population,
+        "sample": len(indices)
+    }
+    return take_records(content, indices), sampling
+
+def _load_prefilter_stats(file_number):
+    """Return the pre-filter stats of a file, None if it was not pre-filtered."""
+    path = os.path.join(PREFILTER_DIR, "prefilter." + file_number)
+    if not os.path.isfile(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+def _check_prefilter_settings(args):
+    if not os.path.isdir(PREFILTER_DIR):
+        return
+    prefilter_files = [name for name in os.listdir(PREFILTER_DIR) if not is_temp_file(name)]
+    if not prefilter_files:
+        return
+    if args.stats:
+        # Stats of the dropped records would require language detection
+        # on them, which is exactly what the pre-filter avoids
+        msg = ("Note: {} reduced records files were pre-filtered (create_reduced_records.py -f). The dropped records are " +
+               "only counted in the processing stats, all other stats cover the remaining records")
+        print(msg.format(len(prefilter_files)))
+    expected = {
+        "desc_min_length": args.desc_min_length,
+        "additional_ddc_sources": args.additional_ddc_sources
+    }
+    for name in prefilter_files:
+        settings = _load_prefilter_stats(name.split(".")[1])["settings"]
+        if settings != expected:
+            msg = ("Error: {} reduced records were pre-filtered with settings {}, which do not match the current settings {}. " +
+                   "Re-run create_reduced_records.py with matching -d/-a arguments (or without -f)")
+            print(msg.format(len(prefilter_files), settings, expected))
+            sys.exit()
+
+def load_ddc_vocab():
     global DDC_VOCAB
     with open(DDC_VOCAB_FILE, encoding="utf-8") as f:
         for line in f:
@@ -343,19 +551,173 @@ def _cleanup_process_pool():
     for process in PROCESS_POOL:
         if process.is_alive():
             still_running.append(process)
+        else:
+            _finish_process(process)
     PROCESS_POOL = still_running
 
+def _finish_process(process):
+    full_name, args = PROCESS_ITEMS.pop(process.name)
+    if process.exitcode == 0:
+        JOURNAL.mark_done(full_name, os.path.join(RLR_DIR, full_name), _journal_settings(args))
+        if WORK_QUEUE is not None:
+            WORK_QUEUE.complete(full_name, NODE_ID)
+        return
+    _record_failure(full_name, "exit code {}".format(process.exitcode))
+
+def _record_failure(full_name, error, permanent=False):
+    print("processing of {} failed: {}".format(full_name, error))
+    if WORK_QUEUE is not None:
+        WORK_QUEUE.fail(full_name, NODE_ID, error, permanent)
+        return
+    FAILED_ATTEMPTS[full_name] = FAILED_ATTEMPTS.get(full_name, 0) + 1
+    if permanent:
+        FAILED_ATTEMPTS[full_name] = MAX_ATTEMPTS
+    if FAILED_ATTEMPTS[full_name] < MAX_ATTEMPTS:
+        RETRY_FILES.append(full_name)
+
+def output_paths(file_number, settings):
+    """The outputs of a reducedListRecords file for the given journal
+    settings, corpus documents are taken from its manifest part."""
+    paths = []
+    if settings["stats"]:
+        paths.append(os.path.join(STATS_DIR, "stats." + file_number))
+    if settings["corpus"]:
+        part_path = os.path.join(MANIFEST_PARTS_DIR, "manifest." + file_number)
+        paths.append(part_path)
+        if os.path.isfile(part_path):
+            with open(part_path, encoding="utf-8") as f:
+                entries = json.load(f)
+            for entry in entries:
+                file_exts = [".txt", ".key"]
+                if entry["auto_codes"]:
+                    file_exts.append(".autokey")
+                paths += [os.path.join(CORPUS_DIR, entry["lang"], entry["basename"] + file_ext) for file_ext in file_exts]
+    return paths
+
+def _journal_settings(args):
+    # Everything which influences the content of the output files
+    settings = ["corpus", "stats", "additional_ddc_sources", "desc_min_length",
+                "language_min_confidence", "reliable_predictions_only",
+                "sample_rate", "sample_mode", "sample_seed"]
+    settings = {setting: getattr(args, setting) for setting in settings}
+    settings["combined_code_order"] = COMBINED_CODE_ORDER
+    return settings
+
 def _start_new_process():
     global CONTENT_WAITING_QUEUE, PROCESS_POOL, MAX_PROCESSES
     if len(PROCESS_POOL) < MAX_PROCESSES:
         data = CONTENT_WAITING_QUEUE.pop()
-        p = mp.Process(target=process_content, args=(data[0], data[1], data[2]), name="Process_" + data[1])
+        p = mp.Process(target=process_content, args=(data[0], data[1], data[2], data[4]), name="Process_" + data[1])
         PROCESS_POOL.append(p)
+        PROCESS_ITEMS[p.name] = (data[3], data[2])
         p.start()
         print("started process " + str(p))
     else:
         print("Process pool currently full")
 
+def _list_input_files(args):
+    input_files = []
+    settings = _journal_settings(args)
+    for full_name in sorted(os.listdir(RLR_DIR)):
+        if is_temp_file(full_name):
+            continue
+        file_number = full_name.split(".")[1]
+        if args.start > int(file_number) or args.end < int(file_number):
+            continue
+        if not args.overwrite and JOURNAL.is_done(full_name, os.path.join(RLR_DIR, full_name), settings, output_paths(file_number, settings)):
+            continue
+        input_files.append(full_name)
+    return input_files
+
+def _required_fields(args):
+    fields = ["description", "classcode", "autoclasscode"]
+    if args.additional_ddc_sources:
+        fields.append("subject")
+    if args.corpus:
+        fields.append("identifier")
+    return fields
+
+def _read_input_file(full_name, args):
+    """Return the (sampled) content of a reduced records file and the
+    sampling info (None without -x), the content is None on errors."""
+    try:
+        if full_name.endswith(ARROW_SUFFIX):
+            content = read_arrow(os.path.join(RLR_DIR, full_name), _required_fields(args))
+        else:
+            with open(os.path.join(RLR_DIR, full_name), encoding="utf-8") as f:
+                content = json.load(f)
+        if args.sample_rate is None:
+            return content, None
+        # Taking rows of a memory-mapped table only reads the sampled rows
+        return _sample_content(content, full_name.split(".")[1], args)
+    except (OSError, ValueError) as e:
+        # Damaged files (JSONDecodeError and pyarrow's ArrowInvalid are
+        # ValueErrors) fail again on every attempt, so they are not retried
+        _record_failure(full_name, str(e) + " (Hint: Re-run create_reduced_records.py to recreate the file)", permanent=True)
+        return None, None
+
+def _renew_leases(names=()):
+    WORK_QUEUE.renew([item[0] for item in PROCESS_ITEMS.values()] + list(names), NODE_ID)
+
+def _process_queue(args):
+    already_done = WORK_QUEUE.add_items(_list_input_files(args))
+    if already_done:
+        msg = ("Warning: {} files to process are already marked as done in the queue file {} and will not be processed again. " +
+               "Use a new queue file for every run")
+        print(msg.format(len(already_done), WORK_QUEUE.path))
+    last_renewal = time()
+    while True:
+        _cleanup_process_pool()
+        if len(PROCESS_POOL) < MAX_PROCESSES:
+            full_name = WORK_QUEUE.claim(NODE_ID)
+            if full_name is not None:
+                # The leases of running files must not expire during a
+                # long read (f.e. a large JSON file)
+                _renew_leases()
+                content, sampling = _read_input_file(full_name, args)
+                _renew_leases([full_name])
+                last_renewal = time()
+                if content is not None:
+                    CONTENT_WAITING_QUEUE.append((content, full_name.split(".")[1], args, full_name, sampling))
+                    _start_new_process()
+                continue
+        if not PROCESS_POOL and WORK_QUEUE.unfinished() == 0:
+            break
+        if time() - last_renewal > LEASE_RENEWAL_INTERVAL:
+            _renew_leases()
+            last_renewal = time()
+        sleep(1)
+    summary = WORK_QUEUE.summary()
+    print("Work queue finished: {} files done, {} files failed".format(summary["done"], summary["failed"]))
+
+def _process_files(args):
+    global RETRY_FILES
+    input_files = _list_input_files(args)
+    while input_files:
+        for full_name in input_files:
+            content, sampling = _read_input_file(full_name, args)
+            if content is None:
+                continue
+            CONTENT_WAITING_QUEUE.append((content, full_name.split(".")[1], args, full_name, sampling))
+            _cleanup_process_pool()
+            _start_new_process()
+        print("All Files read, processing remaining content...")
+        while len(CONTENT_WAITING_QUEUE) > 0:
+            _cleanup_process_pool()
+            _start_new_process()
+            sleep(0.1)
+        print("Waiting for all processes to finish...")
+        while len(PROCESS_POOL) > 0:
+            _cleanup_process_pool()
+            sleep(0.1)
+        input_files = RETRY_FILES
+        RETRY_FILES = []
+        if input_files:
+            print("Retrying {} failed files...".format(len(input_files)))
+    failed_files = [name for name, attempts in FAILED_ATTEMPTS.items() if attempts >= MAX_ATTEMPTS]
+    if failed_files:
+        print("The following files could not be processed: " + ", ".join(sorted(failed_files)))
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("-C", "--corpus", action="store_true", help="Create a corpus")
@@ -367,20 +729,36 @@ if __name__ == '__main__':
     parser.add_argument("-d", "--desc_min_length", type=int, default=100, help="Minimum length of a record's description field to be eligible for the corpus (default: 100)")
     parser.add_argument("-c", "--language_min_confidence", type=float, default=95.0, help="Minimum required confidence of the polyglot language detector when identifying a record's description field language (default: 0.95)")
     parser.add_argument("-r", "--reliable_predictions_only", action="store_true", help="Only use a record for the corpus if polyglot self-reports a reliable prediction for the description field's language (stats will be generated for both cases)")
+    parser.add_argument("-o", "--overwrite", action="store_true", help="Process all files again, even if they have a completion entry with the same settings in the journal")
+    parser.add_argument("-x", "--sample_rate", type=float, help="Only generate stats from a random sample of records (0 < rate <= 1), counters are scaled up to estimates (stats mode only)")
+    parser.add_argument("-m", "--sample_mode", choices=SAMPLE_MODES, default="uniform", help="Sampling mode: Sample every record independently (uniform) or draw a fixed share of records from every file (file) (default: uniform)")
+    parser.add_argument("-g", "--sample_seed", type=int, default=0, help="Seed for the record sampling (default: 0)")
+    parser.add_argument("-q", "--queue", help="Path to a shared work queue file. All nodes started with the same queue file claim reducedListRecords files from it until all files have been processed")
+    parser.add_argument("-n", "--node_id", default=default_node_id(), help="Name of this node in queue mode (default: hostname:pid)")
     args = parser.parse_args()
     if not (args.corpus or args.stats):
         print("Error: Either a corpus (-C) oder stats files (-S) must be created (or both)")
         sys.exit()
+    if args.sample_rate is not None:
+        if args.corpus:
+            print("Error: Sampling (-x) can only be used for stats files (-S), not for corpus creation (-C)")
+            sys.exit()
+        if not 0 < args.sample_rate <= 1:
+            print("Error: The sample rate (-x) must be in the range (0, 1]")
+            sys.exit()
     if args.stats and not os.path.isdir(STATS_DIR):
         os.mkdir(STATS_DIR)
     if args.corpus and not os.path.isdir(CORPUS_DIR):
         os.mkdir(CORPUS_DIR)
+    if args.corpus:
+        os.makedirs(MANIFEST_PARTS_DIR, exist_ok=True)
     if args.processes:
         MAX_PROCESSES = args.processes
+    JOURNAL = Journal(JOURNAL_DIR)
+    _check_prefilter_settings(args)
 
     mp.set_start_method('fork')
-    _load_ddc_vocab()
-    files = sorted(os.listdir(RLR_DIR))
+    load_ddc_vocab()
     start_msg = ("Processing recucedListRecords with the following settings:\n" +
                  "- Create corpus: {}\n" +
                  "- Create stats: {}\n" +
@@ -388,29 +766,14 @@ if __name__ == '__main__':
                  "- Start index: {}\n" +
                  "- End index: {}\n")
     print(start_msg.format(args.corpus, args.stats, MAX_PROCESSES, args.start, args.end))
-    for full_name in files:
-        components = full_name.split(".")
-        file_number = components[1]
-        file_name = components[0] + "." + components[1]
-        if args.start > int(file_number) or args.end < int(file_number):
-            continue
-        with open(os.path.join(RLR_DIR, full_name), encoding="utf-8") as f:
-            try:
-                content = json.load(f)
-            except json.decoder.JSONDecodeError as de:
-                print(str(de))
-                print(full_name)
-                sys.exit()
-            CONTENT_WAITING_QUEUE.append((content, file_number, args))
-            _cleanup_process_pool()
-            _start_new_process()
-    print("All Files read, processing remaining content...")
-    while len(CONTENT_WAITING_QUEUE) > 0:
-        _cleanup_process_pool()
-        _start_new_process()
-        sleep(0.1)
-    print("Waiting for all processes to finish...")
-    while len(PROCESS_POOL) > 0:
-        _cleanup_process_pool()
-        sleep(0.1)
+    if args.sample_rate is not None:
+        print("Sampling records: mode {}, rate {}, seed {}\n".format(args.sample_mode, args.sample_rate, args.sample_seed))
+    if args.queue:
+        WORK_QUEUE = WorkQueue(args.queue)
+        NODE_ID = args.node_id
+        print("Queue mode, claiming files from {} as node {}".format(args.queue, NODE_ID))
+        _process_queue(args)
+        WORK_QUEUE.close()
+    else:
+        _process_files(args)
     print("Done!")
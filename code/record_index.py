@@ -0,0 +1,117 @@
+"""Identifier index over the reduced records.
+
+@author Christoph Broschinski (https://github.com/cbroschinski)
+
+Maps the OAI identifier of every reduced record to the reducedListRecords
+file it is stored in and a SHA-256 hash of its reduced content. The index
+is an SQLite database (RECORD_INDEX_PATH), it is used by apply_harvest.py
+to find the records affected by an incremental harvest and to skip
+records which have been delivered again without any relevant change.
+
+Like the corpus manifest, the index keeps the size/mtime of every indexed
+file, so update() only reads files which have been added or changed since
+(the first update reads all reduced records once).
+
+Called as a script, the index is brought up to date and a summary is
+printed:
+
+python record_index.py
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+
+from file_utils import is_temp_file
+from record_store import load_records
+
+RLR_DIR = "../data/reducedListRecords"
+RECORD_INDEX_PATH = "../data/record_index.db"
+
+def record_identifier(record):
+    if not record["identifier"]:
+        return None
+    return record["identifier"][0]
+
+def record_hash(record):
+    return hashlib.sha256(json.dumps(record, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+class RecordIndex(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS records ("
+            "identifier TEXT PRIMARY KEY, "
+            "file_name TEXT NOT NULL, "
+            "hash TEXT NOT NULL)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS records_file_name ON records (file_name)")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            "name TEXT PRIMARY KEY, "
+            "size INTEGER NOT NULL, "
+            "mtime REAL NOT NULL)"
+        )
+        self.connection.commit()
+
+    def index_file(self, file_name, records, path):
+        """(Re-)index the records of a reduced records file."""
+        self.connection.execute("DELETE FROM records WHERE file_name = ?", (file_name,))
+        rows = []
+        for record in records:
+            identifier = record_identifier(record)
+            if identifier is not None:
+                rows.append((identifier, file_name, record_hash(record)))
+        self.connection.executemany("INSERT OR REPLACE INTO records VALUES (?, ?, ?)", rows)
+        stat = os.stat(path)
+        self.connection.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?)", (file_name, stat.st_size, stat.st_mtime))
+        self.connection.commit()
+
+    def update(self, rlr_dir):
+        """Index new or changed reduced records files, returns their number."""
+        file_names = sorted([name for name in os.listdir(rlr_dir) if not is_temp_file(name)])
+        indexed_states = {row[0]: (row[1], row[2]) for row in self.connection.execute("SELECT name, size, mtime FROM files")}
+        indexed = 0
+        for file_name in file_names:
+            path = os.path.join(rlr_dir, file_name)
+            stat = os.stat(path)
+            if indexed_states.get(file_name) == (stat.st_size, stat.st_mtime):
+                continue
+            self.index_file(file_name, load_records(path), path)
+            indexed += 1
+        for file_name in set(indexed_states.keys()) - set(file_names):
+            self.connection.execute("DELETE FROM records WHERE file_name = ?", (file_name,))
+            self.connection.execute("DELETE FROM files WHERE name = ?", (file_name,))
+        self.connection.commit()
+        return indexed
+
+    def lookup(self, identifier):
+        """Return (file name, hash) of an indexed record or None."""
+        return self.connection.execute(
+            "SELECT file_name, hash FROM records WHERE identifier = ?", (identifier,)
+        ).fetchone()
+
+    def file_names(self):
+        return [row[0] for row in self.connection.execute("SELECT name FROM files ORDER BY name")]
+
+    def summary(self):
+        return self.connection.execute("SELECT COUNT(*), COUNT(DISTINCT file_name) FROM records").fetchone()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--index", default=RECORD_INDEX_PATH, help="Path to the index (default: " + RECORD_INDEX_PATH + ")")
+    args = parser.parse_args()
+
+    index = RecordIndex(args.index)
+    print("{} reduced records files indexed".format(index.update(RLR_DIR)))
+    num_records, num_files = index.summary()
+    print("{} records in {} files".format(num_records, num_files))
+    index.close()
@@ -0,0 +1,80 @@
+"""Columnar storage for reduced records.
+
+@author Christoph Broschinski (https://github.com/cbroschinski)
+
+As an alternative to JSON, create_reduced_records.py can write the reduced
+records as Arrow IPC files (Feather V2, -F arrow). Every DC field is stored
+as a column of string lists, the files are written uncompressed so they
+can be memory-mapped. process_reduced_records.py then only reads the
+columns it actually needs (see read_arrow()): the mapped buffers are used
+directly and only the selected columns are turned into Python objects,
+so the I/O cost of a run depends on the fields used, not on the record
+size.
+"""
+
+import json
+import os
+
+import pyarrow as pa
+from pyarrow import feather
+
+from file_utils import atomic_write, atomic_write_with
+
+FIELDS = ["title", "description", "subject", "classcode", "autoclasscode", "identifier"]
+
+JSON_FORMAT = "json"
+ARROW_FORMAT = "arrow"
+ARROW_SUFFIX = ".arrow"
+
+# Number of records converted to Python objects at once
+BATCH_SIZE = 10000
+
+def reduced_records_path(target_dir, file_name, output_format):
+    path = os.path.join(target_dir, "Reduced" + file_name)
+    if output_format == ARROW_FORMAT:
+        path += ARROW_SUFFIX
+    return path
+
+def write_arrow(path, records):
+    columns = {}
+    for field in FIELDS:
+        columns[field] = pa.array([record[field] for record in records], type=pa.list_(pa.string()))
+    table = pa.table(columns)
+    atomic_write_with(path, lambda temp_path: feather.write_feather(table, temp_path, compression="uncompressed"))
+
+def read_arrow(path, fields):
+    return feather.read_table(path, columns=fields, memory_map=True)
+
+def load_records(path):
+    """Read all records of a reduced records file (either format) as a list of dicts."""
+    if path.endswith(ARROW_SUFFIX):
+        return list(iter_records(read_arrow(path, FIELDS)))
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+def write_records(path, records):
+    if path.endswith(ARROW_SUFFIX):
+        write_arrow(path, records)
+    else:
+        atomic_write(path, json.dumps(records, indent=2, ensure_ascii=False))
+
+def num_records(content):
+    if isinstance(content, list):
+        return len(content)
+    return content.num_rows
+
+def take_records(content, indices):
+    if isinstance(content, list):
+        return [content[index] for index in indices]
+    return content.take(indices)
+
+def iter_records(content):
+    """Iterate over reduced records as dicts, content is either a list of
+    records (JSON files) or a table returned by read_arrow()."""
+    if isinstance(content, list):
+        yield from content
+        return
+    for batch in content.to_batches(max_chunksize=BATCH_SIZE):
+        columns = [column.to_pylist() for column in batch.columns]
+        for values in zip(*columns):
+            yield dict(zip(batch.schema.names, values))
@@ -0,0 +1,80 @@
+"""Persistent cache for Annif suggestions.
+
+@author Christoph Broschinski (https://github.com/cbroschinski)
+
+Stores the suggestions returned by the Annif REST API in an SQLite
+database, keyed by project id, model fingerprint, the SHA-256 hash of the
+document text, limit and threshold. The model fingerprint changes
+whenever a project is retrained (see classify_eval_corpus.py), so cached
+suggestions of an outdated model are never used.
+
+Called as a script, the number of cached suggestions per project and
+fingerprint is printed:
+
+python suggestion_cache.py ../data/suggestion_cache.db
+"""
+
+import argparse
+import hashlib
+import json
+import sqlite3
+
+def text_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+class SuggestionCache(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS suggestions ("
+            "project TEXT NOT NULL, "
+            "fingerprint TEXT NOT NULL, "
+            "text_hash TEXT NOT NULL, "
+            "limit_ INTEGER NOT NULL, "
+            "threshold REAL NOT NULL, "
+            "results TEXT NOT NULL, "
+            "PRIMARY KEY (project, fingerprint, text_hash, limit_, threshold))"
+        )
+        self.connection.commit()
+
+    def get_many(self, project, fingerprint, text_hashes, limit, threshold):
+        """Return a dict text hash -> suggestions for all cached hashes."""
+        cached = {}
+        for hash_value in text_hashes:
+            row = self.connection.execute(
+                "SELECT results FROM suggestions WHERE project = ? AND fingerprint = ? AND text_hash = ? AND limit_ = ? AND threshold = ?",
+                (project, fingerprint, hash_value, limit, threshold)
+            ).fetchone()
+            if row is not None:
+                cached[hash_value] = json.loads(row[0])
+        return cached
+
+    def put(self, project, fingerprint, hash_value, limit, threshold, results):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO suggestions VALUES (?, ?, ?, ?, ?, ?)",
+            (project, fingerprint, hash_value, limit, threshold, json.dumps(results))
+        )
+
+    def commit(self):
+        self.connection.commit()
+
+    def summary(self):
+        return self.connection.execute(
+            "SELECT project, fingerprint, COUNT(*) FROM suggestions GROUP BY project, fingerprint ORDER BY project"
+        ).fetchall()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("cache", help="Path to the cache file")
+    args = parser.parse_args()
+
+    cache = SuggestionCache(args.cache)
+    for project, fingerprint, count in cache.summary():
+        print("{} (model {}): {} cached suggestions".format(project, fingerprint, count))
+    cache.close()
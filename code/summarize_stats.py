@@ -5,6 +5,19 @@
 This script aggregates the statistics files in STATS_DIR and
 creates a number of CSV files in ANALYZE_DIR, summarizing
 different aspects of the analyzed BASE dump.
+
+If some of the stats files were generated from a record sample
+(process_reduced_records.py -x), the counts are estimates. Their
+variances are added up over all files and the count CSV files get two
+additional columns with the bounds of the 95% confidence interval
+(ci_lower, ci_upper). For counts summed up over several class
+combinations (the *_single_class_stats.csv files), the intervals are
+slightly conservative. corpus_stats.csv lists the sampled documents only.
+
+Records dropped by the pre-filter (create_reduced_records.py -f) are
+included in the "min_length" and "no_classcodes" rows of
+processing_stats.csv, but missing from all other CSV files. Their number
+is printed and kept in the "prefilter" section of summarized_stats.json.
 """
 import csv
 import json
@@ -12,48 +25,119 @@ import os
 import sys
 
 from copy import deepcopy
+from math import sqrt
+from file_utils import is_temp_file
 from process_reduced_records import Stats
 
 STATS_DIR = "../data/stats"
 ANALYZE_DIR = "../analyze"
 
+CONFIDENCE_Z = 1.96 # 95% confidence intervals
+
 def _get_nested_dict(top_dict, path):
     current_dict = top_dict
     for path_element in path:
         current_dict = current_dict[path_element]
     return current_dict
 
+def _merge_stats(target, content):
+    path_list = []
+    for category in content.keys():
+        path_list.append([category])
+    while len(path_list) > 0:
+        path = path_list.pop()
+        bottom_level = _get_nested_dict(content, path)
+        if type(bottom_level) == type({}):
+            for next_level in bottom_level.keys():
+                path_list.append(list(path) + [next_level])
+        else:
+            key = path.pop()
+            parent_dict = target
+            for path_element in path:
+                parent_dict = parent_dict.setdefault(path_element, {})
+            if key not in parent_dict:
+                parent_dict[key] = bottom_level
+            else:
+                parent_dict[key] += bottom_level
+
+def _corpus_counts(content):
+    counts = {}
+    for lang, lang_stats in content["corpus"].items():
+        counts[lang] = {code: len(lengths) for code, lengths in lang_stats["classcodes"].items()}
+    return counts
+
 def create_summarized_stats():
     summarized_stats = deepcopy(Stats.STATS_TEMPLATE)
-    stat_files = sorted(os.listdir(STATS_DIR))
+    sampling = {
+        "files": 0,
+        "sampled_files": 0,
+        "population": 0,
+        "sample": 0,
+        "variances": {},
+        "corpus_estimates": {}
+    }
+    prefilter = {
+        "files": 0,
+        "filtered": {}
+    }
+    stat_files = sorted([name for name in os.listdir(STATS_DIR) if not is_temp_file(name)])
     for stat_file in stat_files:
         with open(os.path.join(STATS_DIR, stat_file), encoding="utf-8") as f:
             try:
                 content = json.load(f)
-                path_list = []
-                for category in content.keys():
-                    path_list.append([category])
-                while len(path_list) > 0:
-                    path = path_list.pop()
-                    bottom_level = _get_nested_dict(content, path)
-                    if type(bottom_level) == type({}):
-                        for next_level in bottom_level.keys():
-                            path_list.append(list(path) + [next_level])
-                    else:
-                        key = path.pop()
-                        parent_dict = _get_nested_dict(summarized_stats, path)
-                        if key not in parent_dict:
-                            parent_dict[key] = bottom_level
-                        else:
-                            parent_dict[key] += bottom_level
-
             except json.decoder.JSONDecodeError as de:
                 print(str(de))
                 sys.exit()
+        sampling["files"] += 1
+        file_prefilter = content.pop("prefilter", None)
+        if file_prefilter is not None:
+            prefilter["files"] += 1
+            _merge_stats(prefilter["filtered"], file_prefilter)
+        file_sampling = content.pop("sampling", None)
+        if file_sampling is None:
+            _merge_stats(sampling["corpus_estimates"], _corpus_counts(content))
+        else:
+            sampling["sampled_files"] += 1
+            sampling["population"] += file_sampling["population"]
+            sampling["sample"] += file_sampling["sample"]
+            _merge_stats(sampling["variances"], file_sampling["variances"])
+            _merge_stats(sampling["corpus_estimates"], file_sampling["corpus_estimates"])
+        _merge_stats(summarized_stats, content)
+    if sampling["sampled_files"] > 0:
+        summarized_stats["sampling"] = sampling
+        msg = "{} of {} stats files were generated from a sample ({} of {} records), counts are estimates"
+        print(msg.format(sampling["sampled_files"], sampling["files"], sampling["sample"], sampling["population"]))
+    if prefilter["files"] > 0:
+        summarized_stats["prefilter"] = prefilter
+        msg = ("{} of {} stats files were generated from pre-filtered records, {} dropped records are only counted in " +
+               "processing_stats.csv")
+        print(msg.format(prefilter["files"], sampling["files"], sum(prefilter["filtered"].values())))
     with open(os.path.join(ANALYZE_DIR, "summarized_stats.json"), "w", encoding="utf-8") as sum_file:
         sum_file.write(json.dumps(summarized_stats, indent=2, sort_keys=True, ensure_ascii=False))
     return summarized_stats
 
+def _header(summarized_stats, columns):
+    if "sampling" in summarized_stats:
+        return columns + ["ci_lower", "ci_upper"]
+    return columns
+
+def _variance(summarized_stats, path):
+    if "sampling" not in summarized_stats:
+        return 0.0
+    variance = summarized_stats["sampling"]["variances"]
+    for path_element in path:
+        if path_element not in variance:
+            return 0.0
+        variance = variance[path_element]
+    return variance
+
+def _count_row(summarized_stats, row, count, variance):
+    """Append count (and confidence interval bounds for sampled stats) to a CSV row."""
+    if "sampling" not in summarized_stats:
+        return row + [count]
+    half_width = CONFIDENCE_Z * sqrt(variance)
+    return row + [round(count), round(max(0, count - half_width)), round(count + half_width)]
+
 def extract_corpus_stats(summarized_stats):
     with open(os.path.join(ANALYZE_DIR, "corpus_stats.csv"), "w", encoding="utf-8") as corpus_file:
         writer = csv.writer(corpus_file)
@@ -65,80 +149,98 @@ def extract_corpus_stats(summarized_stats):
                     writer.writerow([lang, classcode, desc_length])
     with open(os.path.join(ANALYZE_DIR, "corpus_single_class_stats.csv"), "w", encoding="utf-8") as s_file:
         writer = csv.writer(s_file)
-        writer.writerow(["lang", "ddc_class", "count"])
+        writer.writerow(_header(summarized_stats, ["lang", "ddc_class", "count"]))
         collected_classes = {
             "de": {},
             "en": {}
         }
+        collected_variances = {
+            "de": {},
+            "en": {}
+        }
         for lang in summarized_stats["corpus"].keys():
             classcode_dict = summarized_stats["corpus"][lang]["classcodes"]
             for class_names, desc_length_list in classcode_dict.items():
                 classes = class_names.split(":")
                 count = len(desc_length_list)
+                variance = _variance(summarized_stats, ["corpus", lang, "classcodes", class_names])
+                if "sampling" in summarized_stats:
+                    count = summarized_stats["sampling"]["corpus_estimates"][lang][class_names]
                 for class_name in classes:
                     if class_name not in collected_classes[lang]:
                         collected_classes[lang][class_name] = count
+                        collected_variances[lang][class_name] = variance
                     else:
                         collected_classes[lang][class_name] += count
+                        collected_variances[lang][class_name] += variance
         for lang, class_dict in collected_classes.items():
             for single_class, collected_count in class_dict.items():
-                writer.writerow([lang, single_class, collected_count])
+                writer.writerow(_count_row(summarized_stats, [lang, single_class], collected_count, collected_variances[lang][single_class]))
 
 def extract_classcode_stats(summarized_stats):
     for category in summarized_stats["ddc_data"].keys():
         file_path = os.path.join(ANALYZE_DIR, category + "_stats.csv")
         with open(file_path, "w", encoding="utf-8") as out_file:
             writer = csv.writer(out_file)
-            writer.writerow([category, "count"])
+            writer.writerow(_header(summarized_stats, [category, "count"]))
             for code, count in summarized_stats["ddc_data"][category]["codes"].items():
-                writer.writerow([code, count])
+                variance = _variance(summarized_stats, ["ddc_data", category, "codes", code])
+                writer.writerow(_count_row(summarized_stats, [code], count, variance))
         s_file_path = os.path.join(ANALYZE_DIR, category + "_single_class_stats.csv")
         with open(s_file_path, "w", encoding="utf-8") as out_file:
             writer = csv.writer(out_file)
-            writer.writerow([category, "count"])
+            writer.writerow(_header(summarized_stats, [category, "count"]))
             collected_classes = {}
+            collected_variances = {}
             for code, count in summarized_stats["ddc_data"][category]["codes"].items():
+                variance = _variance(summarized_stats, ["ddc_data", category, "codes", code])
                 classes = code.split(":")
                 for class_name in classes:
                     if class_name not in collected_classes:
                         collected_classes[class_name] = count
+                        collected_variances[class_name] = variance
                     else:
                         collected_classes[class_name] += count
+                        collected_variances[class_name] += variance
             for single_class, collected_count in collected_classes.items():
-                writer.writerow([single_class, collected_count])
+                writer.writerow(_count_row(summarized_stats, [single_class], collected_count, collected_variances[single_class]))
 
 def extract_language_stats(summarized_stats):
     with open(os.path.join(ANALYZE_DIR, "language_stats.csv"), "w", encoding="utf-8") as out_file:
         writer = csv.writer(out_file)
-        writer.writerow(["min_length", "detection", "lang", "count"])
+        writer.writerow(_header(summarized_stats, ["min_length", "detection", "lang", "count"]))
         for min_length in ["desc_min_length", "not_desc_min_length"]:
             for detection in ["all", "reliable"]:
                 for lang, count in summarized_stats["languages"][min_length][detection].items():
-                    writer.writerow([min_length, detection, lang, count])
+                    variance = _variance(summarized_stats, ["languages", min_length, detection, lang])
+                    writer.writerow(_count_row(summarized_stats, [min_length, detection, lang], count, variance))
 
 def extract_processing_stats(summarized_stats):
     with open(os.path.join(ANALYZE_DIR, "processing_stats.csv"), "w", encoding="utf-8") as out_file:
         writer = csv.writer(out_file)
-        writer.writerow(["processing_result", "count"])
+        writer.writerow(_header(summarized_stats, ["processing_result", "count"]))
         # Write events in order of processing pipeline
         for event in ["min_length", "no_classcodes", "lang_detection_failure", "lang_detection_unreliable", "lang_min_confidence", "other_lang", "eligible"]:
-            writer.writerow([event, summarized_stats["processing_stats"][event]])
+            variance = _variance(summarized_stats, ["processing_stats", event])
+            writer.writerow(_count_row(summarized_stats, [event], summarized_stats["processing_stats"][event], variance))
 
 def extract_description_stats(summarized_stats):
     with open(os.path.join(ANALYZE_DIR, "description_num_per_record_stats.csv"), "w", encoding="utf-8") as out_file:
         writer = csv.writer(out_file)
-        writer.writerow(["num_per_record", "count"])
+        writer.writerow(_header(summarized_stats, ["num_per_record", "count"]))
         for num_per_record, count in summarized_stats["descriptions"]["num_descs_per_record"].items():
-            writer.writerow([num_per_record, count])
+            variance = _variance(summarized_stats, ["descriptions", "num_descs_per_record", num_per_record])
+            writer.writerow(_count_row(summarized_stats, [num_per_record], count, variance))
     with open(os.path.join(ANALYZE_DIR, "description_length_stats.csv"), "w", encoding="utf-8") as out_file:
         writer = csv.writer(out_file)
-        writer.writerow(["length_bin", "length_bin_center", "count"])
+        writer.writerow(_header(summarized_stats, ["length_bin", "length_bin_center", "count"]))
         for length_bin, count in summarized_stats["descriptions"]["combined_desc_lengths"].items():
             bin_center = 0
             if length_bin != "0":
                 bounds = length_bin.split("-")
                 bin_center = (float(bounds[0]) + float(bounds[1])) / 2
-            writer.writerow([length_bin, bin_center, count])
+            variance = _variance(summarized_stats, ["descriptions", "combined_desc_lengths", length_bin])
+            writer.writerow(_count_row(summarized_stats, [length_bin, bin_center], count, variance))
 
 if __name__ == '__main__':
     if not os.path.isdir(ANALYZE_DIR):
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The scripts in code/ are not a package, they import each other as top
+# level modules
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,174 @@
+import argparse
+import json
+import os
+
+import pytest
+
+pytest.importorskip("polyglot.detect")
+pytest.importorskip("pycld2")
+
+import apply_harvest
+import process_reduced_records
+
+from process_reduced_records import COMBINED_CODE_ORDER, Stats, load_ddc_vocab, process_content, process_record
+from record_index import RecordIndex
+from record_store import load_records, write_records
+
+CODE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SETTINGS = {
+    "corpus": True,
+    "stats": True,
+    "additional_ddc_sources": True,
+    "desc_min_length": 100,
+    "language_min_confidence": 0.0,
+    "reliable_predictions_only": False,
+    "sample_rate": None,
+    "sample_mode": "uniform",
+    "sample_seed": 0,
+    "combined_code_order": COMBINED_CODE_ORDER
+}
+
+EN_TEXT = [
+    "This article examines the relationship between monetary policy and the housing market in several European countries over the last two decades.",
+    "We present a new algorithm for the efficient computation of shortest paths in large graphs and evaluate it on road networks and social networks.",
+    "The study describes the history of the public library system and its role in the education of adults during the nineteenth century.",
+    "This thesis investigates the effects of climate change on the distribution of alpine plant species and discusses consequences for conservation."
+]
+DE_TEXT = [
+    "Die Arbeit untersucht die Entwicklung der kommunalen Selbstverwaltung in Deutschland und vergleicht die rechtlichen Grundlagen der einzelnen Bundesländer.",
+    "Der Beitrag beschreibt die Geschichte der Universitätsbibliotheken und ihre Bedeutung für die Forschung und die Lehre an den Hochschulen."
+]
+
+def _record(number, description, classcodes, subjects=(), autoclasscodes=()):
+    return {
+        "title": ["Title {}".format(number)],
+        "description": [description],
+        "subject": list(subjects),
+        "classcode": list(classcodes),
+        "autoclasscode": list(autoclasscodes),
+        "identifier": ["oai:test.example.org:{}".format(number)]
+    }
+
+def _records():
+    return [
+        _record(0, EN_TEXT[0], ["330"], autoclasscodes=["330"]),
+        _record(1, EN_TEXT[1], ["004"], subjects=["ddc:510"]),
+        _record(2, DE_TEXT[0], ["340", "320"]),
+        _record(3, "Too short.", ["020"]),
+        _record(4, EN_TEXT[2], [], subjects=["ddc:020"]),
+        _record(5, DE_TEXT[1], ["020"], autoclasscodes=["020", "370"])
+    ]
+
+def _args():
+    return argparse.Namespace(**SETTINGS)
+
+def _normalized(stats):
+    # Lists of description lengths are multisets, their order depends on
+    # the order in which the records were added
+    stats = json.loads(json.dumps(stats))
+    def _sort_lists(value):
+        if isinstance(value, dict):
+            return {key: _sort_lists(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return sorted(value)
+        return value
+    return _sort_lists(stats)
+
+def _stats(records):
+    stats = Stats("00000", None)
+    for record in records:
+        process_record(json.loads(json.dumps(record)), stats, _args(), "00000")
+    return stats
+
+@pytest.fixture(autouse=True)
+def ddc_vocab(monkeypatch):
+    monkeypatch.setattr(process_reduced_records, "DDC_VOCAB_FILE", os.path.join(CODE_DIR, "en_ddc.tsv"))
+    load_ddc_vocab()
+
+def _use_dirs(monkeypatch, base_dir):
+    dirs = {name: str(base_dir / name) for name in ["reducedListRecords", "stats", "corpus", "corpus_manifest", "journal"]}
+    for path in dirs.values():
+        os.makedirs(path)
+    for module in [process_reduced_records, apply_harvest]:
+        monkeypatch.setattr(module, "RLR_DIR", dirs["reducedListRecords"])
+        monkeypatch.setattr(module, "STATS_DIR", dirs["stats"])
+        monkeypatch.setattr(module, "CORPUS_DIR", dirs["corpus"])
+        monkeypatch.setattr(module, "MANIFEST_PARTS_DIR", dirs["corpus_manifest"])
+    monkeypatch.setattr(apply_harvest, "PROCESS_JOURNAL_DIR", dirs["journal"])
+    return dirs
+
+def _run_full(dirs, records):
+    path = os.path.join(dirs["reducedListRecords"], "ReducedListRecords.00000")
+    write_records(path, records)
+    process_content(json.loads(json.dumps(records)), "00000", _args())
+    return path
+
+def _results(dirs):
+    with open(os.path.join(dirs["stats"], "stats.00000"), encoding="utf-8") as f:
+        stats = _normalized(json.load(f))
+    corpus_files = {}
+    for lang in os.listdir(dirs["corpus"]):
+        for file_name in os.listdir(os.path.join(dirs["corpus"], lang)):
+            with open(os.path.join(dirs["corpus"], lang, file_name), encoding="utf-8") as f:
+                corpus_files[(lang, file_name)] = f.read()
+    with open(os.path.join(dirs["corpus_manifest"], "manifest.00000"), encoding="utf-8") as f:
+        manifest = sorted(json.load(f), key=lambda entry: entry["basename"])
+    records = load_records(os.path.join(dirs["reducedListRecords"], "ReducedListRecords.00000"))
+    return stats, corpus_files, manifest, records
+
+def test_add_stats_subtraction():
+    records = _records()
+    removed = records[1:3] + records[5:]
+    kept = [record for record in records if record not in removed]
+    combined = _stats(records)
+    combined.add_stats(_stats(removed).stats, -1)
+    assert _normalized(combined.stats) == _normalized(_stats(kept).stats)
+    combined.add_stats(_stats(removed).stats, 1)
+    assert _normalized(combined.stats) == _normalized(_stats(records).stats)
+
+def test_add_stats_mismatch():
+    stats = _stats(_records()[:1])
+    with pytest.raises((KeyError, ValueError)):
+        stats.add_stats(_stats(_records()[1:3]).stats, -1)
+
+def test_apply_file_changes_matches_full_run(tmp_path, monkeypatch):
+    records = _records()
+    changed = {
+        # updated: new description and classes
+        "oai:test.example.org:1": _record(1, EN_TEXT[3], ["580"], autoclasscodes=["580"]),
+        # deleted
+        "oai:test.example.org:2": None,
+        # updated, no longer eligible
+        "oai:test.example.org:5": _record(5, "Kurz.", ["020"]),
+        # updated, now eligible
+        "oai:test.example.org:3": _record(3, DE_TEXT[0], ["340"])
+    }
+    expected_records = []
+    for record in records:
+        identifier = record["identifier"][0]
+        if identifier not in changed:
+            expected_records.append(record)
+        elif changed[identifier] is not None:
+            expected_records.append(changed[identifier])
+
+    dirs = _use_dirs(monkeypatch, tmp_path / "incremental")
+    path = _run_full(dirs, records)
+    index = RecordIndex(str(tmp_path / "record_index.db"))
+    index.index_file(os.path.basename(path), records, path)
+    corpus_changes = {lang: {"removed": set(), "added": set()} for lang in apply_harvest.LANGS}
+    apply_harvest._apply_file_changes(os.path.basename(path), json.loads(json.dumps(changed)), index, corpus_changes, SETTINGS, _args())
+    incremental = _results(dirs)
+    assert index.lookup("oai:test.example.org:2") is None
+    index.close()
+
+    dirs = _use_dirs(monkeypatch, tmp_path / "full")
+    _run_full(dirs, expected_records)
+    full = _results(dirs)
+
+    assert incremental[0] == full[0]
+    assert incremental[1] == full[1]
+    assert incremental[2] == full[2]
+    assert incremental[3] == full[3]
+    assert corpus_changes["de"]["removed"] == set(["00000.oai~test.example.org~2", "00000.oai~test.example.org~5"])
+    assert corpus_changes["de"]["added"] == set(["00000.oai~test.example.org~3"])
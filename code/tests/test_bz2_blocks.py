@@ -0,0 +1,77 @@
+import bz2
+import random
+
+import pytest
+
+import bz2_blocks
+
+from bz2_blocks import decompress_file, find_blocks
+
+def _records(num_records, seed):
+    # Varied JSON-like lines, so the data spans several blocks even at a
+    # small block size and records cross block edges
+    rng = random.Random(seed)
+    words = ["".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(2, 12))) for _ in range(5000)]
+    lines = []
+    for index in range(num_records):
+        title = " ".join(rng.choice(words) for _ in range(rng.randint(3, 30)))
+        lines.append('{{"identifier": ["oai:test:{}"], "title": ["{}"]}}\n'.format(index, title))
+    return "".join(lines).encode("utf-8")
+
+def _write(path, data, compresslevel):
+    with open(path, "wb") as f:
+        f.write(bz2.compress(data, compresslevel=compresslevel))
+
+def _expected(path):
+    with bz2.open(path, mode="rb") as f:
+        return f.read()
+
+def test_multi_block_file(tmp_path):
+    path = str(tmp_path / "multi.bz2")
+    # compresslevel 1 means blocks of 100k uncompressed data
+    _write(path, _records(4000, 0), 1)
+    assert len(find_blocks(path)) > 3
+    assert decompress_file(path, 2) == _expected(path)
+
+def test_single_block_file(tmp_path):
+    path = str(tmp_path / "single.bz2")
+    _write(path, _records(10, 1), 9)
+    assert len(find_blocks(path)) == 1
+    assert decompress_file(path, 2) == _expected(path)
+
+def test_concatenated_streams(tmp_path):
+    # parallel compressors like pbzip2 write one stream per block
+    path = str(tmp_path / "streams.bz2")
+    with open(path, "wb") as f:
+        for seed in range(3):
+            f.write(bz2.compress(_records(1500, seed), compresslevel=1))
+    assert decompress_file(path, 2) == _expected(path)
+
+def test_empty_file(tmp_path):
+    path = tmp_path / "empty.bz2"
+    path.write_bytes(b"")
+    assert decompress_file(str(path), 2) == b""
+
+def test_spurious_block_magic_falls_back(tmp_path, monkeypatch):
+    path = str(tmp_path / "spurious.bz2")
+    _write(path, _records(4000, 2), 1)
+    blocks = find_blocks(path)
+    # A block magic found by chance splits a block into two parts which
+    # cannot be decompressed
+    start, end = blocks[1]
+    middle = (start + end) // 2
+    fake_blocks = blocks[:1] + [(start, middle), (middle, end)] + blocks[2:]
+    monkeypatch.setattr(bz2_blocks, "find_blocks", lambda _: fake_blocks)
+    assert decompress_file(path, 2) == _expected(path)
+
+def test_truncated_file(tmp_path):
+    path = str(tmp_path / "truncated.bz2")
+    _write(path, _records(4000, 3), 1)
+    with open(path, "rb") as f:
+        data = f.read()
+    with open(path, "wb") as f:
+        f.write(data[:len(data) * 2 // 3])
+    # the blocks before the cut could be decompressed, the missing data
+    # must not go unnoticed
+    with pytest.raises(EOFError):
+        decompress_file(path, 2)
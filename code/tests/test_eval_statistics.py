@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+
+from eval_statistics import (CLASSIFIED, CORRECT, NUM_STATES, _bootstrap_p_value, _joint_counts, _mcnemar_p_value,
+                             _metrics, bootstrap_counts)
+
+def _pair_counts(only_a, only_b, both=0, neither=0):
+    counts = np.zeros(NUM_STATES ** 2, dtype=np.int64)
+    correct = CLASSIFIED | CORRECT
+    counts[correct + NUM_STATES * CLASSIFIED] = only_a
+    counts[CLASSIFIED + NUM_STATES * correct] = only_b
+    counts[correct + NUM_STATES * correct] = both
+    counts[CLASSIFIED + NUM_STATES * CLASSIFIED] = neither
+    return counts
+
+def _random_states(num_documents, seed):
+    rng = np.random.default_rng(seed)
+    # correlated systems: b mostly agrees with a
+    states_a = rng.choice([0, CLASSIFIED, CLASSIFIED | CORRECT], size=num_documents, p=[0.2, 0.3, 0.5]).astype(np.int8)
+    flip = rng.random(num_documents) < 0.3
+    states_b = np.where(flip, rng.choice([0, CLASSIFIED, CLASSIFIED | CORRECT], size=num_documents), states_a).astype(np.int8)
+    return states_a, states_b
+
+def _naive_bootstrap(states_a, states_b, resamples, seed):
+    """Resample the documents themselves and compute the metrics per resample."""
+    rng = np.random.default_rng(seed)
+    differences = {"exact_match": [], "success_rate": []}
+    for _ in range(resamples):
+        indices = rng.integers(0, len(states_a), size=len(states_a))
+        counts = _joint_counts(states_a[indices], states_b[indices])
+        metrics_a = _metrics(counts, 0)
+        metrics_b = _metrics(counts, 1)
+        for metric in differences:
+            differences[metric].append(metrics_a[metric] - metrics_b[metric])
+    return {metric: np.array(values) for metric, values in differences.items()}
+
+@pytest.mark.parametrize("processes", [1, 2])
+def test_multinomial_bootstrap_matches_naive_bootstrap(processes):
+    states_a, states_b = _random_states(400, 0)
+    counts = _joint_counts(states_a, states_b)
+    resampled = bootstrap_counts(counts, 4000, 1, processes)
+    assert resampled.shape == (4000, NUM_STATES ** 2)
+    assert (resampled.sum(axis=1) == len(states_a)).all()
+    naive = _naive_bootstrap(states_a, states_b, 4000, 2)
+    for metric in ["exact_match", "success_rate"]:
+        differences = _metrics(resampled, 0)[metric] - _metrics(resampled, 1)[metric]
+        assert differences.mean() == pytest.approx(naive[metric].mean(), abs=0.005)
+        assert differences.std() == pytest.approx(naive[metric].std(), rel=0.1)
+        for percentile in [2.5, 97.5]:
+            assert np.percentile(differences, percentile) == pytest.approx(np.percentile(naive[metric], percentile), abs=0.01)
+
+def test_bootstrap_counts_reproducible():
+    counts = _joint_counts(*_random_states(100, 3))
+    assert (bootstrap_counts(counts, 100, 5) == bootstrap_counts(counts, 100, 5)).all()
+
+def test_mcnemar_known_value():
+    # (|10 - 2| - 1)^2 / 12 = 4.083, chi-squared with one degree of freedom
+    assert _mcnemar_p_value(_pair_counts(10, 2, both=50, neither=20)) == pytest.approx(0.04331, abs=1e-4)
+    assert _mcnemar_p_value(_pair_counts(2, 10)) == _mcnemar_p_value(_pair_counts(10, 2))
+
+@pytest.mark.parametrize("only_a, only_b", [(0, 0), (1, 1), (5, 5), (1, 0), (0, 1)])
+def test_mcnemar_no_evidence(only_a, only_b):
+    # Equal or minimal discordant counts never give a significant result
+    assert _mcnemar_p_value(_pair_counts(only_a, only_b, both=30)) == 1.0
+
+def test_mcnemar_ignores_concordant_documents():
+    assert _mcnemar_p_value(_pair_counts(12, 3, both=0)) == _mcnemar_p_value(_pair_counts(12, 3, both=1000, neither=500))
+
+def test_bootstrap_p_value():
+    assert _bootstrap_p_value(np.ones(99)) == pytest.approx(2 / 100)
+    assert _bootstrap_p_value(np.array([-1.0, 1.0] * 50)) == 1.0
+    assert np.isnan(_bootstrap_p_value(np.array([np.nan, np.nan])))
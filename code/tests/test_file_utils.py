@@ -0,0 +1,36 @@
+import os
+
+from file_utils import Journal, input_state
+
+def _linked_corpus(tmp_path):
+    raw_dir = tmp_path / "raw"
+    corpus_dir = tmp_path / "corpus"
+    os.makedirs(raw_dir)
+    os.makedirs(corpus_dir)
+    for number in range(3):
+        for file_ext in [".txt", ".key"]:
+            name = "doc{}{}".format(number, file_ext)
+            (raw_dir / name).write_text("content {}".format(number), encoding="utf-8")
+            os.symlink(str(raw_dir / name), str(corpus_dir / name))
+    return raw_dir, corpus_dir
+
+def test_input_state_detects_edited_link_targets(tmp_path):
+    raw_dir, corpus_dir = _linked_corpus(tmp_path)
+    journal = Journal(str(tmp_path / "journal"))
+    journal.mark_done("en.train", str(corpus_dir), {"analyzer": "snowball(english)"})
+    assert journal.is_done("en.train", str(corpus_dir), {"analyzer": "snowball(english)"})
+    directory_mtime = os.stat(str(corpus_dir)).st_mtime_ns
+    # edited in place, the directory itself is unchanged
+    (raw_dir / "doc1.txt").write_text("updated content 1", encoding="utf-8")
+    assert os.stat(str(corpus_dir)).st_mtime_ns == directory_mtime
+    assert not journal.is_done("en.train", str(corpus_dir), {"analyzer": "snowball(english)"})
+
+def test_input_state_detects_removed_documents(tmp_path):
+    raw_dir, corpus_dir = _linked_corpus(tmp_path)
+    state = input_state(str(corpus_dir))
+    assert state["files"] == 6
+    os.remove(str(raw_dir / "doc2.key"))
+    assert input_state(str(corpus_dir)) != state
+    os.remove(str(corpus_dir / "doc2.key"))
+    os.remove(str(corpus_dir / "doc2.txt"))
+    assert input_state(str(corpus_dir))["files"] == 4
@@ -0,0 +1,62 @@
+import gzip
+import os
+
+import pytest
+
+import prepare_corpora
+
+from corpus_manifest import CorpusManifest, manifest_entry, write_part
+from prepare_corpora import create_tsv_corpus, load_tsv_index, update_tsv_corpus
+
+CODE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+@pytest.fixture
+def corpus(tmp_path, monkeypatch):
+    raw_dir = tmp_path / "corpus"
+    target_dir = tmp_path / "prepared_corpora"
+    os.makedirs(raw_dir / "en")
+    os.makedirs(target_dir / "en")
+    monkeypatch.setattr(prepare_corpora, "RAW_CORPUS_PATH", str(raw_dir))
+    monkeypatch.setattr(prepare_corpora, "TARGET_PATH", str(target_dir))
+    monkeypatch.setattr(prepare_corpora, "DDC_VOCAB_PATH", os.path.join(CODE_DIR, "en_ddc.tsv"))
+    monkeypatch.setattr(prepare_corpora, "TSV_CHUNK_SIZE", 3)
+    entries = []
+    for number in range(10):
+        basename = "00000.doc{}".format(number)
+        (raw_dir / "en" / (basename + ".txt")).write_text("Document\t{}\nline two".format(number), encoding="utf-8")
+        entries.append(manifest_entry(basename, "en", None, 20, ["{:03d}".format(number * 10)], []))
+    os.makedirs(tmp_path / "parts")
+    write_part(str(tmp_path / "parts"), "00000", entries)
+    manifest = CorpusManifest(str(tmp_path / "manifest.db"))
+    manifest.merge(str(tmp_path / "parts"))
+    yield raw_dir, target_dir, manifest
+    manifest.close()
+
+def _lines(target_dir):
+    with gzip.open(str(target_dir / "en" / "train.tsv.gz"), "rt", encoding="utf-8") as f:
+        return f.read().splitlines()
+
+def test_update_tsv_corpus_matches_full_rebuild(corpus):
+    raw_dir, target_dir, manifest = corpus
+    documents = ["00000.doc{}".format(number) for number in range(8)]
+    create_tsv_corpus("train", "en", documents, manifest, 2)
+    assert len(load_tsv_index("train", "en")["chunks"]) == 3
+    # doc1 removed, doc4 updated in place, doc8 and doc9 new
+    (raw_dir / "en" / "00000.doc4.txt").write_text("Updated document 4", encoding="utf-8")
+    documents = [doc for doc in documents if doc != "00000.doc1"] + ["00000.doc8", "00000.doc9"]
+    assert update_tsv_corpus("train", "en", documents, set(["00000.doc4"]), manifest, 2)
+    updated_lines = _lines(target_dir)
+    chunks = load_tsv_index("train", "en")["chunks"]
+    # the last chunk (doc6, doc7) was not changed and is copied
+    assert ["00000.doc6", "00000.doc7"] in [chunk["documents"] for chunk in chunks]
+    assert [doc for chunk in chunks for doc in chunk["documents"]] == documents
+    create_tsv_corpus("train", "en", documents, manifest, 2)
+    assert updated_lines == _lines(target_dir)
+    assert updated_lines[3].startswith("Updated document 4\t")
+
+def test_update_tsv_corpus_without_index(corpus):
+    _, target_dir, manifest = corpus
+    documents = ["00000.doc{}".format(number) for number in range(4)]
+    create_tsv_corpus("train", "en", documents, manifest, 1)
+    os.remove(str(target_dir / "en" / "train.tsv.index.json"))
+    assert not update_tsv_corpus("train", "en", documents, set(), manifest, 1)
@@ -0,0 +1,269 @@
+"""Shared pre-analyzed token cache for the Annif projects.
+
+@author Christoph Broschinski (https://github.com/cbroschinski)
+
+All projects of a language in ANNIF_PROJECTS_FILE use the same analyzer
+(snowball(english) or snowball(german)), but every backend tokenizes and
+stems the corpora again on its own. This script runs the analyzer once per
+prepared corpus (train, test and eval, directory or TSV format), in
+parallel over the documents, and stores the result in TOKEN_CACHE_DIR:
+
+<lang>/vocab.txt: One token per line, the line number is the token id
+<lang>/<corpus>.tokens: The token ids of all documents (unsigned 32 bit)
+<lang>/<corpus>.index.tsv: Document name, offset and number of tokens in
+the .tokens file and the document subjects (Annif TSV notation)
+
+Corpora are only analyzed again if they have changed (see the journal in
+JOURNAL_DIR, for directory corpora this includes documents edited in
+place, f.e. by apply_harvest.py). With -x, pre-analyzed Annif TSV corpora (<lang>/<corpus>.tsv.gz,
+the tokens of each document joined by spaces) and a projects file using
+CACHED_ANALYZER instead of the original analyzer (projects.cfg) are
+written to TOKEN_CACHE_DIR. Annif can then be trained and evaluated on
+the pre-analyzed texts:
+
+ANNIF_PROJECTS=../data/token_cache/projects.cfg ANNIF_DATADIR=../data/token_cache/annif_data annif train en-tfidf ../data/token_cache/en/train.tsv.gz
+
+optimize_annif.py (-k) and classify_eval_corpus.py (-k) can use the cache
+as well.
+
+Annif backends only accept text, so the cached token ids are exported as
+text again and Annif still tokenizes it (nltk word tokenization and lower
+casing by CACHED_ANALYZER), only the stemming is saved. Measured with
+Annif's analyzers on 4334 English documents of 600 characters, one
+snowball pass took 4.6s, the export 0.06s and one pass of CACHED_ANALYZER
+over the exported texts 1.9s. With a single project, the cache is a loss
+(6.5s instead of 4.6s), it pays off from two projects on (three projects
+per language in projects.cfg: 10.3s instead of 13.7s, five: 14.0s instead
+of 22.8s), more so for repeated runs and grid searches with
+optimize_annif.py, which reuse the cache. As sentence boundaries are not
+kept, re-tokenizing the export yields slightly different tokens for some
+abbreviations at the end of a sentence (22 of the 4334 documents).
+
+The analyzer comes from Annif, so this script must be run with the Python
+interpreter of the Annif environment (annif/annif-venv).
+"""
+
+import argparse
+import configparser
+import gzip
+import os
+import shutil
+import sys
+
+from array import array
+from os.path import join
+import multiprocessing as mp
+
+from file_utils import Journal, atomic_write, atomic_write_with
+
+ANNIF_PROJECTS_FILE = "../annif/projects.cfg"
+PREP_CORPORA_DIR = "../data/prepared_corpora"
+TOKEN_CACHE_DIR = "../data/token_cache"
+JOURNAL_DIR = "../data/journal/token_cache"
+DDC_VOCAB_PATH = "en_ddc.tsv"
+
+CORPUS_TYPES = ["train", "test", "eval"]
+# Keeps the cached tokens as they are (only lowercases them)
+CACHED_ANALYZER = "simple(token_min_length=1)"
+CHUNK_SIZE = 100
+
+ANALYZER = None
+
+def project_analyzers(projects_file):
+    """Return the analyzer used by the projects of each language."""
+    projects_config = configparser.ConfigParser(interpolation=None)
+    projects_config.read(projects_file, encoding="utf-8")
+    analyzers = {}
+    for section in projects_config.sections():
+        if "analyzer" not in projects_config[section]:
+            continue
+        lang = projects_config[section]["language"]
+        analyzers.setdefault(lang, set()).add(projects_config[section]["analyzer"])
+    return analyzers
+
+def _load_ddc_codes():
+    # Like Annif, the last code for a non-unique class name is used
+    codes = {}
+    with open(DDC_VOCAB_PATH, encoding="utf-8") as f:
+        for line in f:
+            components = line.split("\t")
+            codes[components[1].replace("\n", "")] = components[0]
+    return codes
+
+def _init_worker(analyzer_spec):
+    global ANALYZER
+    # Imported here, reading the cache does not require Annif
+    from annif.analyzer import get_analyzer
+    ANALYZER = get_analyzer(analyzer_spec)
+
+def _analyze_document(document):
+    name, text, text_path, subjects = document
+    if text is None:
+        with open(text_path, encoding="utf-8") as f:
+            text = f.read()
+    return name, ANALYZER.tokenize_words(text), subjects
+
+def _read_documents(corpus_path, ddc_codes):
+    """Yield (name, text, text path, subjects) tuples, the text is only
+    given for TSV corpora."""
+    if os.path.isdir(corpus_path):
+        for file_name in sorted(os.listdir(corpus_path)):
+            if not file_name.endswith(".txt"):
+                continue
+            name = file_name[:-4]
+            with open(join(corpus_path, name + ".key"), encoding="utf-8") as key_file:
+                labels = [line.replace("\n", "") for line in key_file if line.strip()]
+            subjects = " ".join(["<" + ddc_codes[label] + ">" for label in labels])
+            yield name, None, join(corpus_path, file_name), subjects
+        return
+    with gzip.open(corpus_path, "rt", encoding="utf-8") as tsv_file:
+        for number, line in enumerate(tsv_file):
+            text, subjects = line.rstrip("\n").split("\t", 1)
+            yield str(number), text, None, subjects
+
+def _corpus_path(lang, corpus_type):
+    dir_path = join(PREP_CORPORA_DIR, lang, corpus_type)
+    if os.path.isdir(dir_path):
+        return dir_path
+    tsv_path = join(PREP_CORPORA_DIR, lang, corpus_type + ".tsv.gz")
+    if os.path.isfile(tsv_path):
+        return tsv_path
+    return None
+
+def load_vocab(lang):
+    vocab_path = join(TOKEN_CACHE_DIR, lang, "vocab.txt")
+    if not os.path.isfile(vocab_path):
+        return []
+    with open(vocab_path, encoding="utf-8") as f:
+        return [line.rstrip("\n") for line in f]
+
+def load_corpus(lang, corpus_type):
+    """Yield (document name, tokens, subjects) for a cached corpus."""
+    vocab = load_vocab(lang)
+    token_ids = array("I")
+    with open(join(TOKEN_CACHE_DIR, lang, corpus_type + ".tokens"), "rb") as f:
+        token_ids.frombytes(f.read())
+    with open(join(TOKEN_CACHE_DIR, lang, corpus_type + ".index.tsv"), encoding="utf-8") as f:
+        for line in f:
+            name, offset, length, subjects = line.rstrip("\n").split("\t")
+            offset = int(offset)
+            tokens = [vocab[token_id] for token_id in token_ids[offset:offset + int(length)]]
+            yield name, tokens, subjects
+
+def cache_is_current(lang, corpus_type):
+    """True if the cached tokens of a prepared corpus exist and were built
+    from its current version."""
+    corpus_path = _corpus_path(lang, corpus_type)
+    lang_dir = join(TOKEN_CACHE_DIR, lang)
+    analyzer_path = join(lang_dir, "analyzer.txt")
+    if corpus_path is None or not os.path.isfile(analyzer_path):
+        return False
+    with open(analyzer_path, encoding="utf-8") as f:
+        settings = {"analyzer": f.read()}
+    outputs = [join(lang_dir, corpus_type + ".tokens"), join(lang_dir, corpus_type + ".index.tsv")]
+    return Journal(JOURNAL_DIR).is_done(lang + "." + corpus_type, corpus_path, settings, outputs)
+
+def build_corpus_cache(lang, corpus_type, corpus_path, analyzer_spec, args):
+    vocab = load_vocab(lang)
+    token_ids = {token: token_id for token_id, token in enumerate(vocab)}
+    all_ids = array("I")
+    index_lines = []
+    ddc_codes = _load_ddc_codes()
+    with mp.Pool(args.processes, initializer=_init_worker, initargs=(analyzer_spec,)) as pool:
+        for name, tokens, subjects in pool.imap(_analyze_document, _read_documents(corpus_path, ddc_codes), chunksize=CHUNK_SIZE):
+            offset = len(all_ids)
+            for token in tokens:
+                if token not in token_ids:
+                    token_ids[token] = len(vocab)
+                    vocab.append(token)
+                all_ids.append(token_ids[token])
+            index_lines.append("{}\t{}\t{}\t{}\n".format(name, offset, len(tokens), subjects))
+    lang_dir = join(TOKEN_CACHE_DIR, lang)
+    def _write_tokens(temp_path):
+        with open(temp_path, "wb") as f:
+            all_ids.tofile(f)
+    atomic_write_with(join(lang_dir, corpus_type + ".tokens"), _write_tokens)
+    atomic_write(join(lang_dir, corpus_type + ".index.tsv"), "".join(index_lines))
+    atomic_write(join(lang_dir, "vocab.txt"), "".join([token + "\n" for token in vocab]))
+    msg = "{} corpus '{}': {} documents, {} tokens, vocabulary size {}"
+    print(msg.format(corpus_type, lang, len(index_lines), len(all_ids), len(vocab)))
+
+def export_tsv_corpus(lang, corpus_type):
+    tsv_path = join(TOKEN_CACHE_DIR, lang, corpus_type + ".tsv.gz")
+    def _write_tsv(temp_path):
+        with gzip.open(temp_path, "wt", encoding="utf-8") as tsv_file:
+            for name, tokens, subjects in load_corpus(lang, corpus_type):
+                tsv_file.write(" ".join(tokens) + "\t" + subjects + "\n")
+    atomic_write_with(tsv_path, _write_tsv)
+    print("Pre-analyzed corpus written to " + tsv_path)
+
+def export_projects_file(projects_file, analyzers):
+    projects_config = configparser.ConfigParser(interpolation=None)
+    projects_config.read(projects_file, encoding="utf-8")
+    for section in projects_config.sections():
+        lang = projects_config[section]["language"]
+        if projects_config[section].get("analyzer") == analyzers.get(lang):
+            projects_config[section]["analyzer"] = CACHED_ANALYZER
+    path = join(TOKEN_CACHE_DIR, "projects.cfg")
+    with open(path, "w", encoding="utf-8") as f:
+        projects_config.write(f)
+    print("Projects file for the pre-analyzed corpora written to " + path)
+
+def build_cache(lang, analyzer_spec, journal, args):
+    lang_dir = join(TOKEN_CACHE_DIR, lang)
+    analyzer_path = join(lang_dir, "analyzer.txt")
+    if os.path.isfile(analyzer_path):
+        with open(analyzer_path, encoding="utf-8") as f:
+            if f.read() != analyzer_spec:
+                print("Analyzer for '{}' has changed, clearing the token cache...".format(lang))
+                shutil.rmtree(lang_dir)
+    os.makedirs(lang_dir, exist_ok=True)
+    atomic_write(analyzer_path, analyzer_spec)
+    settings = {"analyzer": analyzer_spec}
+    for corpus_type in CORPUS_TYPES:
+        corpus_path = _corpus_path(lang, corpus_type)
+        if corpus_path is None:
+            continue
+        item = lang + "." + corpus_type
+        cache_exists = os.path.isfile(join(lang_dir, corpus_type + ".index.tsv"))
+        if cache_exists and not args.overwrite and journal.is_done(item, corpus_path, settings):
+            print("{} corpus '{}' is unchanged, using cached tokens".format(corpus_type, lang))
+        else:
+            print("Analyzing {} corpus '{}' ({}) with {}...".format(corpus_type, lang, corpus_path, analyzer_spec))
+            build_corpus_cache(lang, corpus_type, corpus_path, analyzer_spec, args)
+            journal.mark_done(item, corpus_path, settings)
+        if args.export:
+            export_tsv_corpus(lang, corpus_type)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-D", "--german", action="store_true", help="Analyze the german prepared corpora")
+    parser.add_argument("-E", "--english", action="store_true", help="Analyze the english prepared corpora")
+    parser.add_argument("-p", "--processes", type=int, default=os.cpu_count(), help="Number of worker processes (default: all CPUs)")
+    parser.add_argument("-x", "--export", action="store_true", help="Also write pre-analyzed Annif TSV corpora and a matching projects file to " + TOKEN_CACHE_DIR)
+    parser.add_argument("-o", "--overwrite", action="store_true", help="Analyze all corpora again, even if they have not changed")
+    parser.add_argument("-f", "--projects_file", default=ANNIF_PROJECTS_FILE, help="Annif projects file to take the analyzers from (default: " + ANNIF_PROJECTS_FILE + ")")
+    args = parser.parse_args()
+
+    langs = []
+    if args.german:
+        langs.append("de")
+    if args.english:
+        langs.append("en")
+    if not langs:
+        print("Error: Either the German (-D) or English (-E) corpora must be analyzed (or both)")
+        sys.exit()
+    analyzers = {}
+    for lang, lang_analyzers in project_analyzers(args.projects_file).items():
+        if len(lang_analyzers) > 1:
+            print("Error: The '{}' projects use different analyzers ({}), a shared cache is not possible".format(lang, ", ".join(sorted(lang_analyzers))))
+            sys.exit()
+        analyzers[lang] = lang_analyzers.pop()
+    journal = Journal(JOURNAL_DIR)
+    for lang in langs:
+        if lang not in analyzers:
+            print("Error: No project with language '{}' found in {}".format(lang, args.projects_file))
+            sys.exit()
+        build_cache(lang, analyzers[lang], journal, args)
+    if args.export:
+        export_projects_file(args.projects_file, analyzers)
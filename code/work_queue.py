@@ -0,0 +1,170 @@
+"""Shared work queue for sharded execution on several nodes.
+
+@author Christoph Broschinski (https://github.com/cbroschinski)
+
+This module provides a simple work queue based on an SQLite database,
+which is used by create_reduced_records.py and process_reduced_records.py
+in queue mode (-q). Instead of assigning ListRecords number ranges to
+each host by hand, every participating node (any number of script
+instances, on one or several machines) opens the same queue file on
+shared storage and claims input files one at a time until all files
+have been processed.
+
+A claim is a lease with a limited lifetime. Nodes renew the leases of
+files they are still working on, so if a node dies, its files become
+claimable again once the lease has expired. Failed files are put back
+into the queue until they reach the maximum number of attempts.
+
+Items stay done once they have been completed, so every run needs a new
+queue file: The scripts only add the files they would process (taking
+their journal and -o into account), files already done in an older queue
+file are skipped with a warning.
+
+Called as a script, a status overview of a queue file is printed:
+
+python work_queue.py ../data/reduce_queue.db
+"""
+
+import argparse
+import os
+import platform
+import sqlite3
+
+from time import time
+
+LEASE_SECONDS = 600
+MAX_ATTEMPTS = 3
+
+STATUS_PENDING = "pending"
+STATUS_CLAIMED = "claimed"
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+
+def default_node_id():
+    return platform.node() + ":" + str(os.getpid())
+
+class WorkQueue(object):
+
+    def __init__(self, path, lease_seconds=LEASE_SECONDS, max_attempts=MAX_ATTEMPTS):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        # autocommit mode, transactions are started explicitly where needed
+        self.connection = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS work_items ("
+            "name TEXT PRIMARY KEY, "
+            "status TEXT NOT NULL, "
+            "node TEXT, "
+            "lease_expires REAL, "
+            "attempts INTEGER NOT NULL DEFAULT 0, "
+            "error TEXT)"
+        )
+
+    def add_items(self, names):
+        """Add new items to the queue. Items already known are ignored,
+        so every node may call this with its own file listing. Returns the
+        given items which are already done (f.e. from an earlier run with
+        the same queue file), they are not processed again."""
+        self.connection.execute("BEGIN IMMEDIATE")
+        self.connection.executemany(
+            "INSERT OR IGNORE INTO work_items (name, status) VALUES (?, ?)",
+            [(name, STATUS_PENDING) for name in names]
+        )
+        done = set(row[0] for row in self.connection.execute("SELECT name FROM work_items WHERE status = ?", (STATUS_DONE,)))
+        self.connection.execute("COMMIT")
+        return sorted(done.intersection(names))
+
+    def claim(self, node):
+        """Claim the next pending item (or one with an expired lease) for a node.
+        Returns the item name or None if nothing can be claimed at the moment."""
+        now = time()
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            self.connection.execute(
+                "UPDATE work_items SET status = ?, error = ? WHERE status = ? AND lease_expires < ? AND attempts >= ?",
+                (STATUS_FAILED, "lease expired", STATUS_CLAIMED, now, self.max_attempts)
+            )
+            row = self.connection.execute(
+                "SELECT name FROM work_items WHERE status = ? OR (status = ? AND lease_expires < ?) ORDER BY name LIMIT 1",
+                (STATUS_PENDING, STATUS_CLAIMED, now)
+            ).fetchone()
+            if row is None:
+                self.connection.execute("COMMIT")
+                return None
+            self.connection.execute(
+                "UPDATE work_items SET status = ?, node = ?, lease_expires = ?, attempts = attempts + 1 WHERE name = ?",
+                (STATUS_CLAIMED, node, now + self.lease_seconds, row[0])
+            )
+            self.connection.execute("COMMIT")
+        except sqlite3.Error:
+            self.connection.execute("ROLLBACK")
+            raise
+        return row[0]
+
+    def renew(self, names, node):
+        """Extend the leases of items a node is still working on."""
+        expires = time() + self.lease_seconds
+        self.connection.executemany(
+            "UPDATE work_items SET lease_expires = ? WHERE name = ? AND node = ? AND status = ?",
+            [(expires, name, node, STATUS_CLAIMED) for name in names]
+        )
+
+    def complete(self, name, node):
+        self.connection.execute(
+            "UPDATE work_items SET status = ?, lease_expires = NULL, error = NULL WHERE name = ? AND node = ?",
+            (STATUS_DONE, name, node)
+        )
+
+    def fail(self, name, node, error, permanent=False):
+        """Return a failed item to the queue, or mark it as failed for good
+        if it has reached the maximum number of attempts (or the error is
+        permanent, f.e. a corrupt input file)."""
+        self.connection.execute(
+            "UPDATE work_items SET status = CASE WHEN attempts >= ? OR ? THEN ? ELSE ? END, "
+            "lease_expires = NULL, error = ? WHERE name = ? AND node = ?",
+            (self.max_attempts, permanent, STATUS_FAILED, STATUS_PENDING, error, name, node)
+        )
+
+    def unfinished(self):
+        row = self.connection.execute(
+            "SELECT COUNT(*) FROM work_items WHERE status IN (?, ?)",
+            (STATUS_PENDING, STATUS_CLAIMED)
+        ).fetchone()
+        return row[0]
+
+    def summary(self):
+        summary = {STATUS_PENDING: 0, STATUS_CLAIMED: 0, STATUS_DONE: 0, STATUS_FAILED: 0}
+        for status, count in self.connection.execute("SELECT status, COUNT(*) FROM work_items GROUP BY status"):
+            summary[status] = count
+        return summary
+
+    def failed_items(self):
+        return self.connection.execute(
+            "SELECT name, attempts, error FROM work_items WHERE status = ? ORDER BY name",
+            (STATUS_FAILED,)
+        ).fetchall()
+
+    def reset_failed(self):
+        self.connection.execute(
+            "UPDATE work_items SET status = ?, attempts = 0, error = NULL WHERE status = ?",
+            (STATUS_PENDING, STATUS_FAILED)
+        )
+
+    def close(self):
+        self.connection.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("queue", help="Path to the queue file")
+    parser.add_argument("-r", "--retry_failed", action="store_true", help="Put all failed items back into the queue")
+    args = parser.parse_args()
+
+    queue = WorkQueue(args.queue)
+    if args.retry_failed:
+        queue.reset_failed()
+    for status, count in queue.summary().items():
+        print("{}: {}".format(status, count))
+    for name, attempts, error in queue.failed_items():
+        print("failed: {} ({} attempts): {}".format(name, attempts, error))
+    queue.close()